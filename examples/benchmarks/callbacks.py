@@ -0,0 +1,48 @@
+"""
+Per-step overhead of the callback dispatch in Trainer.
+
+Callbacks here only hook `on_train_epoch_end`, so `train_batch` should cost
+nearly the same with 0, 5 or 20 of them hooked.
+"""
+import time
+
+from thexp import Trainer, Params, callbacks
+
+
+def make_callback(i):
+    def on_train_epoch_end(self, trainer, func, params, meter, *args, **kwargs):
+        pass
+
+    return type('EpochCallback{}'.format(i), (callbacks.TrainCallback,),
+                {'on_train_epoch_end': on_train_epoch_end})()
+
+
+class BenchTrainer(Trainer):
+    def train_batch(self, eidx, idx, global_step, batch_data, params, device):
+        return None
+
+
+def bench(trainer: Trainer, steps=100000):
+    params, device = trainer.params, trainer.device
+    start = time.perf_counter()
+    for i in range(steps):
+        trainer.train_batch(0, i, i, None, params, device)
+    return (time.perf_counter() - start) / steps
+
+
+if __name__ == '__main__':
+    params = Params()
+    params.git_commit = False
+    trainer = BenchTrainer(params)
+
+    hooked = 0
+    for num in [0, 5, 20]:
+        while hooked < num:
+            make_callback(hooked).hook(trainer)
+            hooked += 1
+        print('{:>2d} callbacks: {:.3f} us/step'.format(num, bench(trainer) * 1e6))
+
+    profiler = callbacks.ProfileCallback()
+    profiler.hook(trainer)
+    print('{:>2d} callbacks + ProfileCallback: {:.3f} us/step'.format(hooked, bench(trainer) * 1e6))
+    profiler.flush()
@@ -0,0 +1,51 @@
+"""
+Steps/sec of AvgMeter with 5 tracked scalar tensors, and the host overhead of AvgMeter.update().
+
+`eager` converts every tensor to numpy before updating, which is what AvgMeter
+used to do internally and forces a device sync per value. `lazy` passes the
+tensors through and only reads the averages once at the end.
+"""
+import time
+
+import torch
+
+from thexp import Meter, AvgMeter
+
+
+def bench(eager: bool, device, steps=2000):
+    avg = AvgMeter()
+    x = torch.rand(256, 256, device=device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        x = (x @ x).tanh()  # some work queued on the device
+        meter = Meter()
+        for i in range(5):
+            value = x[i, i]
+            if eager:
+                value = value.detach().cpu().numpy()
+            meter['loss{}'.format(i)] = value
+        avg.update(meter)
+    avg.serialize()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return steps / (time.perf_counter() - start)
+
+
+def bench_update(steps=20000):
+    """µs per AvgMeter.update() of a Meter with 5 python floats, host overhead only"""
+    avg = AvgMeter()
+    meter = Meter()
+    for i in range(5):
+        meter['loss{}'.format(i)] = 0.5
+    start = time.perf_counter()
+    for _ in range(steps):
+        avg.update(meter)
+    return (time.perf_counter() - start) / steps * 1e6
+
+
+if __name__ == '__main__':
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    print('device:', device)
+    for eager in [True, False]:
+        print('{:>5s}: {:.0f} steps/s'.format('eager' if eager else 'lazy', bench(eager, device)))
+    print('update: {:.2f} us/step'.format(bench_update()))
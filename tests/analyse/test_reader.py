@@ -0,0 +1,134 @@
+"""
+
+"""
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+from thexp.analyse import reader
+
+
+def write_scalars(log_dir, values):
+    writer = SummaryWriter(log_dir, filename_suffix='.bd')
+    for step, value in enumerate(values):
+        writer.add_scalar('loss', value, step)
+    writer.flush()
+    return writer
+
+
+def test_reader(tmp_path, monkeypatch):
+    writer = write_scalars(str(tmp_path), [0.123456, 0.5])
+    file = writer.file_writer.event_writer._file_name
+
+    bd = reader.BoardReader(file)
+    assert bd.scalars_tags == ['loss']
+    scalars = bd.get_scalars('loss')
+    assert abs(scalars.values[0] - 0.123456) < 1e-7  # not rounded
+    assert list(scalars.steps) == [0, 1]
+    assert os.path.exists(reader.cache_file(file))
+    assert len([i for i in os.listdir(str(tmp_path)) if 'tfevents' in i]) == 1
+
+    # a new reader reads the cache instead of the event file
+    bd = reader.BoardReader(file)
+    assert list(bd.get_scalars('loss').values) == list(scalars.values)
+    assert bd._offset == os.path.getsize(file)
+
+    # reload only after the event file grew
+    writer.add_scalar('loss', 0.25, 2)
+    writer.flush()
+    assert list(bd.get_scalars('loss').steps) == [0, 1, 2]
+    assert not bd._reloaded  # scalars never go through EventAccumulator
+
+    # a stale cache is resumed from its offset, instead of parsing the event file again
+    offsets = []
+    read_scalars = reader.read_scalars
+
+    def record_offset(file, offset=0, tags=None):
+        offsets.append(offset)
+        return read_scalars(file, offset, tags)
+
+    monkeypatch.setattr(reader, 'read_scalars', record_offset)
+    for step, load in enumerate([lambda bd: bd.get_scalars('loss'), lambda bd: bd.load(['loss'])['loss']], 3):
+        cached = os.path.getsize(file)
+        writer.add_scalar('loss', 0.125, step)
+        writer.flush()
+        offsets.clear()
+        assert list(load(reader.BoardReader(file)).steps) == list(range(step + 1))
+        assert offsets == [cached]
+    writer.close()
+
+
+def test_read_scalars(tmp_path):
+    writer = write_scalars(str(tmp_path), [1., 2.])
+    writer.add_scalar('acc', 0.5, 0)
+    writer.add_histogram('w', torch.arange(10), 0)
+    writer.flush()
+    file = writer.file_writer.event_writer._file_name
+
+    scalars, offset = reader.read_scalars(file)
+    assert offset == os.path.getsize(file)
+    assert set(scalars) == {'loss', 'acc'}
+    assert list(scalars['loss'].values) == [1., 2.]
+    assert scalars['loss'].steps.dtype == np.int64
+
+    ea = reader.BoardReader(file).ea
+    ea.Reload()
+    assert list(scalars['acc'].wall_times) == [i.wall_time for i in ea.Scalars('acc')]
+
+    # tail reads from the returned offset
+    writer.add_scalar('loss', 3., 2)
+    writer.flush()
+    with open(file, 'ab') as w:
+        w.write(b'\x10\x00\x00')  # a record not completely written yet
+    scalars, new_offset = reader.read_scalars(file, offset, tags=['loss'])
+    assert list(scalars) == ['loss']
+    assert list(scalars['loss'].values) == [3.]
+    assert new_offset == os.path.getsize(file) - 3
+    writer.close()
+
+
+def test_read_scalars_skips_large_records(tmp_path, monkeypatch):
+    monkeypatch.setattr(reader, '_MAX_SCALAR_RECORD', 1000)
+    writer = write_scalars(str(tmp_path), [1.])
+    writer.add_histogram('w', torch.rand(10000), 0, bins=500)  # larger than 1000 bytes
+    writer.add_scalar('loss', 2., 1)
+    writer.flush()
+    file = writer.file_writer.event_writer._file_name
+
+    scalars, offset = reader.read_scalars(file)
+    assert list(scalars['loss'].values) == [1., 2.]
+    assert offset == os.path.getsize(file)
+    writer.close()
+
+
+def test_board_query_load(tmp_path):
+    from thexp.analyse.querys import BoardQuery
+    from thexp.analyse.viewer import TestViewer
+
+    readers, viewers = [], []
+    for i in range(3):
+        test_dir = os.path.join(str(tmp_path), '{:04d}.test'.format(i))
+        writer = write_scalars(test_dir, [i, i + 1])
+        writer.add_scalar('acc', i, 0)
+        with open(os.path.join(test_dir, 'info.v1.json'), 'w') as w:
+            json.dump({'test_name': os.path.basename(test_dir)}, w)
+        readers.append(reader.BoardReader(writer.file_writer.event_writer._file_name))
+        writer.close()
+        viewers.append(TestViewer(test_dir))
+    bq = BoardQuery(readers, viewers)
+
+    df = bq.load(['loss', 'missing'], workers=2)
+    assert list(df.columns) == ['test', 'tag', 'step', 'value']
+    assert len(df) == 6 and set(df['tag']) == {'loss'}
+    assert df[df['test'] == '0002.test']['value'].tolist() == [2., 3.]
+    # only the requested tags were decoded, the cache is not written from them
+    assert not os.path.exists(reader.cache_file(readers[0].file))
+
+    assert len(bq.load(workers=0)) == 9
+    assert os.path.exists(reader.cache_file(readers[0].file))
+    assert readers[0]._scalars is not None  # workers<=1 reuses the readers of the query
+    df = bq.load(['acc'], workers=2)  # read from the cache
+    assert df['value'].tolist() == [0., 1., 2.]
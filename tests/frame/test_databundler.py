@@ -0,0 +1,101 @@
+"""
+
+"""
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from thexp import DataBundler
+
+
+def _loader(num=10, batch_size=2):
+    return DataLoader(TensorDataset(torch.arange(num)), batch_size=batch_size)
+
+
+def test_prefetch():
+    bundler = DataBundler().add(_loader()).to('cpu')
+    plain = [batch[0] for batch in bundler]
+
+    bundler.prefetch(depth=2)
+    prefetched = [batch[0] for batch in bundler]
+    assert len(prefetched) == len(plain) == len(bundler)
+    for a, b in zip(plain, prefetched):
+        assert (a == b).all()
+    assert bundler.wait_time >= 0
+
+
+def test_prefetch_early_stop():
+    import threading
+    bundler = DataBundler().cycle(_loader(), 'cycled').chain_mode().prefetch(depth=2)
+    threads = threading.active_count()
+
+    for idx, batch in enumerate(bundler):  # cycled loader never ends
+        if idx == 5:
+            break
+    assert threading.active_count() == threads
+
+
+def test_prefetch_exception():
+    def collate(batch):
+        raise ValueError('collate')
+
+    bundler = DataBundler().add(DataLoader(TensorDataset(torch.arange(4)), collate_fn=collate)).prefetch()
+    try:
+        for _ in bundler:
+            pass
+        assert False
+    except ValueError:
+        pass
+
+
+def _alive_batches(cycled, steps=50):
+    """count how many distinct yielded batches are still referenced after iterating"""
+    import gc
+    import weakref
+    refs = []
+    for idx, (batch,) in enumerate(cycled):
+        refs.append(weakref.ref(batch))
+        if idx == steps:
+            break
+    del batch
+    gc.collect()
+    return len({id(ref()) for ref in refs if ref() is not None})
+
+
+def test_cycle_memory():
+    import itertools
+    from thexp.frame.databundler import cycle
+
+    loader = _loader(num=20, batch_size=2)
+    # itertools.cycle keeps every batch of the first pass alive
+    assert _alive_batches(itertools.cycle(loader)) == len(loader)
+    assert _alive_batches(cycle(loader)) <= 1  # only the batch held by the suspended generator
+
+    bundler = DataBundler().add(_loader(num=10, batch_size=2), 'labeled').cycle(loader, 'unlabeled').zip_mode()
+    assert len(bundler) == 5
+    assert len(list(bundler)) == 5
+
+
+def test_cycle_reshuffle():
+    from thexp.frame.databundler import cycle
+    loader = DataLoader(TensorDataset(torch.arange(100)), batch_size=100, shuffle=True)
+    first, second = [batch[0] for _, batch in zip(range(2), cycle(loader))]
+    assert not (first == second).all()
+    assert (first.sort()[0] == second.sort()[0]).all()
+
+
+def test_prefetch_custom_to_device():
+    from thexp.contrib.device import to_device
+    from thexp.frame.databundler import _accepts_non_blocking
+
+    assert _accepts_non_blocking(to_device)
+    assert _accepts_non_blocking(lambda batch, device, **kwargs: batch)
+    assert not _accepts_non_blocking(lambda batch, device: batch)
+
+    moved = []
+
+    def move(batch, device):
+        moved.append(device)
+        return batch
+
+    bundler = DataBundler(device='cpu', to_device_fn=move).add(_loader()).prefetch(depth=2)
+    assert len(list(bundler)) == len(bundler) == len(moved)
@@ -0,0 +1,71 @@
+"""
+
+"""
+import json
+import os
+
+from thexp.frame.experiment import Experiment
+
+
+def read_info(exp):
+    with open(exp.test_info_fn, encoding='utf-8') as r:
+        return json.load(r)
+
+
+def test_coalesced_write():
+    exp = Experiment('test_experiment')
+    assert not os.path.exists(exp.test_info_fn)
+    exp.flush()
+    assert read_info(exp)['commit_hash'] == exp.commit.hexsha
+
+    exp.add_plugin('a', {'v': 1})
+    exp.add_tag('b', 'a')
+    exp.makedir('c')
+    info = read_info(exp)
+    assert 'a' not in info['plugins'] and 'b' not in info['tags'] and 'c' not in info['dirs']
+
+    exp.flush()
+    info = read_info(exp)
+    assert info['plugins']['a'] == {'v': 1} and info['tags']['b'] == ['a'] and 'c' in info['dirs']
+    assert not any('.tmp' in f for f in os.listdir(exp.test_dir))
+
+    mtime = os.stat(exp.test_info_fn).st_mtime_ns
+    exp.flush()  # nothing changed, not rewritten
+    assert os.stat(exp.test_info_fn).st_mtime_ns == mtime
+
+    exp.add_plugin('d')
+    exp.end()
+    info = read_info(exp)
+    assert 'd' in info['plugins'] and info['end_code'] == 0
+
+
+def test_flush_after_end():
+    import threading
+    import time
+
+    exp = Experiment('test_experiment')
+    exp.add_tag('a')
+    with exp._lock:
+        # a timer flush which is waiting for the lock when the experiment ends
+        flusher = threading.Thread(target=exp.flush)
+        flusher.start()
+        time.sleep(0.2)
+        exp.end()
+    flusher.join()
+    info = read_info(exp)
+    assert info['end_code'] == 0 and 'end_time' in info
+
+
+def test_allocate_test_dir():
+    exp = Experiment('test_experiment')
+    number, hash = os.path.basename(exp.test_dir).split('.')
+    assert hash == exp.test_hash == exp.commit_hash[:8]
+    with open(os.path.join(exp.exp_dir, '.testcount')) as r:
+        assert r.read() == str(int(number))
+
+    # created by another process meanwhile
+    os.mkdir(os.path.join(exp.exp_dir, "{:04d}.{}".format(int(number) + 1, hash)))
+    exp2 = Experiment('test_experiment')
+    assert os.path.basename(exp2.test_dir) == "{:04d}.{}".format(int(number) + 2, hash)
+    exp.end()
+    exp2.end()
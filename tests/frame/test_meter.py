@@ -43,3 +43,46 @@ def test_avgmeter():
     assert avg.avg.a == 2
     assert avg.meter.b == 2
     assert avg.avg.b == 2
+
+
+def test_avgmeter_lazy():
+    from thexp.frame.meter import _DeviceAvgItem
+    lazy, eager = AvgMeter(), AvgMeter()
+    values = torch.rand(10)
+    for v in values:
+        lazy.loss = v * 3
+        eager.loss = (v * 3).numpy()
+
+    assert isinstance(lazy['loss'], _DeviceAvgItem)
+    assert lazy.avg.loss == eager.avg.loss
+    assert lazy.meter.loss == eager.meter.loss
+    assert type(lazy.avg.loss) == type(eager.avg.loss)
+    assert dict(lazy.numeral_items()) == dict(eager.numeral_items())
+    assert str(lazy) == str(eager)
+
+    if torch.cuda.is_available():
+        cuda = AvgMeter()
+        for v in values:
+            cuda.loss = (v * 3).cuda()
+        assert isinstance(cuda['loss']._sum, torch.Tensor)  # still on device, nothing synchronized
+        assert cuda.avg.loss == eager.avg.loss
+
+
+def test_avgitem_slots():
+    import pickle
+    from thexp.base_classes.trickitems import AvgItem
+
+    item = AvgItem()
+    item.update(1)
+    item.update(3)
+    assert not hasattr(item, '__dict__')
+    res = pickle.loads(pickle.dumps(item))
+    assert res.avg == 2 and res.item == 3
+
+    avg = AvgMeter()
+    meter = Meter()
+    meter.a = 0.5
+    for _ in range(10):
+        avg.update(meter)
+    assert len(avg._convert_type) == len(meter._convert_type)
+    assert avg.a.avg == 0.5
@@ -24,3 +24,278 @@ def test_keypoint():
     assert len(saver.find_keypoints()) == 5
     saver.clear_keypoints()
     assert len(saver.find_keypoints()) == 0
+
+
+def test_async_save(tmp_path):
+    import os
+    import torch
+
+    saver = Saver(str(tmp_path), max_to_keep=2, async_save=True)
+    weight = torch.zeros(3)
+    fns = []
+    for i in range(4):
+        weight.fill_(i)
+        fns.append(saver.save_checkpoint(i, dict(w=weight, eidx=i), dict(b=i)))
+    weight.fill_(-1)  # should not change the snapshots
+    saver.flush()
+
+    assert len(set(fns)) == 4
+    assert len(saver.find_checkpoints()) == 2
+    assert not any('.tmp' in f for f in os.listdir(str(tmp_path)))
+    ckpt, info = saver.load_state_dict(fns[-1])
+    assert (ckpt['w'] == 3).all() and ckpt['eidx'] == 3 and info['b'] == 3
+
+    fn = saver.save_model(1, dict(w=weight))
+    ckpt, info = saver.load_state_dict(fn)  # waits for the pending write
+    assert (ckpt['w'] == -1).all() and info['fn'] == fn
+
+
+def test_async_saver_released(tmp_path):
+    import gc
+    from thexp.frame import saver as saver_module
+
+    saver = Saver(str(tmp_path / 'closed'), async_save=True)
+    assert saver in saver_module._async_savers
+    saver.close()
+    assert saver not in saver_module._async_savers
+    assert saver.save_model(1, dict(w=1)) is not None  # falls back to a synchronous write
+
+    saver = Saver(str(tmp_path / 'dropped'), async_save=True)
+    del saver
+    gc.collect()
+    assert len([i for i in saver_module._async_savers if i.ckpt_dir.startswith(str(tmp_path))]) == 0
+
+
+def test_sharded(tmp_path):
+    import os
+    import torch
+
+    saver = Saver(str(tmp_path), max_to_keep=1, sharded=True)
+    state_dict = dict(model=dict(a=dict(w=torch.ones(2, 3)), b=dict(w=torch.zeros(4))),
+                      optim=dict(a=dict(state={}, lr=0.1)),
+                      eidx=3)
+    fn = saver.save_checkpoint(3, state_dict, dict(b=3))
+    assert saver.is_sharded(fn)
+
+    index = saver.read_index(fn)
+    assert index['keys'] == ['model', 'optim', 'eidx']
+    assert index['sections']['model']['tensors']['a.w'] == {'dtype': 'float32', 'shape': [2, 3], 'nbytes': 24}
+
+    ckpt, info = saver.load_state_dict(fn, sections=['model'])
+    assert list(ckpt.keys()) == ['model', 'eidx'] and info['b'] == 3
+    assert (ckpt['model']['a']['w'] == 1).all()
+    ckpt, _ = saver.load_state_dict(fn)
+    assert ckpt['optim']['a']['lr'] == 0.1
+
+    # replace the old one, directories are removed by max_to_keep
+    saver.save_checkpoint(4, state_dict)
+    assert len(saver.find_checkpoints()) == 1
+    assert len([f for f in os.listdir(str(tmp_path)) if not f.endswith('.json')]) == 1
+
+    # monolithic files are still readable
+    fn = Saver(str(tmp_path)).save_model(1, state_dict['model'])
+    assert not saver.is_sharded(fn)
+    ckpt, _ = saver.load_state_dict(fn, sections=['model'])
+    assert (ckpt['b']['w'] == 0).all()
+
+
+def test_dedup(tmp_path):
+    import os
+    import torch
+    from thexp.frame.blobstore import BlobStore
+
+    blob_dir = str(tmp_path / 'blobs')
+    backbone = torch.rand(256, 256)  # 256KB, shared by all checkpoints
+
+    def blob_files():
+        return [f for d in os.listdir(blob_dir) if len(d) == 2 for f in os.listdir(os.path.join(blob_dir, d))]
+
+    saver = Saver(str(tmp_path / 'a'), max_to_keep=2, blob_dir=blob_dir)
+    other = Saver(str(tmp_path / 'b'), sharded=True, blob_dir=blob_dir)  # another test of the same experiment
+    fns = []
+    for i in range(3):
+        fns.append(saver.save_checkpoint(i, dict(model=dict(backbone=backbone, head=torch.rand(256, 256)),
+                                                 bias=torch.zeros(3), eidx=i)))
+    other_fn = other.save_checkpoint(0, dict(model=dict(backbone=backbone)))
+
+    # one backbone, two heads (the first checkpoint was pruned by max_to_keep)
+    assert len(blob_files()) == 3
+    store = BlobStore(blob_dir)
+    assert store.refcount(store.hash_tensor(backbone)) == 3
+
+    ckpt, _ = saver.load_state_dict(fns[-1])
+    assert torch.equal(ckpt['model']['backbone'], backbone) and torch.equal(ckpt['bias'], torch.zeros(3))
+    assert ckpt['eidx'] == 2
+
+    saver.clear_checkpoints()
+    assert len(blob_files()) == 1
+    ckpt, _ = other.load_state_dict(other_fn)
+    assert torch.equal(ckpt['model']['backbone'], backbone)
+    other.clear_checkpoints()
+    assert len(blob_files()) == 0
+
+    # in-place writes through .data (like EMA) don't bump tensor._version
+    weight = torch.zeros(256, 256)
+    saver.save_checkpoint(0, dict(weight=weight))
+    weight.data.add_(1)
+    fn = saver.save_checkpoint(1, dict(weight=weight))
+    assert saver.load_state_dict(fn).checkpoint['weight'].sum() == 65536
+
+
+def test_moved_blobs(tmp_path):
+    import os
+    import torch
+
+    def saved(exp_dir):
+        return [f for _, _, fs in os.walk(exp_dir) for f in fs if f.endswith('.pt')]
+
+    weight = torch.rand(256, 256)
+    for i, delta in enumerate([False, True]):
+        exp_dir = str(tmp_path / str(i))
+        saver = Saver(os.path.join(exp_dir, 'test', 'modules'), blob_dir=os.path.join(exp_dir, 'blobs'), delta=delta)
+        saver.save_checkpoint(0, dict(weight=weight))
+        saver.save_checkpoint(1, dict(weight=weight))
+        assert len(saved(exp_dir)) > 0
+
+        # the whole experiment is moved (or copied to another machine)
+        moved = exp_dir + '.moved'
+        os.rename(exp_dir, moved)
+        saver = Saver(os.path.join(moved, 'test', 'modules'), blob_dir=os.path.join(moved, 'blobs'), delta=delta)
+        fns = saver.find_checkpoints()
+        assert torch.equal(saver.load_state_dict(fns[-1]).checkpoint['weight'], weight)
+        saver.clear_checkpoints()
+        assert len(saved(moved)) == 0
+
+
+def test_delta(tmp_path, monkeypatch):
+    import os
+    import threading
+    import torch
+    from thexp.frame.blobstore import BlobStore
+
+    frozen = torch.rand(256, 256)
+    weight = torch.zeros(256, 256)
+
+    def packs(saver):
+        root = saver.deltas.root
+        return [f for d in os.listdir(root) if len(d) == 2 for f in os.listdir(os.path.join(root, d))]
+
+    saver = Saver(str(tmp_path), max_to_keep=3, delta=True, compact_every=3)
+    fns = []
+    for i in range(5):
+        weight.fill_(i)  # in-place, like an optimizer step
+        fns.append(saver.save_checkpoint(i, dict(model=dict(frozen=frozen, weight=weight), eidx=i)))
+
+        ckpt, _ = saver.load_state_dict(fns[-1])
+        assert torch.equal(ckpt['model']['frozen'], frozen)
+        assert (ckpt['model']['weight'] == i).all() and ckpt['eidx'] == i
+
+    # frozen is only written by the base checkpoints (0 and 3)
+    refs = [saver._load_manifest(fn)['model']['frozen'] for fn in fns[2:]]
+    assert refs[0].hash != refs[1].hash and refs[1].hash == refs[2].hash
+
+    # 2 refers the base 0 and its own delta, 3 is a new base, 4 only writes the delta
+    assert len(saver.find_checkpoints()) == 3
+    assert len(packs(saver)) == 4
+    ckpt, _ = saver.load_state_dict(fns[2])
+    assert (ckpt['model']['weight'] == 2).all()
+
+    # the packs the next delta would refer were removed with the checkpoints, a new base is saved
+    saver.clear_checkpoints()
+    assert len(packs(saver)) == 0
+    fn = saver.save_checkpoint(5, dict(model=dict(frozen=frozen, weight=weight)))
+    assert torch.equal(saver.load_state_dict(fn).checkpoint['model']['frozen'], frozen)
+
+    # in-place writes through .data (like EMA) don't bump tensor._version
+    weight.zero_()
+    saver.save_checkpoint(6, dict(weight=weight))
+    weight.data.add_(1)
+    fn = saver.save_checkpoint(7, dict(weight=weight))
+    assert saver.load_state_dict(fn).checkpoint['weight'].sum() == 65536
+
+    saver = Saver(str(tmp_path / 'async'), delta=True, async_save=True)
+    fns = [saver.save_checkpoint(i, dict(frozen=frozen, weight=weight.fill_(i))) for i in range(3)]
+    weight.fill_(-1)
+    for i, fn in enumerate(fns):
+        ckpt, _ = saver.load_state_dict(fn)
+        assert torch.equal(ckpt['frozen'], frozen) and (ckpt['weight'] == i).all()
+
+    # with async_save, the tensors are hashed in the background thread
+    threads = set()
+    hash_tensor = BlobStore.hash_tensor
+
+    def record_thread(tensor):
+        threads.add(threading.current_thread().name)
+        return hash_tensor(tensor)
+
+    monkeypatch.setattr(BlobStore, 'hash_tensor', staticmethod(record_thread))
+    saver.save_checkpoint(3, dict(frozen=frozen, weight=weight))
+    saver.flush()
+    assert len(threads) == 1 and threads.pop().startswith('thexp-saver')
+
+
+def test_remove_without_store(tmp_path):
+    saver = Saver(str(tmp_path), max_to_keep=1)
+
+    def find_refs(fn):
+        raise AssertionError('{} is loaded to be removed'.format(fn))
+
+    saver._find_refs = find_refs
+    for i in range(3):
+        saver.save_checkpoint(i, dict(eidx=i))
+    assert len(saver.find_checkpoints()) == 1
+
+
+def test_retention(tmp_path):
+    import os
+
+    saver = Saver(str(tmp_path), max_to_keep=2)
+    saver.retention.keep_best = 2
+    saver.retention.keep_every = 5
+    metrics = [5, 1, 4, 8, 9, 2, 7, 6, 3, 9]
+    for eidx, metric in enumerate(metrics, start=1):
+        saver.save_checkpoint(eidx, dict(eidx=eidx), metric=metric)
+        saver.load_state_dict(saver.find_checkpoints()[-1])  # reading doesn't change the order
+
+    def epochs(saver):
+        return [saver.load_state_dict(fn).checkpoint['eidx'] for fn in saver.find_checkpoints()]
+
+    # last 2: 9, 8 (10 is pinned) / best 2: 6, 2 / every 5: 10, 5
+    assert epochs(saver) == [10, 9, 8, 6, 5, 2]
+    assert len([f for f in os.listdir(str(tmp_path)) if f.endswith('.ckpt')]) == 6
+    assert saver.retention.is_best(saver.manifest.entries, 1.5)
+    assert not saver.retention.is_best(saver.manifest.entries, 2.5)
+
+    # the manifest is reloaded, and removing by hand is recorded
+    saver = Saver(str(tmp_path), max_to_keep=2)
+    assert epochs(saver) == [10, 9, 8, 6, 5, 2]
+    saver.check_remove(saver.find_checkpoints()[0])
+    assert epochs(Saver(str(tmp_path))) == [9, 8, 6, 5, 2]
+
+
+def test_average_checkpoints(tmp_path):
+    import torch
+
+    saver = Saver(str(tmp_path / 'a'), max_to_keep=3, sharded=True, delta=True)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.BatchNorm1d(4)).half()
+    for i in range(4):
+        for p in model.parameters():
+            p.data.fill_(i)
+        model[1].num_batches_tracked.fill_(i)
+        saver.save_checkpoint(i, dict(model=dict(net=model.state_dict()), eidx=i))
+
+    fn = saver.average_checkpoints()  # 1, 2, 3
+    ckpt, info = saver.load_model(fn)
+    assert ckpt['net']['0.weight'].dtype == torch.float16
+    assert (ckpt['net']['0.weight'] == 2).all() and ckpt['net']['1.num_batches_tracked'] == 3
+    assert len(info['sources']) == 3
+
+    # models from another saver, weighted
+    other = Saver(str(tmp_path / 'b'))
+    for p in model.parameters():
+        p.data.fill_(10)
+    model_fn = other.save_model(0, dict(net=model.state_dict()))
+    fn = saver.average_checkpoints([saver.find_checkpoints()[0], model_fn], weights=[3, 1],
+                                   fn=str(tmp_path / 'soup.pth'))
+    ckpt, _ = saver.load_model(fn)
+    assert (ckpt['net']['1.bias'] == 4.75).all()
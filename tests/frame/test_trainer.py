@@ -1,9 +1,11 @@
 """
 
 """
+import warnings
+
 import torch
 from torch import nn
-from thexp import Params, Trainer
+from thexp import Params, Trainer, Meter
 
 
 class MyModel(nn.Module):
@@ -41,3 +43,352 @@ def test_trainer():
     assert trainer.params.eidx == trainer.params.epoch
     trainer.load_checkpoint(fn)
     assert trainer.params.eidx == 3
+
+
+def test_callback_dispatch():
+    from thexp import callbacks
+
+    class EpochOnly(callbacks.TrainCallback):
+        def __init__(self):
+            self.count = 0
+
+        def on_train_epoch_end(self, trainer, func, params, meter, *args, **kwargs):
+            self.count += 1
+
+    class BatchOnly(callbacks.TrainCallback):
+        def __init__(self):
+            self.count = 0
+
+        def on_train_batch_begin(self, trainer, func, params, *args, **kwargs):
+            self.count += 1
+
+    trainer = MyTrainer(Params())
+    epoch_cb, batch_cb = EpochOnly(), BatchOnly()
+    epoch_cb.hook(trainer)
+    batch_cb.hook(trainer)
+
+    begins, ends = trainer._callback_dispatch['train_batch']
+    assert len(begins) == 1 and len(ends) == 0
+    begins, ends = trainer._callback_dispatch['train_epoch']
+    assert len(begins) == 0 and len(ends) == 1
+
+    from torch.utils.data import DataLoader, TensorDataset
+    trainer.regist_databundler(train=DataLoader(TensorDataset(torch.rand(4, 28 * 28)), batch_size=2))
+    trainer.train_epoch(0, trainer.params)
+    assert batch_cb.count == 2 and epoch_cb.count == 1
+
+    batch_cb.unhook()
+    begins, ends = trainer._callback_dispatch['train_batch']
+    assert len(begins) == 0 and len(ends) == 0
+
+
+def test_profile_callback():
+    import json
+    from thexp import callbacks
+
+    class BatchOnly(callbacks.TrainCallback):
+        def on_train_batch_end(self, trainer, func, params, meter, *args, **kwargs):
+            pass
+
+    params = Params()
+    params.eidx, params.epoch = 1, 2
+    trainer = MyTrainer(params)
+    from torch.utils.data import DataLoader, TensorDataset
+    trainer.regist_databundler(train=DataLoader(TensorDataset(torch.rand(6, 28 * 28)), batch_size=2))
+
+    BatchOnly().hook(trainer)
+    profiler = callbacks.ProfileCallback()
+    profiler.hook(trainer)
+    trainer.train()
+
+    with open(profiler.fn, encoding='utf-8') as r:
+        records = [json.loads(line) for line in r]
+    assert [record['eidx'] for record in records] == [1, 2]
+    stats = records[0]['stats']
+    assert stats['train_batch']['count'] == 3 and stats['data_wait']['count'] == 3
+    assert stats['step']['count'] == 2
+    assert stats['BatchOnly.on_train_batch_end']['count'] == 3
+    assert {'mean', 'p50', 'p90', 'p99', 'max'} <= set(stats['train_batch'].keys())
+
+    profiler.unhook()
+    begins, ends = trainer._callback_dispatch['train_batch']
+    assert len(begins) == 0 and len(ends) == 1 and not hasattr(ends[0], '_profiled')
+
+
+class AccumTrainer(Trainer):
+
+    def models(self, params: Params):
+        torch.manual_seed(0)
+        self.model = nn.Linear(4, 1)
+        self.optim = torch.optim.SGD(self.model.parameters(), lr=0.1)
+
+    def train_batch(self, eidx, idx, global_step, batch_data, params: Params, device: torch.device):
+        xs, ys = batch_data
+        self.optim.zero_grad()
+        loss = ((self.model(xs) - ys) ** 2).mean()
+        loss.backward()
+        self.optim.step()
+        meter = Meter()
+        meter.loss = loss
+        meter.idx = idx
+        return meter
+
+
+def test_accum_steps():
+    import functools
+    from thexp import callbacks
+    from torch.utils.data import DataLoader, TensorDataset
+
+    class BatchCount(callbacks.TrainCallback):
+        def __init__(self):
+            self.count = 0
+
+        def on_train_batch_end(self, trainer, func, params, meter, *args, **kwargs):
+            self.count += 1
+
+    xs, ys = torch.rand(12, 4), torch.rand(12, 1)
+
+    def run(batch_size, accum_steps):
+        params = Params()
+        params.accum_steps = accum_steps
+        trainer = AccumTrainer(params)
+        trainer.regist_databundler(train=DataLoader(TensorDataset(xs, ys), batch_size=batch_size))
+        cb = BatchCount()
+        cb.hook(trainer)
+        avg = trainer.train_epoch(1, params)
+        return trainer, cb, avg
+
+    full, full_cb, full_avg = run(4, 1)
+    accum, accum_cb, accum_avg = run(2, 2)
+
+    assert torch.allclose(full.model.weight, accum.model.weight)
+    assert torch.allclose(full.model.bias, accum.model.bias)
+    assert full_cb.count == accum_cb.count == 3
+    assert full.params.global_step == accum.params.global_step == 3
+    assert 'step' not in accum.optim.__dict__ and 'zero_grad' not in accum.optim.__dict__
+    assert accum.model.weight.grad is None or (accum.model.weight.grad == 0).all()
+    assert accum_avg.idx == 5  # the last micro-batch index is kept for not averaged values
+
+    # train_step() counts optimizer steps and accumulates in the same way
+    def run_steps(batch_size, accum_steps, steps):
+        params = Params()
+        params.accum_steps = accum_steps
+        trainer = AccumTrainer(params)
+        trainer.regist_databundler(train=DataLoader(TensorDataset(xs, ys), batch_size=batch_size))
+        trainer.train_step(steps)
+        return trainer
+
+    for steps in [1, 2]:
+        full, accum = run_steps(4, 1, steps), run_steps(2, 2, steps)
+        assert torch.allclose(full.model.weight, accum.model.weight)
+        assert 'step' not in accum.optim.__dict__
+
+    # decorators of the user on train_batch still run for each micro-batch
+    class DecoratedTrainer(AccumTrainer):
+        calls = 0
+
+        def counted(func):
+            @functools.wraps(func)
+            def inner(self, *args, **kwargs):
+                DecoratedTrainer.calls += 1
+                return func(self, *args, **kwargs)
+
+            return inner
+
+        train_batch = counted(AccumTrainer.train_batch)
+
+    params = Params()
+    params.accum_steps = 2
+    trainer = DecoratedTrainer(params)
+    trainer.regist_databundler(train=DataLoader(TensorDataset(xs, ys), batch_size=2))
+    trainer.train_epoch(1, params)
+    assert DecoratedTrainer.calls == 6
+
+    # the tail window which has less micro-batches
+    params = Params()
+    params.accum_steps = 5
+    trainer = AccumTrainer(params)
+    trainer.regist_databundler(train=DataLoader(TensorDataset(xs, ys), batch_size=2))
+    trainer.train_epoch(1, params)
+    assert trainer.params.global_step == 2
+
+
+class PrecisionTrainer(AccumTrainer):
+
+    def train_batch(self, eidx, idx, global_step, batch_data, params: Params, device: torch.device):
+        xs, ys = batch_data
+        self.optim.zero_grad()
+        out = self.model(xs)
+        self.out_dtype = out.dtype
+        loss = ((out.float() - ys) ** 2).mean()
+        self.backward(loss)
+        self.optim.step()
+        meter = Meter()
+        meter.loss = loss
+        return meter
+
+    def test_eval_logic(self, dataloader, param: Params):
+        self.eval_dtype = self.model(torch.rand(2, 4)).dtype
+        return Meter()
+
+
+def test_precision():
+    from torch.utils.data import DataLoader, TensorDataset
+    xs, ys = torch.rand(8, 4), torch.rand(8, 1)
+
+    def build(precision, cls=PrecisionTrainer):
+        params = Params()
+        params.device = 'cpu'
+        params.precision = precision
+        trainer = cls(params)
+        trainer.regist_databundler(train=DataLoader(TensorDataset(xs, ys), batch_size=4),
+                                   eval=DataLoader(TensorDataset(xs, ys), batch_size=4))
+        return trainer
+
+    trainer = build('bf16')
+    trainer.train_epoch(1, trainer.params)
+    trainer.eval()
+    assert trainer.out_dtype == torch.bfloat16 and trainer.eval_dtype == torch.bfloat16
+    assert trainer.grad_scaler is None and 'scaler' not in trainer.checkpoint_dict()
+
+    trainer = build('fp32')
+    trainer.train_epoch(1, trainer.params)
+    assert trainer.out_dtype == torch.float32
+
+    trainer = build('fp16')
+    weight = trainer.model.weight.detach().clone()
+    trainer.train_epoch(1, trainer.params)
+    assert trainer.out_dtype == torch.float16
+    assert not torch.equal(weight, trainer.model.weight)
+    assert 'step' not in trainer.optim.__dict__
+
+    trainer.grad_scaler.update(1024.)
+    state = trainer.checkpoint_dict()
+    assert state['scaler']['scale'] == 1024.
+
+    other = build('fp16')
+    other.load_checkpoint_dict(state)
+    assert other.grad_scaler.get_scale() == 1024.
+
+    # loss.backward() instead of self.backward(): gradients are not scaled, step() must not be unscaled
+    class PlainTrainer(PrecisionTrainer):
+        def backward(self, loss, **kwargs):
+            loss.backward(**kwargs)
+
+    updates = {}
+    for precision in ['fp32', 'fp16']:
+        trainer = build(precision, PlainTrainer)
+        weight = trainer.model.weight.detach().clone()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            trainer.train_epoch(1, trainer.params)
+        updates[precision] = trainer.model.weight.detach() - weight
+        assert (len(caught) > 0) == (precision == 'fp16')
+    assert torch.allclose(updates['fp32'], updates['fp16'], atol=1e-2)
+    assert trainer.grad_scaler.get_scale() == 65536.
+
+
+def test_load_model_from_checkpoint():
+    params = Params()
+    params.sharded_ckpt = True
+    trainer = AccumTrainer(params)
+    fn = trainer.save_checkpoint()
+    weight = trainer.model.weight.detach().clone()
+    with torch.no_grad():
+        trainer.model.weight.zero_()
+    trainer.load_model(fn)
+    assert torch.equal(trainer.model.weight, weight)
+
+
+def test_resume_mid_epoch():
+    import copy
+    from types import SimpleNamespace
+    from thexp import callbacks
+    from thexp.frame.builder import DatasetBuilder
+
+    loaded = []
+
+    def augment(x):
+        loaded.append(x)
+        return x + torch.rand(4) * 0.1  # random augmentation, reproduced by the restored rng state
+
+    xs, ys = torch.rand(12, 4), torch.rand(12, 1)
+
+    class Record(callbacks.TrainCallback):
+        def __init__(self, save_at=None):
+            self.count = 0
+            self.state = None
+            self.save_at = save_at
+
+        def on_train_batch_end(self, trainer, func, params, meter, *args, **kwargs):
+            self.count += 1
+            if self.save_at == self.count:
+                self.state = copy.deepcopy(trainer.checkpoint_dict())
+
+    def build(record):
+        params = Params()
+        trainer = AccumTrainer(params)
+        builder = DatasetBuilder(xs, ys).add_x(transform=augment).add_y()
+        trainer.regist_databundler(train=builder.DataLoader(batch_size=2, shuffle=True, resumable=True))
+        record.hook(trainer)
+        return trainer
+
+    torch.manual_seed(1)
+    record = Record(save_at=8)  # the 2nd batch of the 2nd epoch
+    trainer = build(record)
+    trainer.params.eidx = 1
+    for _ in range(2):
+        trainer.train_epoch(trainer.params.eidx, trainer.params)
+        end_state = trainer.checkpoint_dict()  # like being saved in on_train_epoch_end
+        trainer.params.eidx += 1
+    order = [float(y) for y in trainer.train_dataloader.choice_batch()[1]]  # consumes the 3rd epoch
+
+    torch.manual_seed(2)
+    other = build(Record())
+    other.load_checkpoint_dict(record.state)
+    loaded.clear()
+    other.train_epoch(other.params.eidx, other.params)
+
+    assert other.params.eidx == 2 and len(loaded) == 8  # the first 2 batches are not loaded
+    assert torch.equal(other.model.weight, trainer.model.weight)
+    assert other.params.global_step == trainer.params.global_step
+    assert [float(y) for y in other.train_dataloader.choice_batch()[1]] == order
+
+    # saved at the end of an epoch, resumes from the next one
+    other.load_checkpoint_dict(end_state)
+    assert other.params.eidx == 3 and other._resume_batches == 0
+
+    # a batch interrupted in train_batch() is not counted
+    class Interrupt(callbacks.TrainCallback):
+        def on_train_batch_begin(self, trainer, func, params, *args, **kwargs):
+            if params.global_step == 2:
+                raise KeyboardInterrupt()
+
+    interrupted = build(Interrupt())
+    try:
+        interrupted.train_epoch(1, interrupted.params)
+    except KeyboardInterrupt:
+        pass
+    state = interrupted.checkpoint_dict()
+    assert state['global_step'] == 2 and state['epoch_batches'] == 2
+    assert interrupted.params.global_step == 2 and not interrupted._unfinished
+
+    # the inline progress of LoggerCallback continues from the interrupted step
+    class InlineLogger:
+        def __init__(self):
+            self.lines = []
+
+        def info(self, *args, **kwargs):
+            pass
+
+        def inline(self, *args, **kwargs):
+            self.lines.append(args[0])
+
+    logger = callbacks.LoggerCallback(avg=False, inline_per_step=1)
+    other.load_checkpoint_dict(record.state)
+    view = SimpleNamespace(logger=InlineLogger(), params=other.params,
+                           train_dataloader=other.train_dataloader, _resume_batches=other._resume_batches)
+    logger.on_train_epoch_begin(view, None, other.params)
+    other.params.global_step += 1  # increased by train_epoch() before the batch callbacks
+    logger.on_train_batch_end(view, None, other.params, Meter())
+    assert view.logger.lines == ['3/6']
@@ -0,0 +1,67 @@
+"""
+`import thexp` should stay fast, heavy dependencies are imported only when the names which need them are accessed
+"""
+import os
+import subprocess
+import sys
+
+import thexp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ['torch', 'pandas', 'tensorboard', 'pyecharts']
+
+
+def _run_importtime(stmt: str) -> list:
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', stmt], cwd=ROOT,
+                         stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    entries = []
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if cumulative.strip().isdigit():
+            entries.append((name.strip(), int(cumulative), name[1:] == name.strip()))
+    return entries
+
+
+def import_time(stmt: str):
+    """
+    run stmt in a new interpreter with `python -X importtime`
+
+    Returns:
+        (modules, us), the modules imported by stmt and their cumulative time.
+        Modules imported by importlib.import_module (as thexp.__getattr__ does) are not reported themselves,
+        but their imports are reported at the top level, so all top level entries except those of the
+        interpreter startup are summed.
+    """
+    startup = {name for name, _, _ in _run_importtime('pass')}
+    modules, us = [], 0
+    for name, cumulative, top in _run_importtime(stmt):
+        if name in startup:
+            continue
+        modules.append(name)
+        if top:
+            us += cumulative
+    return modules, us
+
+
+def test_import_params():
+    modules, us = import_time('from thexp import Params')
+    assert 'thexp.base_classes.params_vars' in modules
+    assert not [m for m in modules if m.split('.')[0] in HEAVY]
+    # ~0.1s, vs ~3s when torch was imported, the bound is loose for slow machines
+    assert us < 1000 * 1000
+
+
+def test_create_params():
+    stmt = ("import sys; from thexp import Params; p = Params(); p.lr = 0.1; p.lr; p.get('accum_steps', 1); "
+            "assert 'torch' not in sys.modules; assert p.device in ('cpu', 'cuda:0')")
+    subprocess.run([sys.executable, '-c', stmt], cwd=ROOT, check=True)
+
+
+def test_lazy_names():
+    for name in thexp.__all__:
+        assert getattr(thexp, name) is not None
+    from thexp.frame import Trainer, Saver
+    from thexp.analyse import TestViewer
+    assert thexp.Trainer is Trainer and 'Saver' in dir(thexp)
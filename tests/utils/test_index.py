@@ -0,0 +1,150 @@
+"""
+
+"""
+import json
+import os
+from datetime import datetime
+
+from thexp import C
+from thexp.analyse import querys
+from thexp.utils import index as tindex
+from thexp.utils import paths
+
+
+def make_test(root, name, end_code=None, tags=(), plugins=(), params=None, start_time="2020-01-01 00:00:00"):
+    test_dir = os.path.join(root, name)
+    os.makedirs(test_dir)
+    info = dict(test_name=name, start_time=start_time, time_fmt="%Y-%m-%d %H:%M:%S",
+                tags={tag: [] for tag in tags}, plugins={plugin: {} for plugin in plugins})
+    if end_code is not None:
+        info['end_code'] = end_code
+    with open(os.path.join(test_dir, 'info.v1.json'), 'w') as w:
+        json.dump(info, w)
+    if params is not None:
+        with open(os.path.join(test_dir, 'params.v1.json'), 'w') as w:
+            json.dump(params, w)
+    return test_dir
+
+
+def test_sync(tmp_path):
+    root = str(tmp_path)
+    a = make_test(root, '0001.a', end_code=0, tags=['x'], params={'lr': 0.1})
+    b = make_test(root, '0002.b', plugins=['writer'])
+
+    with tindex.TestIndex(os.path.join(root, 'index.sqlite')) as index:
+        index.sync([a, b])
+        assert index.select([a, b], 't.end_code = 0') == {a}
+        assert index.params([a, b]) == {a: {'lr': 0.1}, b: None}
+
+        # modified after indexed
+        with open(os.path.join(b, 'info.v1.json')) as r:
+            info = json.load(r)
+        info['end_code'] = 0
+        with open(os.path.join(b, 'info.v1.json'), 'w') as w:
+            json.dump(info, w)
+        os.utime(os.path.join(b, 'info.v1.json'), ns=(0, 1))
+        index.sync([a, b])
+        assert index.select([a, b], 't.end_code = 0') == {a, b}
+        assert index.select([b], 't.end_code = 0') == {b}
+
+        # deleted tests of the same experiment are pruned
+        os.remove(os.path.join(b, 'info.v1.json'))
+        index.sync([a])
+        assert index.conn.execute('SELECT test_dir FROM tests').fetchall() == [(a,)]
+
+
+def test_tests_query(tmp_path, monkeypatch):
+    monkeypatch.setattr(paths, 'home_dir', lambda: str(tmp_path))  # don't touch ~/.thexp/index.v1.sqlite
+    root = str(tmp_path)
+    dirs = [
+        make_test(root, '0001.a', end_code=0, tags=['x'], plugins=['params'],
+                  params={'lr': 0.1, 'optim': {'name': 'SGD'}}),
+        make_test(root, '0002.b', end_code=1, plugins=['writer', 'params'], params={'lr': 0.01},
+                  start_time="2020-02-01 00:00:00"),
+        make_test(root, '0003.c'),
+    ]
+    query = querys.TestsQuery(dirs)
+    assert query.success().test_names == ['0001.a']
+    assert query.failed().test_names == ['0002.b', '0003.c']
+    assert query.has_tag('x').test_names == ['0001.a']
+    assert query.has_tag('x', toggle=False).test_names == ['0002.b', '0003.c']
+    assert query.has_board().test_names == ['0002.b']
+    assert query.time_range(datetime(2020, 1, 15)).test_names == ['0002.b']
+    assert query.time_range(datetime(2019, 1, 1), datetime(2020, 1, 15)).test_names == ['0001.a', '0003.c']
+    assert query.filter_params(C.param.lr > 0.05).test_names == ['0001.a']
+    assert query.filter_params(C.param['optim.name'] == 'SGD').test_names == ['0001.a']
+
+
+def test_filter_params(tmp_path, monkeypatch):
+    monkeypatch.setattr(paths, 'home_dir', lambda: str(tmp_path))
+    root = str(tmp_path)
+    dirs = [
+        make_test(root, '0001.a', plugins=['params'], params={'lr': 0.1, 'ema': True, 'milestones': [1, 2],
+                                                              'optim': {'_class_name': 'attr', 'name': 'SGD'}}),
+        make_test(root, '0002.b', plugins=['params'], params={'lr': 0.01, 'ema': False, 'margin': 5}),
+        make_test(root, '0003.c'),
+    ]
+    with tindex.TestIndex(os.path.join(root, 'index.sqlite')) as index:
+        index.sync(dirs)
+        values = index.param_values(dirs)
+    assert values['optim.name'] == {dirs[0]: 'SGD'}
+    assert values['ema'] == {dirs[0]: True, dirs[1]: False}
+    assert values['milestones'] == {dirs[0]: [1, 2]}
+
+    query = querys.TestsQuery(dirs)
+    df = query.params_df()
+    assert list(df.columns) == ['0001.a', '0002.b', '0003.c']
+    assert df.loc['lr', '0002.b'] == 0.01
+
+    assert query.filter_params(C.param.lr < 0.05).test_names == ['0002.b']
+    assert query.filter_params(C.param.ema == True).test_names == ['0001.a']
+    assert query.filter_params(C.param.margin > 1).test_names == ['0002.b']
+    assert query.filter_params(C.param.allow_none.margin > 1).test_names == ['0001.a', '0002.b']
+    assert query.filter_params(C.param.milestones == [1, 2]).test_names == ['0001.a']
+    assert query.filter_params(C.param.lr > 0, C.param['optim.name'] != 'SGD').test_names == []
+    assert query.filter_params(C.param.allow_none['optim.name'] != 'SGD').test_names == ['0002.b']
+
+
+def test_filter_params_like_params_get(tmp_path, monkeypatch):
+    monkeypatch.setattr(paths, 'home_dir', lambda: str(tmp_path))
+    root = str(tmp_path)
+    dirs = [
+        make_test(root, '0001.a', plugins=['params'],
+                  params={'optim': {'_class_name': 'attr', 'name': 'SGD', 'lr': 0.1},
+                          'sche': None, 'extra': {'_class_name': 'attr'}}),
+        make_test(root, '0002.b', plugins=['params'], params={'optim': {'name': 'Adam', 'lr': 0.1}, 'sche': 'cos'}),
+        make_test(root, '0003.c', plugins=['params'], params={}),
+        make_test(root, '0004.d', params={'sche': None}),  # params.json is not read without the params plugin
+    ]
+    query = querys.TestsQuery(dirs)
+
+    # the same as filtering with params.get(name, NoneItem()) on each test
+    def expected(*constrains):
+        from thexp.base_classes.trickitems import NoneItem
+        res = []
+        for vw in query.to_viewers():
+            params = vw.params
+            if params is None:
+                continue
+            lefts = [params.get(constrain._name, NoneItem()) for constrain in constrains]
+            if all((constrain._allow_none or not isinstance(left, NoneItem)) and constrain._constrain(left, constrain._value)
+                   for left, constrain in zip(lefts, constrains)):
+                res.append(vw.name)
+        return res
+
+    cases = [
+        (C.param.optim == {'name': 'SGD', 'lr': 0.1},),
+        (C.param.optim != {'name': 'SGD', 'lr': 0.1},),
+        (C.param.allow_none.optim != {'name': 'SGD', 'lr': 0.1},),
+        (C.param.sche == None,),
+        (C.param.sche != None,),
+        (C.param.allow_none.sche == None,),
+        (C.param.extra == {},),
+        (C.param.allow_none.extra != {},),
+    ]
+    for constrains in cases:
+        assert query.filter_params(*constrains).test_names == expected(*constrains), constrains
+
+    assert query.filter_params(C.param.optim == {'name': 'SGD', 'lr': 0.1}).test_names == ['0001.a']
+    assert query.filter_params(C.param.sche == None).test_names == ['0001.a']
+    assert query.filter_params(C.param.extra == {}).test_names == ['0001.a']
@@ -0,0 +1,26 @@
+"""
+
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from thexp.utils.paths import locked_json, load_json
+
+
+def test_locked_json(tmp_path):
+    fn = os.path.join(str(tmp_path), 'repo.v1.json')
+    assert load_json(fn, {}) == {}
+
+    def add(i):
+        with locked_json(fn) as res:
+            res[str(i)] = i
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(add, range(64)))
+
+    assert load_json(fn) == {str(i): i for i in range(64)}
+    assert not [f for f in os.listdir(str(tmp_path)) if '.tmp' in f]
+
+    with open(fn, 'w') as w:
+        w.write('{"a": ')  # truncated by a crashed writer
+    assert load_json(fn, {}) == {}
@@ -0,0 +1,37 @@
+"""
+
+"""
+import os
+import subprocess
+
+from git import Repo
+
+from thexp.utils.repository import snapshot
+
+
+def test_snapshot(tmp_path):
+    root = str(tmp_path)
+    subprocess.check_call(['git', 'init', '-q', root])
+    with open(os.path.join(root, 'a.py'), 'w') as w:
+        w.write('a')
+    subprocess.check_call(['git', '-C', root, 'add', 'a.py'])
+    subprocess.check_call(['git', '-C', root, '-c', 'user.name=t', '-c', 'user.email=t@t', 'commit', '-qm', 'init'])
+    with open(os.path.join(root, 'b.py'), 'w') as w:
+        w.write('b')
+
+    repo = Repo(root)
+    head, status = repo.head.commit, repo.git.status('--porcelain')
+    commit = snapshot(repo, 'experiment')
+    assert {b.path for b in commit.tree.traverse()} == {'a.py', 'b.py'}
+    assert commit.parents == (head,)
+    assert repo.heads['experiment'].commit == commit
+    # user's HEAD and index are untouched
+    assert repo.head.commit == head and repo.git.status('--porcelain') == status
+
+    assert snapshot(repo, 'experiment') == commit  # unchanged, reused
+
+    with open(os.path.join(root, 'a.py'), 'w') as w:
+        w.write('aa')
+    new_commit = snapshot(repo, 'experiment')
+    assert new_commit.parents == (commit,)
+    assert new_commit.tree['a.py'].data_stream.read() == b'aa'
@@ -1,25 +1,69 @@
 """
 
 """
+import sys
+from typing import TYPE_CHECKING
 
 __VERSION__ = "1.5.0.9"
 
-from .frame import (
-    Logger,
-    Meter,
-    AvgMeter,
-    Params, BaseParams,
-    Saver,
-    RndManager,
-    Delegate,
-    DatasetBuilder,
-    DataBundler,
-    Trainer,
-    callbacks,
-    Experiment,
-    globs)
-
-from .analyse import Q, C
-from .utils.environ import ENVIRON_ as ENV
-
-import thexp.calculate  # initialize schedule attr classes
+# name -> module, imported when first accessed (see __getattr__), so that `import thexp` doesn't import torch / pandas
+_LAZY_ATTRS = {
+    'Logger': '.frame.logger',
+    'Meter': '.frame.meter',
+    'AvgMeter': '.frame.meter',
+    'Params': '.frame.params',
+    'BaseParams': '.frame.params',
+    'Saver': '.frame.saver',
+    'RndManager': '.frame.rndmanager',
+    'Delegate': '.frame.builder',
+    'DatasetBuilder': '.frame.builder',
+    'DataBundler': '.frame.databundler',
+    'Trainer': '.frame.trainer',
+    'Experiment': '.frame.experiment',
+    'globs': '.frame.configs',
+    'Q': '.analyse.querys',
+    'C': '.analyse.constrain',
+}
+_LAZY_MODULES = {
+    'callbacks': '.frame.callbacks',
+    'calculate': '.calculate',
+}
+
+__all__ = list(_LAZY_ATTRS) + list(_LAZY_MODULES) + ['ENV']
+
+if TYPE_CHECKING:
+    from .frame import (
+        Logger,
+        Meter,
+        AvgMeter,
+        Params, BaseParams,
+        Saver,
+        RndManager,
+        Delegate,
+        DatasetBuilder,
+        DataBundler,
+        Trainer,
+        callbacks,
+        Experiment,
+        globs)
+    from .analyse import Q, C
+    from .utils.environ import ENVIRON_ as ENV
+
+
+def __getattr__(name):
+    import importlib
+    if name in _LAZY_ATTRS:
+        value = getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+    elif name in _LAZY_MODULES:
+        value = importlib.import_module(_LAZY_MODULES[name], __name__)
+    elif name == 'ENV':
+        from .utils.environ import ENVIRON_ as value
+    else:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    # not globals(), which is shadowed by the submodule thexp.globals once it's imported
+    setattr(sys.modules[__name__], name, value)
+    return value
+
+
+def __dir__():
+    return sorted(set(vars(sys.modules[__name__])) | set(__all__))
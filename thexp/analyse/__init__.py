@@ -1,9 +1,39 @@
 """
 
 """
+import sys
+from typing import TYPE_CHECKING
 
-from .charts import Curve, Parallel
-from .querys import Query, BoardQuery, TestsQuery, ExpsQuery, ReposQuery, Q
-from .viewer import TestViewer, ProjViewer, ExpViewer
+# name -> module, imported when first accessed (pyecharts, pandas, tensorboard are slow to import), see thexp.__getattr__
+_LAZY_ATTRS = {
+    'Curve': '.charts',
+    'Parallel': '.charts',
+    'Query': '.querys',
+    'BoardQuery': '.querys',
+    'TestsQuery': '.querys',
+    'ExpsQuery': '.querys',
+    'ReposQuery': '.querys',
+    'Q': '.querys',
+    'TestViewer': '.viewer',
+    'ProjViewer': '.viewer',
+    'ExpViewer': '.viewer',
+    'C': '.constrain',
+}
 
-from .constrain import C
+__all__ = list(_LAZY_ATTRS)
+
+if TYPE_CHECKING:
+    from .charts import Curve, Parallel
+    from .querys import Query, BoardQuery, TestsQuery, ExpsQuery, ReposQuery, Q
+    from .viewer import TestViewer, ProjViewer, ExpViewer
+
+    from .constrain import C
+
+
+def __getattr__(name):
+    import importlib
+    if name not in _LAZY_ATTRS:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+    setattr(sys.modules[__name__], name, value)
+    return value
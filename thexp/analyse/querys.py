@@ -14,23 +14,22 @@ viewer.tests().last() -> TestViewer
 
 
 """
-import json
 import numbers
 
 import warnings
 import numpy as np
 import os
 from itertools import chain
-from collections import OrderedDict
+from ..base_classes.attr import attr
 from ..base_classes.trickitems import NoneItem
 from pprint import pformat
-from typing import List, Iterator, Set
+from typing import List, Iterator, Optional, Set, Tuple
 from datetime import datetime, timedelta
 import pandas as pd
 
 from thexp.base_classes.list import llist
 from thexp.globals import _FNAME
-from thexp.utils.paths import home_dir
+from thexp.utils.paths import home_dir, load_json, locked_json
 from .reader import BoardReader
 from .viewer import TestViewer
 from ..utils.iters import is_same_type
@@ -59,27 +58,22 @@ class Query:
     @property
     def projs_list(self):
         global_repofn = os.path.join(home_dir(), _FNAME.repo)
-        if not os.path.exists(global_repofn):
-            res = {}
-        else:
-            with open(global_repofn, 'r', encoding='utf-8') as r:
-                res = json.load(r)
-
-        re_write = False
+        res = load_json(global_repofn, {})
 
         repos = []
         projs = []
         for k, v in res.items():  # log_dir(proj level), repopath
             if not os.path.exists(k):  # 不仅需要日志记录，还需要该试验目录确实存在
-                re_write = True
                 continue
 
             repos.append(v)
             projs.append(k)
 
-        if re_write:
-            with open(global_repofn, 'w', encoding='utf-8') as w:
-                json.dump({k: v for k, v in zip(projs, repos)}, w)
+        if len(projs) != len(res):
+            # reload under the lock, entries may be added by running experiments meanwhile
+            with locked_json(global_repofn) as res:
+                for k in [k for k in res if not os.path.exists(k)]:
+                    res.pop(k)
 
         return projs, repos
 
@@ -397,6 +391,49 @@ class BoardQuery():
                 res.append(None)
         return res
 
+    def load(self, tags: List[str] = None, workers: int = None) -> pd.DataFrame:
+        """
+        用多个进程同时读取所有 test 的 tags，没有被记录的 tag 会被忽略。
+        有效的 scalars 缓存会被直接使用，否则只解码 tags 中的 scalar，见 BoardReader.load()
+
+        Args:
+            tags: 需要读取的 tag，为 None 时读取所有 scalar
+            workers: 进程数，默认为 cpu 数量，为 0 或 1 时在当前进程中读取
+
+        Returns:
+            pd.DataFrame，每一行为一个记录，列为 test, tag, step, value
+        """
+        from .reader import load_scalars
+        files = [reader.file for reader in self.board_readers]
+        if workers is None:
+            workers = os.cpu_count()
+        workers = min(workers, len(files))
+        if workers <= 1:
+            loaded = [reader.load(tags) for reader in self.board_readers]
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            from functools import partial
+            with ProcessPoolExecutor(workers) as executor:
+                loaded = list(executor.map(partial(load_scalars, tags=tags), files,
+                                           chunksize=max(len(files) // (workers * 4), 1)))
+
+        test_names, tag_names, steps, values = [], [], [], []
+        for test_viewer, scalars_dict in zip(self.test_viewers, loaded):
+            for tag, scalars in scalars_dict.items():
+                test_names.append(np.full(len(scalars.steps), test_viewer.name, dtype=object))
+                tag_names.append(np.full(len(scalars.steps), tag, dtype=object))
+                steps.append(scalars.steps)
+                values.append(scalars.values)
+
+        if len(steps) == 0:
+            return pd.DataFrame(columns=['test', 'tag', 'step', 'value'])
+        return pd.DataFrame({
+            'test': np.concatenate(test_names),
+            'tag': np.concatenate(tag_names),
+            'step': np.concatenate(steps),
+            'value': np.concatenate(values),
+        })
+
     def parallel_dicts(self, *constrains: Constrain):
         """
         构建 平行图的字典，返回一个字典，包含了每个 tag 对应的所有试验的N个记录
@@ -541,6 +578,45 @@ class BoardQuery():
                 print('{} ({})'.format(k, v))
 
 
+def _constrain_mask(table: pd.DataFrame, present: pd.DataFrame, constrain: ParamConstrain) -> np.ndarray:
+    """
+    table 中满足 constrain 的行，与 params.get(name) 的比较结果相同：
+        - 值为 None（params.json 中的 null）的参数与 None 比较
+        - dict 类型的参数由其子参数（name.*）组合为 attr 后比较
+        - 没有该参数的行只有在 allow_none 时才可能满足，此时与 NoneItem() 比较
+    """
+    name, right = constrain._name, constrain._value
+    mask = np.zeros(len(table), dtype=bool)
+    found = np.zeros(len(table), dtype=bool)
+    if name in table:
+        column = table[name]
+        found = present[name].values.copy()
+        scalar = found & column.notna().values
+        if scalar.any():
+            values = column[scalar]
+            if right is None or isinstance(right, (numbers.Number, str)):
+                res = constrain._constrain(values, right)  # compared element-wise by pandas
+            else:  # list etc. would be treated as another column
+                res = values.map(lambda left: constrain._constrain(left, right))
+            mask[scalar] = np.asarray(res, dtype=bool)
+        for i in np.flatnonzero(found & ~scalar):  # None and NaN
+            mask[i] = constrain._constrain(column.values[i], right)
+
+    children = [c for c in table.columns if c.startswith(name + '.')]
+    if len(children) > 0:
+        for i in np.flatnonzero(present[children].values.any(axis=1) & ~found):
+            left = attr()
+            for c in children:
+                if present[c].values[i]:
+                    left[c[len(name) + 1:]] = table[c].values[i]
+            mask[i] = constrain._constrain(left, right)
+            found[i] = True
+
+    if constrain._allow_none:
+        mask[~found] = constrain._constrain(NoneItem(), right)
+    return mask
+
+
 class TestsQuery:
 
     def __init__(self, test_dirs: List[str]):
@@ -615,16 +691,10 @@ class TestsQuery:
         return df
 
     def params_df(self):
-        params_lis = [vw.params for vw in self.to_viewers()]
-        res = []
-        for params in params_lis:
-            dic = OrderedDict()
-            for k, v in params.inner_dict.walk():
-                dic[k] = v
-            res.append(dic)
-
-        df = pd.DataFrame(res, index=[vw.name for vw in self.to_viewers()]).T
-        return df
+        """每一列为一个 test，每一行为一个参数（a.b.c）"""
+        table, _, _ = self._params_table()
+        table.index = self.test_names
+        return table.T
 
     def boards(self):
         from thexp.base_classes.errors import NoneWarning
@@ -672,6 +742,32 @@ class TestsQuery:
     def tail(self, num=5):
         return self[-5:]
 
+    def _select(self, where: str, args=()) -> Optional[Set[str]]:
+        """
+        在索引（见 thexp.utils.index.TestIndex）中查询满足条件的 test，只有索引过期的 test 才会重新读取文件。
+        索引不可用时返回 None
+        """
+        from thexp.utils.index import TestIndex, INDEX_ERRORS
+        try:
+            with TestIndex() as index:
+                index.sync(self.test_dirs)
+                return index.select(self.test_dirs, where, args)
+        except INDEX_ERRORS as e:
+            warnings.warn('test index is unavailable, fall back to reading files: {}'.format(e))
+            return None
+
+    def _filter(self, where: str, args, check, toggle=True):
+        """
+        Args:
+            where, args: 筛选条件，见 TestIndex.select()
+            check: 对 TestViewer 的相同的判断，在索引不可用时使用
+            toggle: 为 False 时返回不满足条件的 test
+        """
+        matched = self._select(where, args)
+        if matched is None:
+            matched = {viewer.root for viewer in self.to_viewers() if check(viewer)}
+        return self[[i for i, test_dir in enumerate(self.test_dirs) if (test_dir in matched) == toggle]]
+
     def time_range(self, left_time=None, right_time=None):
         """
         筛选 start_time 位于某时间区间内的 test
@@ -685,19 +781,19 @@ class TestsQuery:
         if left_time is None and right_time is None:
             return self
 
-        res = []
-        for i, viewer in enumerate(self.to_viewers()):
-            if left_time is None:
-                if viewer.start_time < right_time:
-                    res.append(i)
-            elif right_time is None:
-                if viewer.start_time > left_time:
-                    res.append(i)
-            else:
-                if viewer.start_time > left_time and viewer.start_time < left_time:
-                    res.append(i)
+        where, args = [], []
+        if left_time is not None:
+            where.append('t.start_ts > ?')
+            args.append(left_time.timestamp())
+        if right_time is not None:
+            where.append('t.start_ts < ?')
+            args.append(right_time.timestamp())
 
-        return self[res]
+        def check(viewer):
+            return ((left_time is None or viewer.start_time > left_time) and
+                    (right_time is None or viewer.start_time < right_time))
+
+        return self._filter(' AND '.join(where), args, check)
 
     def in_time(self,
                 minutes=0,
@@ -709,41 +805,18 @@ class TestsQuery:
         return self.time_range(left_time=datetime.now() - delta)
 
     def success(self):
-        res = []
-        for i, viewer in enumerate(self.to_viewers()):
-            if viewer.success_exit:
-                res.append(i)
-        return self[res]
+        return self._filter('t.end_code = 0', (), lambda viewer: viewer.success_exit)
 
     def failed(self):
-        res = []
-        for i, viewer in enumerate(self.to_viewers()):
-            if not viewer.success_exit:
-                res.append(i)
-        return self[res]
+        return self._filter('t.end_code = 0', (), lambda viewer: viewer.success_exit, toggle=False)
 
     def has_tag(self, tag: str, toggle=True):
-        res = []
-        for i, viewer in enumerate(self.to_viewers()):
-            if viewer.has_tag(tag):
-                if toggle:
-                    res.append(i)
-            else:
-                if not toggle:
-                    res.append(i)
-        return self[res]
+        return self._filter('EXISTS (SELECT 1 FROM tags g WHERE g.test_dir = t.test_dir AND g.name = ?)', (tag,),
+                            lambda viewer: viewer.has_tag(tag), toggle)
 
     def has_plugin(self, plugin, toggle=True):
-        res = []
-        for i, viewer in enumerate(self.to_viewers()):
-            if viewer.has_plugin(plugin):
-                if toggle:
-                    res.append(i)
-            else:
-                if not toggle:
-                    res.append(i)
-
-        return self[res]
+        return self._filter('EXISTS (SELECT 1 FROM plugins p WHERE p.test_dir = t.test_dir AND p.name = ?)',
+                            (plugin,), lambda viewer: viewer.has_plugin(plugin), toggle)
 
     def has_board(self, toggle=True):
         return self.has_plugin(_BUILTIN_PLUGIN.writer, toggle)
@@ -778,10 +851,55 @@ class TestsQuery:
                 if not toggle: res.append(i)
         return self[res]
 
+    def _params_table(self, names: List[str] = None) -> Tuple[pd.DataFrame, pd.DataFrame, np.ndarray]:
+        """
+        每一行为一个 test（与 self.test_dirs 的顺序相同），每一列为一个参数（a.b.c）的参数表，优先从索引中读取
+
+        Args:
+            names: 只读取这些参数（以及 dict 类型参数的子参数），为 None 时读取所有参数
+
+        Returns:
+            (table, present, has_params)，没有的参数为 NaN；
+            present 与 table 的形状相同，表示 test 是否有该参数（用于区分值为 None 和没有该参数）；
+            has_params 表示 test 是否记录了 params.json
+        """
+        from thexp.utils.index import TestIndex, INDEX_ERRORS, flatten_params
+        try:
+            with TestIndex() as index:
+                index.sync(self.test_dirs)
+                columns = index.param_values(self.test_dirs, names)
+                # TestViewer.params reads params.json only when the params plugin is recorded
+                recorded = index.select(self.test_dirs, 't.params IS NOT NULL AND EXISTS ('
+                                                        'SELECT 1 FROM plugins p WHERE p.test_dir = t.test_dir AND p.name = ?)',
+                                        (_BUILTIN_PLUGIN.params,))
+        except INDEX_ERRORS as e:
+            warnings.warn('test index is unavailable, fall back to reading files: {}'.format(e))
+            columns = {}
+            recorded = set()
+            for test_dir, vw in zip(self.test_dirs, self.to_viewers()):
+                if vw.params is None:
+                    continue
+                recorded.add(test_dir)
+                for name, value in flatten_params(vw.params.inner_dict.jsonify()):
+                    if names is None or any(name == i or name.startswith(i + '.') for i in names):
+                        columns.setdefault(name, {})[test_dir] = value
+
+        table = pd.DataFrame(columns, index=list(self.test_dirs), columns=list(columns))
+        for name, column in columns.items():
+            if any(value is None for value in column.values()):  # pandas would store None as NaN
+                table[name] = pd.Series([column.get(test_dir, np.nan) for test_dir in self.test_dirs],
+                                        index=table.index, dtype=object)
+        present = pd.DataFrame({name: [test_dir in column for test_dir in self.test_dirs]
+                                for name, column in columns.items()}, columns=list(columns), dtype=bool)
+        table.index = pd.RangeIndex(len(table))
+        return table, present, np.array([test_dir in recorded for test_dir in self.test_dirs], dtype=bool)
+
     def filter_params(self, *constrains: ParamConstrain):
         """
         Query test with param constrains.
 
+        Each constrain is compiled to a boolean mask over the parameter table of all tests, see _params_table().
+
         Args:
             *constrains: a ParamConstrain instance.
 
@@ -791,28 +909,11 @@ class TestsQuery:
         if len(constrains) == 0:
             return self
 
-        res = []
-        params_lis = [vw.params for vw in self.to_viewers()]
-        for i, params in enumerate(params_lis):
-            feasible = True
-            for constrain in constrains:
-                if params is None:
-                    feasible = False
-                    break
-
-                left = params.get(constrain._name, NoneItem())
-                if isinstance(left, NoneItem) and not constrain._allow_none:
-                    feasible = False
-                    break
-
-                right = constrain._value
-                if not constrain._constrain(left, right):
-                    feasible = False
-                    break
-            if feasible:
-                res.append(i)
+        table, present, mask = self._params_table([constrain._name for constrain in constrains])
+        for constrain in constrains:
+            mask &= _constrain_mask(table, present, constrain)
 
-        return self[res]
+        return self[np.flatnonzero(mask).tolist()]
 
     """update test state"""
 
@@ -832,6 +933,14 @@ class TestsQuery:
         for viewer in self.to_viewers():
             viewer.delete_checkpoints()
 
+    def average_checkpoints(self, fn: str, last: int = 1, weights: List[float] = None) -> str:
+        """
+        对这些 test 最近保存的 last 个 checkpoint 中的模型参数求平均，保存在 fn 中，见 thexp.frame.saver.average_checkpoints
+        """
+        from thexp.frame.saver import average_checkpoints
+        fns = list(chain(*[viewer.find_checkpoints()[:last] for viewer in self.to_viewers()]))
+        return average_checkpoints(fns, fn, weights)
+
     def toggle_state(self, state_name: str, toggle=None):
         for viewer in self.to_viewers():
             viewer.toggle_state(state_name, toggle)
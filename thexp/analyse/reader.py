@@ -1,12 +1,186 @@
 """
 for reading values recorded by tensorboard directly instead of opening tensorboard web pages.
 """
+import os
 import pprint as pp
+import struct
 from collections import namedtuple
-from typing import List
-from tensorboard.backend.event_processing import event_accumulator
+from typing import Dict, Iterable, List, Tuple
 
-Scalars = namedtuple('ScalarEvent', ['wall_times', 'values', 'steps'])
+import numpy as np
+
+Scalars = namedtuple('Scalars', ['wall_times', 'values', 'steps'])
+
+
+def _stamp(file) -> tuple:
+    st = os.stat(file)
+    return st.st_size, st.st_mtime_ns
+
+
+def cache_file(file: str) -> str:
+    """
+    event file 对应的 scalars 缓存文件，与其位于同一目录下。
+    文件名中不能包含 'tfevents'，否则 tensorboard 会把它当成 event file 读取
+    """
+    dirname, basename = os.path.split(file)
+    return os.path.join(dirname, '.{}.scalars.v1.npz'.format(basename.replace('tfevents', 'thexp')))
+
+
+def _varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    res = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        res |= (b & 0x7f) << shift
+        if b < 0x80:
+            return res, pos
+        shift += 7
+
+
+def _fields(buf: bytes):
+    """iterate (field number, wire type, value) of a serialized protobuf message"""
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wire = key & 7
+        if wire == 0:
+            value, pos = _varint(buf, pos)
+        elif wire == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire == 2:
+            size, pos = _varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError('unsupported wire type {}'.format(wire))
+        yield key >> 3, wire, value
+
+
+def _plugin_name(metadata: bytes):
+    """SummaryMetadata.plugin_data.plugin_name"""
+    for number, _, plugin_data in _fields(metadata):
+        if number == 1:
+            for number_, _, name in _fields(plugin_data):
+                if number_ == 1:
+                    return name.decode('utf-8')
+    return None
+
+
+_TENSOR_FORMAT = {1: 'f', 2: 'd'}  # DT_FLOAT, DT_DOUBLE
+
+
+def _tensor_scalar(tensor: bytes):
+    """the value of a scalar TensorProto written by tf.summary.scalar (TF2)"""
+    dtype = None
+    values = b''
+    for number, wire, value in _fields(tensor):
+        if number == 1:
+            dtype = value
+        elif number in (4, 5, 6):  # tensor_content, float_val, double_val
+            values = value
+    fmt = _TENSOR_FORMAT.get(dtype, None)
+    if fmt is None or len(values) != struct.calcsize(fmt):
+        return None
+    return struct.unpack('<' + fmt, values)[0]
+
+
+def _parse_event(record: bytes, tags, columns: dict):
+    """append the scalar values of an Event to columns[tag] = ([wall_time], [value], [step])"""
+    wall_time, step, summary = 0., 0, None
+    for number, wire, value in _fields(record):
+        if number == 1 and wire == 1:
+            wall_time = struct.unpack('<d', value)[0]
+        elif number == 2 and wire == 0:
+            step = value - (1 << 64) if value >= (1 << 63) else value
+        elif number == 5 and wire == 2:
+            summary = value
+    if summary is None:
+        return
+
+    for number, _, summary_value in _fields(summary):
+        if number != 1:
+            continue
+        tag, value, tensor, metadata = None, None, None, None
+        for number_, wire, field in _fields(summary_value):
+            if number_ == 1:
+                tag = field.decode('utf-8')
+            elif number_ == 2 and wire == 5:
+                value = struct.unpack('<f', field)[0]
+            elif number_ == 8:
+                tensor = field
+            elif number_ == 9:
+                metadata = field
+        if tags is not None and tag not in tags:
+            continue
+        if value is None and tensor is not None and metadata is not None and _plugin_name(metadata) == 'scalars':
+            value = _tensor_scalar(tensor)
+        if value is None:
+            continue
+
+        column = columns.get(tag, None)
+        if column is None:
+            column = columns[tag] = ([], [], [])
+        column[0].append(wall_time)
+        column[1].append(value)
+        column[2].append(step)
+
+
+# events larger than this are not scalars (images, audio, large histograms), they are skipped without being read
+_MAX_SCALAR_RECORD = 1 << 20
+
+
+def read_scalars(file: str, offset: int = 0, tags: Iterable[str] = None) -> Tuple[Dict[str, Scalars], int]:
+    """
+    不依赖 tensorboard，直接解析 event file 的 TFRecord 格式，只解码其中的 scalar（Summary.Value.simple_value，
+    或 plugin 为 scalars 的 tensor）。
+
+    Args:
+        file: event file
+        offset: 从该位置开始读取，一般为上一次调用返回的 offset，用于轮询正在写入的 event file
+        tags: 只读取这些 tag，为 None 时读取所有 scalar
+
+    Returns:
+        (scalars, offset)，scalars 为 offset 之后记录的 {tag: Scalars}，每一项为 numpy array；
+        offset 为已经完整读取的位置，末尾未写完的 record 会在下一次调用时读取
+
+    Notes:
+        文件逐个 record 读取，大于 _MAX_SCALAR_RECORD 的 record 直接跳过，
+        因此包含大量图片等记录的 event file 也不会被整个读入内存。
+    """
+    if tags is not None:
+        tags = set(tags)
+
+    columns = {}
+    pos = offset
+    with open(file, 'rb') as r:
+        file_size = os.fstat(r.fileno()).st_size
+        r.seek(offset)
+        while pos + 12 <= file_size:
+            # uint64 length, uint32 masked crc of length, data, uint32 masked crc of data
+            size, = struct.unpack('<Q', r.read(12)[:8])
+            end = pos + 12 + size + 4
+            if end > file_size:
+                break
+            if size > _MAX_SCALAR_RECORD:
+                r.seek(end)
+            else:
+                data = r.read(size + 4)
+                if len(data) < size + 4:
+                    break
+                _parse_event(data[:size], tags, columns)
+            pos = end
+
+    scalars = {tag: Scalars(np.array(wall_times, dtype=np.float64),
+                            np.array(values, dtype=np.float64),
+                            np.array(steps, dtype=np.int64))
+               for tag, (wall_times, values, steps) in columns.items()}
+    return scalars, pos
 
 
 class BoardReader():
@@ -30,41 +204,146 @@ class BoardReader():
     """
 
     def __init__(self, file):
-        self.ea = event_accumulator.EventAccumulator(file,
-                                                     size_guidance={  # see below regarding this argument
-                                                         event_accumulator.COMPRESSED_HISTOGRAMS: 500,
-                                                         event_accumulator.IMAGES: 4,
-                                                         event_accumulator.AUDIO: 4,
-                                                         event_accumulator.SCALARS: 0,
-                                                         event_accumulator.HISTOGRAMS: 1,
-                                                     })
+        self.file = file
+        self._ea = None
         self._reloaded = False
+        self._ea_stamp = None  # (size, mtime) of the event file when self.ea was reloaded
+        self._stamp = None  # (size, mtime) of the event file when self._scalars was loaded
+        self._offset = 0  # position of the event file read by read_scalars()
+        self._scalars = None  # type: Dict[str, Scalars]
 
-    def _check_reload(self):
-        """load values from dist to memory"""
-        if not self._reloaded:
+    @property
+    def ea(self):
+        """EventAccumulator，只在读取 scalar 以外的记录时使用"""
+        if self._ea is None:
+            from tensorboard.backend.event_processing import event_accumulator
+            self._ea = event_accumulator.EventAccumulator(self.file,
+                                                          size_guidance={  # see below regarding this argument
+                                                              event_accumulator.COMPRESSED_HISTOGRAMS: 500,
+                                                              event_accumulator.IMAGES: 4,
+                                                              event_accumulator.AUDIO: 4,
+                                                              event_accumulator.SCALARS: 0,
+                                                              event_accumulator.HISTOGRAMS: 1,
+                                                          })
+        return self._ea
+
+    def _load_cache(self):
+        """
+        读取缓存的 scalar 和 offset。即使 event file 在缓存之后又追加了记录，缓存的内容仍然有效，
+        之后只需要从 offset 继续读取（见 _check_reload()）
+
+        Returns:
+            缓存时 event file 的 (size, mtime)，没有可用的缓存时为 None
+        """
+        try:
+            with np.load(cache_file(self.file)) as npz:
+                stamp = tuple(npz['stamp'].tolist())
+                self._offset = int(npz['offset'])
+                self._scalars = {
+                    str(tag): Scalars(npz['{}.wall_times'.format(i)], npz['{}.values'.format(i)],
+                                      npz['{}.steps'.format(i)])
+                    for i, tag in enumerate(npz['tags'])
+                }
+            return stamp
+        except (OSError, KeyError, ValueError):  # not exists, incomplete or written by other versions
+            self._offset, self._scalars = 0, None
+            return None
+
+    def _dump_cache(self, stamp):
+        arrays = {'stamp': np.array(stamp, dtype=np.int64),
+                  'offset': np.array(self._offset, dtype=np.int64),
+                  'tags': np.array(list(self._scalars), dtype=str)}
+        for i, scalars in enumerate(self._scalars.values()):
+            arrays['{}.wall_times'.format(i)] = scalars.wall_times
+            arrays['{}.values'.format(i)] = scalars.values
+            arrays['{}.steps'.format(i)] = scalars.steps
+
+        fn = cache_file(self.file)
+        tmp_fn = '{}.tmp{}.npz'.format(fn, os.getpid())
+        try:
+            np.savez(tmp_fn, **arrays)
+            os.replace(tmp_fn, fn)
+        except OSError:  # read-only log dir, the cache is only an optimization
+            if os.path.exists(tmp_fn):
+                os.remove(tmp_fn)
+
+    def _reload_ea(self):
+        """load values from disk to memory, EventAccumulator only reads the events appended since last reload"""
+        stamp = _stamp(self.file)
+        if not self._reloaded or stamp != self._ea_stamp:
             self.ea.Reload()
+            self._reloaded = True
+            self._ea_stamp = stamp
+
+    def _is_fresh(self) -> bool:
+        """
+        whether self._scalars is up to date with the event file, it is loaded from the cache if possible.
+        A cache written before the last records were appended is loaded as well, but it is not fresh.
+        """
+        stamp = _stamp(self.file)
+        if stamp == self._stamp:
+            return True
+        if self._scalars is None and self._load_cache() == stamp:
+            self._stamp = stamp
+            return True
+        return False
+
+    def _check_reload(self):
+        """load scalars from the cache, or read the events appended since last time if the event file has changed"""
+        if self._is_fresh():
+            return
+
+        stamp = _stamp(self.file)
+        if self._scalars is None or stamp[0] < self._offset:  # not loaded, or the event file was replaced
+            self._scalars = {}
+            self._offset = 0
+        appended, self._offset = read_scalars(self.file, self._offset)
+        for tag, new in appended.items():
+            old = self._scalars.get(tag, None)
+            if old is not None:
+                new = Scalars(*[np.concatenate(pair) for pair in zip(old, new)])
+            self._scalars[tag] = new
+        self._stamp = stamp
+        self._dump_cache(stamp)
+
+    def load(self, tags: Iterable[str] = None) -> Dict[str, Scalars]:
+        """
+        读取 tags（不存在的 tag 会被忽略），为 None 时读取所有 scalar。
+
+        已经读取过或者有缓存时直接使用（此时只需要读取新追加的记录）；
+        否则只解码 tags 中的 scalar，这种情况下结果不会被保存，也不会写入缓存
+        """
+        if tags is None or self._is_fresh() or self._scalars is not None:
+            self._check_reload()
+            scalars = self._scalars
+        else:
+            scalars, _ = read_scalars(self.file, tags=tags)
+        if tags is None:
+            return dict(scalars)
+        return {tag: scalars[tag] for tag in tags if tag in scalars}
 
     def get_scalars(self, tag) -> Scalars:
-        """get scalars named '<tag>' in this board"""
+        """get scalars named '<tag>' in this board, each field is a numpy array"""
         self._check_reload()
-        wall_times, steps, values = list(zip(*self.ea.Scalars(tag)))  # 'wall_time', 'step', 'value'
-        values = [float("{:.4f}".format(i)) for i in values]
-        return Scalars(wall_times, values, steps)
+        return self._scalars[tag]
 
     @property
     def scalars_tags(self) -> List[str]:
         """get all scalar tags"""
         self._check_reload()
-        return self.tags['scalars']
+        return list(self._scalars)
 
     @property
     def tags(self) -> dict:
         """get all tags in this board"""
-        self._check_reload()
+        self._reload_ea()
         return self.ea.Tags()
 
     def summary(self):
         """print tags in this board"""
-        self._check_reload()
-        pp.pprint(self.ea.Tags())
+        pp.pprint(self.tags)
+
+
+def load_scalars(file: str, tags: Iterable[str] = None) -> Dict[str, Scalars]:
+    """BoardReader(file).load(tags)，用于 BoardQuery.load() 在子进程中读取"""
+    return BoardReader(file).load(tags)
@@ -6,10 +6,11 @@ import os
 import pprint
 import shutil
 from functools import lru_cache
-from typing import Dict
+from typing import Dict, List
 
 from thexp import Experiment
 from thexp.base_classes.attr import attr
+from thexp.frame.saver import Saver
 from thexp.globals import _INFOJ, _FNAME, _BUILTIN_PLUGIN, _GITKEY, _TEST_BUILTIN_STATE, _PLUGIN_DIRNAME, _PLUGIN_KEY
 from .reader import BoardReader
 from ..utils.dates import date_from_str
@@ -450,6 +451,33 @@ class TestViewer(_Viewer):
         if plugin_info is not None:
             return os.path.exists(plugin_info[_PLUGIN_KEY.LOGGER.fn])
 
+    """profile CRUD"""
+
+    @property
+    def profile_fn(self):
+        if self.has_plugin(_BUILTIN_PLUGIN.profile):
+            return os.path.join(self.root, _FNAME.profile)
+        return None
+
+    def has_profile(self):
+        fn = self.profile_fn
+        return fn is not None and os.path.exists(fn)
+
+    @property
+    def profile(self) -> list:
+        """
+        ProfileCallback 记录的每个 epoch 的时间统计，每个元素为 {'eidx':..., 'stats': {key: {'count':..., 'mean':..., ...}}}
+        """
+        if not self.has_profile():
+            return None
+        res = []
+        with open(self.profile_fn, encoding='utf-8') as r:
+            for line in r:
+                line = line.strip()
+                if len(line) > 0:
+                    res.append(json.loads(line))
+        return res
+
     """saver CRUD"""
 
     @property
@@ -458,38 +486,40 @@ class TestViewer(_Viewer):
             return self.get_plugin(_BUILTIN_PLUGIN.saver)[_PLUGIN_KEY.SAVER.ckpt_dir]
         return None
 
+    def find_checkpoints(self) -> List[str]:
+        """按保存顺序排列的 checkpoint，最近保存的在前"""
+        dir = self.saver_dir_fn
+        if dir is None or not os.path.exists(dir):
+            return []
+        return Saver(dir).find_checkpoints()
+
     def delete_keypoints(self):
         dir = self.saver_dir_fn
         if dir is None:
             return
         fn = [os.path.join(dir, i) for i in os.listdir(dir) if i.endswith('.ckpt') and i.startswith('keep')]
+        saver = Saver(dir)
         for f in fn:
-            os.remove(f)
-            jfn = '{}.json'.format(f)
-            if os.path.exists(jfn):
-                os.remove(jfn)
+            # directories of sharded checkpoints and references of deduplicated tensors are handled by Saver
+            saver.check_remove(f)
 
     def delete_checkpoints(self):
         dir = self.saver_dir_fn
         if dir is None:
             return
         fn = [os.path.join(dir, i) for i in os.listdir(dir) if i.endswith('.ckpt') and not i.startswith('keep')]
+        saver = Saver(dir)
         for f in fn:
-            os.remove(f)
-            jfn = '{}.json'.format(f)
-            if os.path.exists(jfn):
-                os.remove(jfn)
+            saver.check_remove(f)
 
     def delete_modules(self):
         dir = self.saver_dir_fn
         if dir is None:
             return
         fn = [os.path.join(dir, i) for i in os.listdir(dir) if i.startswith('model') and i.endswith('pth')]
+        saver = Saver(dir)
         for f in fn:
-            os.remove(f)
-            jfn = '{}.json'.format(f)
-            if os.path.exists(jfn):
-                os.remove(jfn)
+            saver.check_remove(f)
 
     def delete_saver_dir(self):
         dir = self.saver_dir_fn
@@ -1,10 +1,9 @@
 """
 
 """
+import sys
 import warnings
 import copy
-import torch
-import numpy as np
 from collections import OrderedDict
 
 from typing import Any, Iterable
@@ -14,6 +13,18 @@ from thexp.base_classes.metaclasses import meta_attr
 _attr_clss = {}
 
 
+def _array_types() -> tuple:
+    """
+    只有 torch / numpy 已经被导入时，值才可能是 Tensor / ndarray，因此不需要为此导入它们（import thexp 时不会导入 torch）
+    """
+    res = []
+    if 'torch' in sys.modules:
+        res.append(sys.modules['torch'].Tensor)
+    if 'numpy' in sys.modules:
+        res.append(sys.modules['numpy'].ndarray)
+    return tuple(res)
+
+
 class attr(OrderedDict, metaclass=meta_attr):
     """
     An ordered defaultdict, the default class is attr itself.
@@ -155,6 +166,8 @@ class attr(OrderedDict, metaclass=meta_attr):
     def from_dict(cls, dic: dict):
         # res = cls()
         cls_name = dic.get('_class_name', cls.__name__)
+        if cls_name not in _attr_clss:
+            import thexp.calculate  # schedule classes, no longer imported by `import thexp`
         if cls_name not in _attr_clss:
             res = attr()
             from .errors import AttrTypeNotFoundWarning
@@ -169,7 +182,7 @@ class attr(OrderedDict, metaclass=meta_attr):
         for k, v in dic.items():
             if isinstance(v, attr):
                 v = v.from_dict(v)
-            elif isinstance(v, (list, tuple, torch.Tensor, np.ndarray)):
+            elif isinstance(v, (list, tuple) + _array_types()):
                 v = cls._copy_iters(v)
 
             res[k] = v
@@ -177,9 +190,10 @@ class attr(OrderedDict, metaclass=meta_attr):
 
     @staticmethod
     def _copy_iters(item):
-        if isinstance(item, torch.Tensor):
+        torch, np = sys.modules.get('torch', None), sys.modules.get('numpy', None)
+        if torch is not None and isinstance(item, torch.Tensor):
             return item.clone()
-        elif isinstance(item, np.ndarray):
+        elif np is not None and isinstance(item, np.ndarray):
             return item.copy()
         elif isinstance(item, list):
             return list(attr._copy_iters(i) for i in item)
@@ -2,11 +2,9 @@
 
 """
 import numbers
+import sys
 from typing import Any, Iterable
 
-import numpy as np
-import torch
-
 
 class llist(list):
     """
@@ -44,14 +42,16 @@ class llist(list):
             else:
                 return res
         elif isinstance(i, (Iterable)):
-            if isinstance(i, torch.Tensor):
+            # an index can only be a Tensor / ndarray when torch / numpy has been imported
+            torch, np = sys.modules.get('torch', None), sys.modules.get('numpy', None)
+            if torch is not None and isinstance(i, torch.Tensor):
                 if len(i.shape) == 0:
                     i = i.item()
                     return self.__getitem__(i)
                 else:
                     i = i.tolist()
-            if isinstance(i, np.ndarray):
-                if i.dtype == np.bool:
+            if np is not None and isinstance(i, np.ndarray):
+                if i.dtype == np.bool_:
                     i = np.where(i)[0]
 
                 if len(i.shape) == 0:
@@ -1,8 +1,6 @@
 import importlib
 from typing import overload
 
-from torch.optim.optimizer import Optimizer
-
 from .attr import attr
 
 
@@ -12,7 +10,7 @@ class OptimParams(attr):
         self.args = attr.from_dict(kwargs)  # type:attr
         self.name = name
 
-    def build(self, parameters, optim_cls=None) -> Optimizer:
+    def build(self, parameters, optim_cls=None) -> 'torch.optim.Optimizer':
         lname = self.name.lower()
         if optim_cls is None:
             assert self.name is not None
@@ -3,7 +3,6 @@
 
     提供一些提供了奇葩 feature 的类
 """
-from typing import Any
 
 
 class Self:
@@ -82,9 +81,9 @@ class AvgItem:
     avg.avg = 2 #(average item)
     avg.sum = 6
     """
+    __slots__ = ('_sum', '_weight', '_count', '_item')
 
     def __init__(self, weight=1) -> None:
-        super().__init__()
         self._sum = 0
         self._weight = weight
         self._count = 0
@@ -110,19 +109,19 @@ class AvgItem:
         return self._sum / self._count
 
     def __repr__(self) -> str:
-        return str("{}({})".format(self._item, self.avg))
-
-    def __getattribute__(self, name: str) -> Any:
-        return super().__getattribute__(name)
+        return str("{}({})".format(self.item, self.avg))
 
     def __getattr__(self, item):
-        return getattr(self._item, item)
+        if item.startswith('_'):
+            # unset slots / pickle protocol lookups, don't fall back to the inner item
+            raise AttributeError(item)
+        return getattr(self.item, item)
 
     def __format__(self, format_spec):
-        return "{{:{}}}({{:{}}})".format(format_spec, format_spec).format(self._item, self.avg)
+        return "{{:{}}}({{:{}}})".format(format_spec, format_spec).format(self.item, self.avg)
 
     def __getitem__(self, item):
-        return self._item[item]
+        return self.item[item]
 
 
 class _ContainWrap():
@@ -26,11 +26,16 @@ thexp log <test_name>
 # print params of this test
 thexp params <test_name>
 
+# print time breakdown recorded by ProfileCallback
+thexp profile <test_name> [--epoch=<eidx>]
+
+# average the model of the last K checkpoints of some tests (SWA / model soup)
+thexp average <test_name> [<test_name> ...] [--last=<K>] [--out=<fn>]
+
 # <test_name>/--test=<test_name>/--test_name=<test_name>
 """
 import sys
 from thexp import __VERSION__
-from thexp import Q
 
 from thexp.decorators import regist_func
 
@@ -79,6 +84,7 @@ def _board_with_logdir(logdir, *args, **kwargs):
 
 
 def _board_with_test_name(test_name, *args, **kwargs):
+    from thexp import Q  # imported by the commands which need it, pandas etc. are slow to import
     query = Q.tests(test_name)
     if query.empty:
         raise IndexError(test_name)
@@ -117,6 +123,7 @@ def _find_test_name(*args, **kwargs):
 @regist_func(func_map)
 def reset(*args, **kwargs):
     test_name = _find_test_name(*args, **kwargs)
+    from thexp import Q
     query = Q.tests(test_name)
     if query.empty:
         print("can't find test {}".format(test_name))
@@ -128,6 +135,7 @@ def reset(*args, **kwargs):
 @regist_func(func_map)
 def archive(*args, **kwargs):
     test_name = _find_test_name(*args, **kwargs)
+    from thexp import Q
     query = Q.tests(test_name)
     if query.empty:
         print("can't find test {}".format(test_name))
@@ -140,6 +148,7 @@ def archive(*args, **kwargs):
 @regist_func(func_map)
 def delete(*args, **kwargs):
     test_name = _find_test_name(*args, **kwargs)
+    from thexp import Q
     query = Q.tests(test_name)
     if query.empty:
         print("can't find test {}".format(test_name))
@@ -152,6 +161,7 @@ def delete(*args, **kwargs):
 @regist_func(func_map)
 def log(*args, **kwargs):
     test_name = _find_test_name(*args, **kwargs)
+    from thexp import Q
     query = Q.tests(test_name)
     if query.empty:
         print("can't find test {}".format(test_name))
@@ -167,6 +177,7 @@ def log(*args, **kwargs):
 @regist_func(func_map)
 def params(*args, **kwargs):
     test_name = _find_test_name(*args, **kwargs)
+    from thexp import Q
     query = Q.tests(test_name)
     if query.empty:
         print("can't find test {}".format(test_name))
@@ -181,6 +192,58 @@ def params(*args, **kwargs):
         exit(1)
 
 
+def _format_profile(record):
+    stats = record['stats']
+    lines = ['epoch {}:'.format(record['eidx'])]
+    heads = [k for k in next(iter(stats.values())).keys() if k != 'count']
+    lines.append('{:<40s}{:>8s}'.format('(ms)', 'count') + ''.join('{:>10s}'.format(k) for k in heads))
+    for key, stat in sorted(stats.items(), key=lambda x: -x[1]['total']):
+        lines.append('{:<40s}{:>8d}'.format(key, stat['count']) +
+                     ''.join('{:>10.3f}'.format(stat[k]) for k in heads))
+    return '\n'.join(lines)
+
+
+@regist_func(func_map)
+def profile(*args, **kwargs):
+    test_name = _find_test_name(*args, **kwargs)
+    from thexp import Q
+    query = Q.tests(test_name)
+    if query.empty:
+        print("can't find test {}".format(test_name))
+        exit(1)
+
+    vw = query.to_viewer()
+    if not vw.has_profile():
+        print("can't find profile file of [{}]".format(test_name))
+        exit(1)
+
+    records = vw.profile
+    if 'epoch' in kwargs:
+        records = [record for record in records if record['eidx'] == kwargs['epoch']]
+    for record in records:
+        print(_format_profile(record))
+
+
+@regist_func(func_map)
+def average(*args, **kwargs):
+    import os
+    from thexp import Q
+    query = Q.tests(*args)
+    if len(args) == 0 or query.empty:
+        print("can't find test {}".format(' '.join(args)))
+        exit(1)
+
+    vw = query.to_viewers()[0]
+    out = kwargs.get('out', None)
+    if out is None:
+        if vw.saver_dir_fn is None:
+            print("can't find checkpoint dir of [{}], use --out to choose where to save".format(vw.name))
+            exit(1)
+        out = os.path.join(vw.saver_dir_fn, 'model.avg.pth')
+    fn = query.average_checkpoints(out, last=kwargs.get('last', 1))
+    print("saved in {}".format(fn))
+
+
 def main(*args, **kwargs):
     if len(args) == 0 or 'help' in kwargs:
         print(doc)
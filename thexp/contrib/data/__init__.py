@@ -3,4 +3,5 @@
 """
 
 from .dataloader import DataLoader
+from .sampler import ResumableSampler
 from . import splits
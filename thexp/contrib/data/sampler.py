@@ -0,0 +1,72 @@
+"""
+
+"""
+import torch
+from torch.utils.data import Sampler
+
+from thexp.utils import random
+
+
+class ResumableSampler(Sampler):
+    """
+    可以从任意位置恢复的 sampler。
+
+    每一轮（每次调用 iter()）的顺序只由 seed 和轮数决定，因此只需要记录 (seed, epoch, offset)，
+    恢复后的下一轮会直接从第 offset 个样本开始产生 index，被跳过的样本不会被读取。
+    状态的记录和恢复一般由 Trainer 通过 DataBundler.sampler_state_dict() 完成，见 DatasetBuilder.DataLoader(resumable=True)
+
+    Args:
+        data_source: 数据集
+        shuffle: 为 False 时按顺序产生 index
+        seed: 默认从 torch 的随机数生成器中产生，因此在 fix_seed() 之后是确定的
+    """
+
+    def __init__(self, data_source, shuffle=True, seed=None):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        if seed is None:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        self.seed = seed
+        self.epoch = 0  # the round used by the next iteration
+        self.offset = 0  # number of samples skipped at the beginning of the next iteration
+        self._start = 0  # offset of the last started iteration
+        # restored when the next iteration starts, after the DataLoader iterator drew its worker seed
+        self.rng_state = None
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def order(self, epoch: int) -> torch.Tensor:
+        """第 epoch 轮的顺序"""
+        if not self.shuffle:
+            return torch.arange(len(self.data_source))
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        return torch.randperm(len(self.data_source), generator=generator)
+
+    def __iter__(self):
+        if self.rng_state is not None:
+            random.set_state(self.rng_state, fix_cudnn=False)
+            self.rng_state = None
+        order = self.order(self.epoch)[self.offset:]
+        self._start = self.offset
+        self.epoch += 1
+        self.offset = 0
+        return iter(order.tolist())
+
+    def state_dict(self, consumed: int = None) -> dict:
+        """
+        Args:
+            consumed: 最近开始的一轮中已经被使用的样本数量，为 None 时表示下一轮还没有开始
+
+        Returns:
+            恢复后，下一轮将从该位置开始
+        """
+        if consumed is None:
+            return {'seed': self.seed, 'epoch': self.epoch, 'offset': self.offset}
+        return {'seed': self.seed, 'epoch': self.epoch - 1, 'offset': self._start + consumed}
+
+    def load_state_dict(self, state_dict: dict):
+        self.seed = state_dict['seed']
+        self.epoch = state_dict['epoch']
+        self.offset = state_dict['offset']
@@ -1,7 +1,7 @@
 from typing import List, Tuple
 
 import torch
-from torch._utils import _accumulate
+from itertools import accumulate as _accumulate  # removed from torch._utils in newer versions
 from torch.utils.data import Dataset, Subset
 
 
@@ -6,10 +6,33 @@ from typing import Union, List, Dict, Tuple
 import torch
 
 
-def to_device(batch: Union[List, Dict, Tuple, torch.Tensor], device: torch.device):
+def to_device(batch: Union[List, Dict, Tuple, torch.Tensor], device: torch.device, non_blocking=False):
     if isinstance(batch, (list, tuple)):
-        return [to_device(ele, device) for ele in batch]
+        return [to_device(ele, device, non_blocking) for ele in batch]
     elif isinstance(batch, dict):
-        return {k: to_device(ele, device) for k, ele in batch.items()}
+        return {k: to_device(ele, device, non_blocking) for k, ele in batch.items()}
     elif isinstance(batch, torch.Tensor):
-        return batch.to(device)
+        return batch.to(device, non_blocking=non_blocking)
+
+
+def pin_memory(batch: Union[List, Dict, Tuple, torch.Tensor]):
+    """copy tensors in batch to page-locked memory, so that they can be transferred by `non_blocking=True`"""
+    if isinstance(batch, (list, tuple)):
+        return [pin_memory(ele) for ele in batch]
+    elif isinstance(batch, dict):
+        return {k: pin_memory(ele) for k, ele in batch.items()}
+    elif isinstance(batch, torch.Tensor) and not batch.is_pinned():
+        return batch.pin_memory()
+    return batch
+
+
+def record_stream(batch: Union[List, Dict, Tuple, torch.Tensor], stream):
+    """mark tensors in batch as used by `stream`, see torch.Tensor.record_stream"""
+    if isinstance(batch, (list, tuple)):
+        for ele in batch:
+            record_stream(ele, stream)
+    elif isinstance(batch, dict):
+        for ele in batch.values():
+            record_stream(ele, stream)
+    elif isinstance(batch, torch.Tensor) and batch.is_cuda:
+        batch.record_stream(stream)
@@ -1,14 +1,46 @@
 """
 
 """
+import sys
+from typing import TYPE_CHECKING
 
-from .builder import DatasetBuilder, Delegate
-from .databundler import DataBundler
-from .experiment import Experiment
-from .configs import globs
-from .logger import Logger
-from .meter import Meter, AvgMeter
-from .params import Params, BaseParams
-from .rndmanager import RndManager
-from .saver import Saver
-from .trainer import Trainer, BaseTrainer
+# name -> module, imported when first accessed, see thexp.__getattr__
+_LAZY_ATTRS = {
+    'DatasetBuilder': '.builder',
+    'Delegate': '.builder',
+    'DataBundler': '.databundler',
+    'Experiment': '.experiment',
+    'globs': '.configs',
+    'Logger': '.logger',
+    'Meter': '.meter',
+    'AvgMeter': '.meter',
+    'Params': '.params',
+    'BaseParams': '.params',
+    'RndManager': '.rndmanager',
+    'Saver': '.saver',
+    'Trainer': '.trainer',
+    'BaseTrainer': '.trainer',
+}
+
+__all__ = list(_LAZY_ATTRS)
+
+if TYPE_CHECKING:
+    from .builder import DatasetBuilder, Delegate
+    from .databundler import DataBundler
+    from .experiment import Experiment
+    from .configs import globs
+    from .logger import Logger
+    from .meter import Meter, AvgMeter
+    from .params import Params, BaseParams
+    from .rndmanager import RndManager
+    from .saver import Saver
+    from .trainer import Trainer, BaseTrainer
+
+
+def __getattr__(name):
+    import importlib
+    if name not in _LAZY_ATTRS:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(_LAZY_ATTRS[name], __name__), name)
+    setattr(sys.modules[__name__], name, value)
+    return value
@@ -0,0 +1,204 @@
+"""
+按内容寻址的 tensor 存储，用于 checkpoint 之间共享相同的 tensor（如冻结的 backbone、embedding）
+"""
+import hashlib
+import itertools
+import os
+from collections import namedtuple
+
+import torch
+
+from ..utils.paths import file_lock
+
+# root is relative to the directory of the checkpoint which holds the reference, see BlobStore.rel_root()
+BlobRef = namedtuple('BlobRef', ['hash', 'root'])
+# a tensor saved in a pack (a dict of tensors written by one delta checkpoint), see Saver(delta=True)
+PackRef = namedtuple('PackRef', ['hash', 'root', 'key'])
+
+
+class BlobStore:
+    """
+    每个 tensor 以其内容（dtype、shape 和数据）的 hash 命名，只保存一次：
+        <root>/<hash[:2]>/<hash>.pt
+
+    保存 checkpoint 时，state_dict 中较大的 tensor 会被替换为 BlobRef，checkpoint 文件本身只是一份引用清单。
+    每个引用以一个空文件的形式记录在 <root>/refs/<hash>/<manifest_id> 中，
+    删除 checkpoint 时移除其引用，当某个 blob 没有任何引用时才会被删除。
+    引用的增删通过 <root>/.lock 上的文件锁（fcntl）与其他进程互斥，因此同一个实验下的多个 test 可以共享一个 BlobStore。
+
+    增量 checkpoint（Saver(delta=True)）也通过 BlobStore 保存，此时每个 blob 是一次保存中发生变化的所有 tensor 组成的 pack，
+    以随机的 id 命名，见 add_refs()。
+
+    Args:
+        root: 存储目录，一般为实验（exp）级别的目录
+        min_bytes: 小于该大小的 tensor 直接保存在 checkpoint 中
+    """
+
+    def __init__(self, root, min_bytes=64 * 1024):
+        self.root = os.path.abspath(root)
+        self.min_bytes = min_bytes
+        os.makedirs(os.path.join(self.root, 'refs'), exist_ok=True)
+
+    def _lock(self):
+        return file_lock(os.path.join(self.root, '.lock'))
+
+    @staticmethod
+    def hash_tensor(tensor: torch.Tensor) -> str:
+        tensor = tensor.detach().cpu().contiguous()
+        h = hashlib.sha1("{}{}".format(tensor.dtype, list(tensor.shape)).encode())
+        h.update(tensor.reshape(-1).view(torch.uint8).numpy())
+        return h.hexdigest()
+
+    def rel_root(self, fn: str) -> str:
+        """
+        记录在 checkpoint fn 中的 root，为相对于 fn 所在目录的路径，因此移动或复制整个实验目录后引用仍然有效
+        """
+        try:
+            return os.path.relpath(self.root, os.path.dirname(os.path.abspath(fn)))
+        except ValueError:  # on different drives (windows)
+            return self.root
+
+    def blob_fn(self, hash: str) -> str:
+        return os.path.join(self.root, hash[:2], "{}.pt".format(hash))
+
+    def _ref_dir(self, hash: str) -> str:
+        return os.path.join(self.root, 'refs', hash)
+
+    def _manifest_id(self, fn: str) -> str:
+        """由 fn 相对于 root 的路径决定，与 rel_root() 一样在移动整个实验目录后保持不变"""
+        try:
+            fn = os.path.relpath(os.path.abspath(fn), self.root)
+        except ValueError:  # on different drives (windows)
+            fn = os.path.abspath(fn)
+        return hashlib.sha1(fn.encode()).hexdigest()
+
+    def _replace_tensors(self, obj, blobs: dict, root: str):
+        if isinstance(obj, torch.Tensor):
+            if obj.numel() * obj.element_size() < self.min_bytes:
+                return obj
+            # always hashed by contents: in-place writes through .data don't bump tensor._version
+            hash = self.hash_tensor(obj)
+            blobs.setdefault(hash, obj)
+            return BlobRef(hash, root)
+        elif isinstance(obj, dict):
+            return obj.__class__((k, self._replace_tensors(v, blobs, root)) for k, v in obj.items())
+        elif isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+            return obj.__class__(self._replace_tensors(v, blobs, root) for v in obj)
+        return obj
+
+    def prepare(self, state_dict, fn: str):
+        """
+        计算 state_dict 中 tensor 的 hash，并记录 fn 对这些 blob 的引用（记录后它们不会被其他 checkpoint 的删除所影响）。
+
+        Returns:
+            (manifest, missing)
+            manifest: 将 tensor 替换为 BlobRef 后的 state_dict，应保存在 fn 中
+            missing: {hash: tensor}，store 中还不存在、需要通过 commit() 写入的 tensor
+        """
+        blobs = {}
+        manifest = self._replace_tensors(state_dict, blobs, self.rel_root(fn))
+
+        mid = self._manifest_id(fn)
+        missing = {}
+        with self._lock():
+            for hash, tensor in blobs.items():
+                os.makedirs(self._ref_dir(hash), exist_ok=True)
+                open(os.path.join(self._ref_dir(hash), mid), 'w').close()
+                if not os.path.exists(self.blob_fn(hash)):
+                    missing[hash] = tensor
+        return manifest, missing
+
+    def commit(self, missing: dict):
+        """写入 prepare() 返回的 missing tensor（或 add_refs() 之后的 pack）"""
+        for hash, obj in missing.items():
+            blob_fn = self.blob_fn(hash)
+            if os.path.exists(blob_fn):  # written by another process
+                continue
+            os.makedirs(os.path.dirname(blob_fn), exist_ok=True)
+            tmp_fn = "{}.tmp{}".format(blob_fn, os.getpid())
+            if isinstance(obj, dict):
+                obj = {k: v.detach().cpu().clone() for k, v in obj.items()}
+            else:
+                obj = obj.detach().cpu().clone()
+            torch.save(obj, tmp_fn)
+            os.replace(tmp_fn, blob_fn)
+
+    def add_refs(self, fn: str, hashes, new_hashes=()) -> bool:
+        """
+        记录 fn 对 hashes 中已有 blob 以及 new_hashes 中将要写入的 blob 的引用。
+
+        Returns:
+            hashes 中有 blob 已经不再被引用（已被删除或即将被删除）时不添加任何引用，返回 False
+        """
+        mid = self._manifest_id(fn)
+        with self._lock():
+            if not all(os.path.isdir(self._ref_dir(hash)) for hash in hashes):
+                return False
+            for hash in itertools.chain(hashes, new_hashes):
+                os.makedirs(self._ref_dir(hash), exist_ok=True)
+                open(os.path.join(self._ref_dir(hash), mid), 'w').close()
+        return True
+
+    def put(self, state_dict, fn: str):
+        """prepare() 和 commit() 的组合，返回 manifest"""
+        manifest, missing = self.prepare(state_dict, fn)
+        self.commit(missing)
+        return manifest
+
+    def release(self, fn: str, hashes):
+        """移除 fn 对 hashes 中 blob 的引用，并删除不再被引用的 blob"""
+        mid = self._manifest_id(fn)
+        with self._lock():
+            for hash in set(hashes):
+                ref_dir = self._ref_dir(hash)
+                ref_fn = os.path.join(ref_dir, mid)
+                if os.path.exists(ref_fn):
+                    os.remove(ref_fn)
+                if os.path.isdir(ref_dir) and len(os.listdir(ref_dir)) == 0:
+                    os.rmdir(ref_dir)
+                    if os.path.exists(self.blob_fn(hash)):
+                        os.remove(self.blob_fn(hash))
+
+    def refcount(self, hash: str) -> int:
+        ref_dir = self._ref_dir(hash)
+        if not os.path.isdir(ref_dir):
+            return 0
+        return len(os.listdir(ref_dir))
+
+
+def find_refs(obj, res: set = None) -> set:
+    """返回 obj 中所有的 BlobRef 和 PackRef"""
+    if res is None:
+        res = set()
+    if isinstance(obj, (BlobRef, PackRef)):
+        res.add(obj)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            find_refs(v, res)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            find_refs(v, res)
+    return res
+
+
+def ref_root(ref, fn: str) -> str:
+    """保存在 checkpoint fn 中的引用 ref 所在 BlobStore 的绝对路径（更早的 checkpoint 中记录的是绝对路径）"""
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(fn)), ref.root))
+
+
+def resolve_refs(obj, fn: str, load_fn, _packs: dict = None):
+    """将 checkpoint fn 中的 BlobRef / PackRef 替换为通过 load_fn(blob_fn) 读取的 tensor，每个 pack 只读取一次"""
+    if _packs is None:
+        _packs = {}
+    if isinstance(obj, BlobRef):
+        return load_fn(os.path.join(ref_root(obj, fn), obj.hash[:2], "{}.pt".format(obj.hash)))
+    elif isinstance(obj, PackRef):
+        pack_fn = os.path.join(ref_root(obj, fn), obj.hash[:2], "{}.pt".format(obj.hash))
+        if pack_fn not in _packs:
+            _packs[pack_fn] = load_fn(pack_fn)
+        return _packs[pack_fn][obj.key]
+    elif isinstance(obj, dict):
+        return obj.__class__((k, resolve_refs(v, fn, load_fn, _packs)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return obj.__class__(resolve_refs(v, fn, load_fn, _packs) for v in obj)
+    return obj
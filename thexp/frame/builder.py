@@ -383,9 +383,18 @@ class DatasetBuilder(Dataset):
     def DataLoader(self, batch_size=1, shuffle=False, sampler=None,
                    batch_sampler=None, num_workers=0, collate_fn=None,
                    pin_memory=False, drop_last=False, timeout=0,
-                   worker_init_fn=None, multiprocessing_context=None):
+                   worker_init_fn=None, multiprocessing_context=None, resumable=False):
         pass
 
-    def DataLoader(self, *args, **kwargs):
-        from thexp.contrib.data import DataLoader
+    def DataLoader(self, *args, resumable=False, **kwargs):
+        """
+        Args:
+            resumable: 为 True 时使用 ResumableSampler（shuffle 参数传递给它），
+                Trainer 保存的 checkpoint 会记录其位置，恢复后可以直接从中断的 batch 继续训练，不需要重新读取之前的 batch
+        """
+        from thexp.contrib.data import DataLoader, ResumableSampler
+        if resumable:
+            assert len(args) <= 1, 'pass arguments except batch_size by keywords when resumable=True'
+            assert kwargs.get('sampler', None) is None and kwargs.get('batch_sampler', None) is None
+            kwargs['sampler'] = ResumableSampler(self, shuffle=kwargs.pop('shuffle', False))
         return DataLoader(self, *args, **kwargs)
@@ -2,16 +2,21 @@
 
 """
 
+import json
 import os, sys
+import time
+from collections import defaultdict
 from functools import wraps
 
+import numpy as np
+
 from ..calculate.schedule import Schedule, ScheduleList
 from .meter import AvgMeter
 from .meter import Meter
 from .params import Params
 from .trainer import Trainer
 from ..base_classes.trickitems import NoneItem, AvgItem
-from ..globals import _ML
+from ..globals import _ML, _PLUGIN_KEY
 from ..utils.timing import format_second
 
 
@@ -83,6 +88,28 @@ class BaseCallback():
     def on_end(self, trainer: Trainer, func, params: Params, meter, *args, **kwargs):
         pass
 
+    def _dispatch_begin(self, func_name: str):
+        """
+        返回 trainer.<func_name> 执行前需要调用的方法，若该回调不关心该函数，返回 None。
+        Trainer 在 add_callback / remove_callback 时通过该方法预先构建每个函数的回调列表。
+        """
+        if type(self).on_begin is BaseCallback.on_begin:
+            return None
+        return self.on_begin
+
+    def _dispatch_end(self, func_name: str):
+        """同 _dispatch_begin()，对应执行后的回调"""
+        if type(self).on_end is BaseCallback.on_end:
+            return None
+        return self.on_end
+
+    def _instrument_dispatch(self, func_name: str, begins: list, ends: list):
+        """
+        在 Trainer 构建完 trainer.<func_name> 的回调列表后调用，可以原地修改 begins / ends，
+        用于需要包裹其他回调的回调（如 ProfileCallback），一般的回调无需重写。
+        """
+        pass
+
     def __le__(self, other):
         return self.priority <= other.priority
 
@@ -114,19 +141,41 @@ class TrainCallback(BaseCallback):
     """
     实现了一般训练过程中的函数函数回调，主要将 on_begin() / on_end() 方法分发到各具体的回调方法中
     """
+    _begin_hooks = {
+        "train": "on_train_begin",
+        "train_epoch": "on_train_epoch_begin",
+        "train_batch": "on_train_batch_begin",
+        "test": "on_test_begin",
+        "eval": "on_eval_begin",
+    }
+    _end_hooks = {
+        "train": "on_train_end",
+        "train_epoch": "on_train_epoch_end",
+        "train_batch": "on_train_batch_end",
+        "test": "on_test_end",
+        "eval": "on_eval_end",
+    }
+
+    def _dispatch_hook(self, func_name: str, generic: str, hooks: dict):
+        if getattr(type(self), generic) is not getattr(TrainCallback, generic):
+            # on_begin() / on_end() itself was overridden, so it must see every call
+            return getattr(self, generic)
+
+        hook_name = hooks.get(func_name, None)
+        if hook_name is None or getattr(type(self), hook_name) is getattr(TrainCallback, hook_name):
+            return None
+        return getattr(self, hook_name)
+
+    def _dispatch_begin(self, func_name: str):
+        return self._dispatch_hook(func_name, "on_begin", TrainCallback._begin_hooks)
+
+    def _dispatch_end(self, func_name: str):
+        return self._dispatch_hook(func_name, "on_end", TrainCallback._end_hooks)
 
     def on_begin(self, trainer: Trainer, func, params: Params, *args, **kwargs):
-        if func.__name__ == "train":
-            self.on_train_begin(trainer, func, params, *args, **kwargs)
-        elif func.__name__ == "train_epoch":
-            self.on_train_epoch_begin(trainer, func, params, *args, **kwargs)
-        elif func.__name__ == "train_batch":
-            self.on_train_batch_begin(trainer, func, params, *args, **kwargs)
-        elif func.__name__ == "test":
-            self.on_test_begin(trainer, func, params, *args, **kwargs)
-        elif func.__name__ == "eval":
-            self.on_eval_begin(trainer, func, params, *args, **kwargs)
-        # elif func.__name__ in ""
+        hook_name = TrainCallback._begin_hooks.get(func.__name__, None)
+        if hook_name is not None:
+            getattr(self, hook_name)(trainer, func, params, *args, **kwargs)
 
     def on_initial_end(self, trainer: Trainer, func, params: Params, meter: Meter, *args, **kwargs):
         pass
@@ -147,16 +196,9 @@ class TrainCallback(BaseCallback):
         pass
 
     def on_end(self, trainer: Trainer, func, params: Params, meter, *args, **kwargs):
-        if func.__name__ == "train":
-            self.on_train_end(trainer, func, params, meter, *args, **kwargs)
-        elif func.__name__ == "train_epoch":
-            self.on_train_epoch_end(trainer, func, params, meter, *args, **kwargs)
-        elif func.__name__ == "train_batch":
-            self.on_train_batch_end(trainer, func, params, meter, *args, **kwargs)
-        elif func.__name__ == "test":
-            self.on_test_end(trainer, func, params, meter, *args, **kwargs)
-        elif func.__name__ == "eval":
-            self.on_eval_end(trainer, func, params, meter, *args, **kwargs)
+        hook_name = TrainCallback._end_hooks.get(func.__name__, None)
+        if hook_name is not None:
+            getattr(self, hook_name)(trainer, func, params, meter, *args, **kwargs)
 
     def on_train_end(self, trainer: Trainer, func, params: Params, meter: Meter, *args, **kwargs):
         pass
@@ -212,8 +254,17 @@ class LoggerCallback(TrainCallback):
     only_main_process = True
     priority = 100
 
-    def __init__(self, avg=True):
+    def __init__(self, avg=True, inline_per_step=10):
+        """
+        Args:
+            avg: 是否输出 epoch 内的均值
+            inline_per_step: 每多少个 batch 刷新一次行内输出。读取 meter 中的 tensor 会导致 device 同步，
+                因此不在每个 batch 都刷新。
+        """
         self.avg = avg
+        self.inline_per_step = max(inline_per_step, 1)
+        self._inline_count = 0
+        self._epoch_step = 0
 
     def on_hooked(self, trainer: Trainer, params: Params):
         super().on_hooked(trainer, params)
@@ -246,11 +297,19 @@ class LoggerCallback(TrainCallback):
 
         if self.avg:
             self.meter = AvgMeter()
+        # 从 epoch 中间的 checkpoint 恢复时，跳过的 batch 也计入行内进度，使计数与 params.global_step 对齐
+        accum_steps = params.get('accum_steps', 1) or 1
+        skipped = getattr(trainer, '_resume_batches', 0) // accum_steps
+        self._epoch_step = params.global_step - skipped
+        self._inline_count = skipped
+        self._inline_meter = None
         self.epochtime = TimeIt()
         self.epochtime.start()
         trainer.logger.info("{}/{}".format(params.eidx, params.epoch))
 
     def on_train_epoch_end(self, trainer: Trainer, func, params: Params, meter: Meter, *args, **kwargs):
+        if self._inline_meter is not None and self._inline_count % self.inline_per_step != 0:
+            self._log_inline(trainer)
         self.traintime.mark("epoch")
         self.epochtime.end()
         if self.cur is None:
@@ -265,6 +324,9 @@ class LoggerCallback(TrainCallback):
         tm.epoch = format_second(self.epochtime["use"])
         tm.avg = format_second(avg)
         tm.last = format_second(last)
+        wait_time = getattr(trainer.train_dataloader, 'wait_time', None)
+        if wait_time is not None:
+            tm.data_wait = "{:.2f}s".format(wait_time)
         trainer.logger.info(tm)
 
         super().on_train_epoch_end(trainer, func, params, meter, *args, **kwargs)
@@ -276,7 +338,18 @@ class LoggerCallback(TrainCallback):
             if self.avg:
                 self.meter.update(meter)
                 meter = self.meter
-        trainer.logger.inline("{}/{}".format(params.idx + 1, len(trainer.train_dataloader)), meter, fix=1)
+        self._inline_meter = meter
+        # params.global_step has been increased before the batch callbacks
+        self._inline_count = params.global_step - self._epoch_step
+        if self._inline_count % self.inline_per_step == 0:
+            self._log_inline(trainer)
+
+    def _log_inline(self, trainer: Trainer):
+        # with gradient accumulation, train_batch callbacks are called once per optimizer step
+        accum_steps = trainer.params.get('accum_steps', 1) or 1
+        total = (len(trainer.train_dataloader) + accum_steps - 1) // accum_steps
+        trainer.logger.inline("{}/{}".format(self._inline_count, total),
+                              self._inline_meter, fix=1)
 
     def on_first_exception(self, trainer: Trainer, func, params: Params, e: BaseException, *args, **kwargs):
         trainer.logger.error("{} raised".format(e.__class__.__name__))
@@ -302,15 +375,25 @@ class ModelCheckpoint(TrainCallback):
     """
     用于检视训练过程中模型的某个指标，并根据其提升进行 checkpoint 类型的保存
     该类参考了 Keras 中相应的实现。
+
+    keep_best 不为 None 时，改为保留该指标最优的 keep_best 个 checkpoint：
+    只要当前的指标能进入前 keep_best 个就会保存，旧的 checkpoint 由 trainer.saver.retention 负责删除，见 RetentionPolicy
     """
     only_main_process = True
 
-    def __init__(self, monitor, mode="train", lower=True, start_epoch=0):
+    def __init__(self, monitor, mode="train", lower=True, start_epoch=0, keep_best=None):
         self.monitor = monitor
         self.mode = mode
         self.lower = lower
         self.last_val = NoneItem()
         self.start_epoch = start_epoch
+        self.keep_best = keep_best
+
+    def on_hooked(self, trainer: Trainer, params: Params):
+        super().on_hooked(trainer, params)
+        if self.keep_best is not None:
+            trainer.saver.retention.keep_best = self.keep_best
+            trainer.saver.retention.lower = self.lower
 
     def on_train_epoch_end(self, trainer: Trainer, func, params: Params, meter: Meter, *args, **kwargs):
         self.update("train", trainer, params, meter)
@@ -325,6 +408,13 @@ class ModelCheckpoint(TrainCallback):
             if isinstance(item, NoneItem):
                 return
 
+            if self.keep_best is not None:
+                saver = trainer.saver
+                if saver.retention.is_best(saver.manifest.entries, item):
+                    trainer.logger.info("{} = {}, in the best {}".format(self.monitor, item, self.keep_best))
+                    trainer.save_checkpoint(meter.serialize(), metric=item)
+                return
+
             if self.lower:
                 if self.last_val > item:
                     trainer.logger.info("model imporved from {} to {}".format(self.last_val, item))
@@ -343,7 +433,7 @@ class ModelCheckpoint(TrainCallback):
         self.update("eval", trainer, params, meter)
 
     def __repr__(self) -> str:
-        return self._repr_by_val("monitor", "mode", "lower", "start_epoch")
+        return self._repr_by_val("monitor", "mode", "lower", "start_epoch", "keep_best")
 
 
 class TimingCheckpoint(TrainCallback):
@@ -532,3 +622,119 @@ class ReportSche(TrainCallback):
         for k, v in self.sche_lis:
             m[k] = v(params.eidx)
         trainer.logger.info(m)
+
+
+class ProfileCallback(TrainCallback):
+    """
+    以 time.perf_counter_ns 统计训练过程中每个 step 的时间分布，包括：
+        data_wait: 等待 train_dataloader 产生当前 batch 的时间
+        train_batch: trainer.train_batch 本身的执行时间（不包含回调）
+        step: 相邻两次 train_batch 开始之间的时间，即一个 step 的总耗时
+        <CallbackName>.<hook_name>: 其他回调中每个钩子的执行时间
+
+    每个 epoch 结束时（下一个 epoch 开始或训练结束时），将各项的 count/total/mean/p50/p90/p99/max（单位 ms）
+    作为一行 json 追加到实验目录下的 profile.v1.jsonl 中，可以通过 `thexp profile <test_name>` 查看。
+
+    计时是通过在 Trainer 构建的回调列表中插入计时包裹实现的，每个钩子仅多两次 perf_counter_ns 调用，
+    开销足够低，可以在正式训练中保持开启。
+    """
+    priority = -100
+
+    def __init__(self, percentiles=(50, 90, 99)):
+        self.percentiles = tuple(percentiles)
+        self.fn = None
+        self._records = defaultdict(list)
+        self._eidx = None
+        self._step_start = None
+        self._compute_start = 0
+
+    def on_hooked(self, trainer: Trainer, params: Params):
+        if trainer.experiment is not None:
+            self.fn = trainer.experiment.add_profile()[_PLUGIN_KEY.PROFILE.fn]
+            trainer.experiment.regist_exit_hook(lambda *_: self.flush())
+        # wrap the callbacks which have been hooked before
+        trainer._rebuild_callback_dispatch()
+
+    def _instrument_dispatch(self, func_name: str, begins: list, ends: list):
+        begins[:] = [self._timed(hook) for hook in begins]
+        ends[:] = [self._timed(hook) for hook in ends]
+        if func_name == 'train_batch':
+            begins.append(self._compute_begin)
+            ends.insert(0, self._compute_end)
+        elif func_name == 'train_epoch':
+            begins.insert(0, self._epoch_begin)
+        elif func_name == 'train':
+            ends.append(self._train_end)
+
+    def _timed(self, hook):
+        owner = getattr(hook, '__self__', None)
+        if owner is self or getattr(hook, '_profiled', False):
+            return hook
+        key = "{}.{}".format(owner.__class__.__name__, getattr(hook, '__name__', 'hook'))
+        records = self._records[key]
+        perf_counter_ns = time.perf_counter_ns
+
+        @wraps(hook)
+        def timed(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return hook(*args, **kwargs)
+            finally:
+                records.append(perf_counter_ns() - start)
+
+        timed._profiled = True
+        return timed
+
+    def _compute_begin(self, trainer: Trainer, func, params: Params, *args, **kwargs):
+        now = time.perf_counter_ns()
+        records = self._records
+        if self._step_start is not None:
+            records['step'].append(now - self._step_start)
+        self._step_start = now
+        records['data_wait'].append(getattr(trainer.train_dataloader, 'last_wait_ns', 0))
+        self._compute_start = time.perf_counter_ns()
+
+    def _compute_end(self, trainer: Trainer, func, params: Params, meter: Meter, *args, **kwargs):
+        self._records['train_batch'].append(time.perf_counter_ns() - self._compute_start)
+
+    def _epoch_begin(self, trainer: Trainer, func, params: Params, *args, **kwargs):
+        self.flush()
+        self._eidx = params.eidx
+
+    def _train_end(self, trainer: Trainer, func, params: Params, meter: Meter, *args, **kwargs):
+        self.flush()
+
+    def summary(self) -> dict:
+        """返回当前还未写入文件的记录的统计结果，key 为计时项，value 为各统计量（ms）"""
+        res = {}
+        for key, values in self._records.items():
+            if len(values) == 0:
+                continue
+            values = np.array(values, dtype=np.int64) / 1e6
+            stat = {
+                'count': len(values),
+                'total': float(values.sum()),
+                'mean': float(values.mean()),
+            }
+            for q, v in zip(self.percentiles, np.percentile(values, self.percentiles)):
+                stat['p{}'.format(q)] = float(v)
+            stat['max'] = float(values.max())
+            res[key] = stat
+        return res
+
+    def flush(self):
+        """将当前 epoch 的统计结果追加到 profile 文件中，并清空记录"""
+        stats = self.summary()
+        # clear in place, the timing wrappers hold references of these lists
+        for values in self._records.values():
+            values.clear()
+        self._step_start = None
+        if len(stats) == 0 or self.fn is None:
+            return stats
+        with open(self.fn, 'a', encoding='utf-8') as w:
+            w.write(json.dumps({'eidx': self._eidx, 'stats': stats}))
+            w.write('\n')
+        return stats
+
+    def __repr__(self) -> str:
+        return self._repr_by_val("priority", "percentiles")
@@ -1,12 +1,132 @@
 """
 
 """
+import inspect
+import queue
+import threading
+import time
 from collections import OrderedDict
-from itertools import cycle, chain
+from itertools import chain
 from typing import Optional, overload, Union
 import torch
 
-from thexp.contrib.device import to_device
+from thexp.contrib.device import to_device, pin_memory, record_stream
+from thexp.utils import random
+
+
+def cycle(loader):
+    """
+    无限循环迭代 loader。
+
+    和 itertools.cycle 不同，每一轮结束后会重新调用 iter(loader)，而不是缓存并重放第一轮产生的所有 batch，
+    因此内存占用不会随 loader 的大小增长，DataLoader 的 shuffle 在每一轮也会重新生效。
+    如果 DataLoader 创建时指定了 persistent_workers=True，worker 进程会在每一轮之间保持存活。
+    """
+    while True:
+        empty = True
+        for batch in loader:
+            empty = False
+            yield batch
+        if empty:  # avoid endless loop on an empty loader, the same as itertools.cycle
+            return
+
+
+def _accepts_non_blocking(fn) -> bool:
+    """判断 to_device_fn 是否能接收 non_blocking 参数，用户自定义的函数一般只接收 (batch, device)"""
+    if fn is to_device:
+        return True
+    try:
+        params = inspect.signature(fn).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    return any(p.name == 'non_blocking' or p.kind == p.VAR_KEYWORD for p in params)
+
+
+class _Prefetcher:
+    """
+    在后台线程中提前从 iterator 中读取 batch，并（如果需要）将其转移到 device 上，最多缓存 depth 个 batch。
+
+    device 为 cuda 时，会先 pin memory，再在一个独立的 cuda stream 中以 non_blocking 的方式转移，
+    主线程取出 batch 时再等待相应的 event，从而使数据的转移和当前 batch 的计算重叠。
+    non_blocking 只会传给能接收该参数的 to_device_fn，否则以 to_device_fn(batch, device) 的方式调用。
+    device 为 cpu 或 None 时，只进行预读取。
+    """
+    _end = object()
+
+    class _Raised:
+        def __init__(self, exc):
+            self.exc = exc
+
+    def __init__(self, iterator, depth, device=None, to_device_fn=to_device):
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._device = device
+        self._to_device_fn = to_device_fn
+        self._non_blocking = _accepts_non_blocking(to_device_fn)
+        self._cuda = device is not None and device.type == 'cuda' and torch.cuda.is_available()
+        self._thread = threading.Thread(target=self._run, args=(iterator,), daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, iterator):
+        try:
+            stream = torch.cuda.Stream(self._device) if self._cuda else None
+            for batch in iterator:
+                if self._stop.is_set():
+                    return
+                event = None
+                if self._cuda:
+                    with torch.cuda.stream(stream):
+                        if self._non_blocking:
+                            batch = self._to_device_fn(pin_memory(batch), self._device, non_blocking=True)
+                        else:
+                            batch = self._to_device_fn(batch, self._device)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                elif self._device is not None:
+                    batch = self._to_device_fn(batch, self._device)
+
+                if not self._put((batch, event)):
+                    return
+        except BaseException as e:
+            self._put(_Prefetcher._Raised(e))
+            return
+        self._put(_Prefetcher._end)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self._queue.get()
+        if item is _Prefetcher._end:
+            raise StopIteration()
+        if isinstance(item, _Prefetcher._Raised):
+            raise item.exc
+
+        batch, event = item
+        if event is not None:
+            current = torch.cuda.current_stream(self._device)
+            current.wait_event(event)
+            record_stream(batch, current)
+        return batch
+
+    def close(self):
+        """stop the background thread and release the cached batches"""
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread.join()
 
 
 class DataBundler:
@@ -36,6 +156,10 @@ class DataBundler:
         self.iter_mode = "chain"
         self._to_device_fn = to_device_fn
         self.device_arg = None
+        self.device = None
+        self.prefetch_depth = 0
+        self.wait_time = 0  # seconds spent on waiting data in the last iteration
+        self.last_wait_ns = 0  # nanoseconds spent on waiting the last batch
         if device is not None:
             self.to(device)
 
@@ -51,23 +175,39 @@ class DataBundler:
     def __iter__(self):
         loaders = self._func_loader()
         if len(loaders) == 1:
-            iter = loaders[0]
+            batches = loaders[0]
             # for batch in loaders[0]:
             #     yield batch
             # return iter(loaders[0])
         elif self.iter_mode == "zip":
-            iter = zip(*loaders)
+            batches = zip(*loaders)
         elif self.iter_mode == "chain":
-            iter = chain(*loaders)
+            batches = chain(*loaders)
         else:
             assert False
 
-        for batch_data in iter:
-            # from .utils import to_device
-            if self.device_arg is not None:
-                yield self._to_device_fn(batch_data, self.device_arg)
-            else:
+        if self.prefetch_depth > 0:
+            batches = _Prefetcher(iter(batches), self.prefetch_depth, self.device, self._to_device_fn)
+        elif self.device is not None:
+            batches = (self._to_device_fn(batch_data, self.device) for batch_data in batches)
+        else:
+            batches = iter(batches)
+
+        self.wait_time = 0
+        try:
+            while True:
+                start = time.perf_counter_ns()
+                try:
+                    batch_data = next(batches)
+                except StopIteration:
+                    break
+                self.last_wait_ns = time.perf_counter_ns() - start
+                self.wait_time += self.last_wait_ns / 1e9
                 yield batch_data
+        finally:
+            # called when the epoch ends or is stopped by trainer.stop_current_epoch()
+            if isinstance(batches, _Prefetcher):
+                batches.close()
 
     def _append(self, loader, func, name):
         from torch.utils.data import DataLoader
@@ -87,12 +227,8 @@ class DataBundler:
             loader.to(*self.device_arg[0], **self.device_arg[1])
 
     def _func_loader(self):
-        def filter(loader):
-            if isinstance(loader, DataBundler):
-                return iter(loader)
-            return loader
-
-        return [func(filter(loader)) for name, (loader, func) in self.dataloaders.items()]
+        # pass loaders themselves (not iterators), so that cycle() can re-iterate them in every round
+        return [func(loader) for name, (loader, func) in self.dataloaders.items()]
 
     def set_batch_size(self, batch_size):
         from torch.utils.data import DataLoader
@@ -120,6 +256,69 @@ class DataBundler:
             res[name] = len(loader)
         return res
 
+    @staticmethod
+    def _resumable_sampler(loader):
+        from thexp.contrib.data.sampler import ResumableSampler
+        for sampler in [getattr(loader, 'sampler', None), getattr(loader.batch_sampler, 'sampler', None)]:
+            if isinstance(sampler, ResumableSampler):
+                return sampler
+        return None
+
+    @property
+    def resumable(self) -> bool:
+        """是否所有的 DataLoader 都使用了 ResumableSampler"""
+        return len(self.dataloaders) > 0 and all(
+            not isinstance(loader, DataBundler) and self._resumable_sampler(loader) is not None
+            for loader, _ in self.dataloaders.values())
+
+    def sampler_state_dict(self, batches: int) -> dict:
+        """
+        从本次迭代开始读取了 batches 个 batch 时，各个使用 ResumableSampler 的 DataLoader 的采样位置，
+        通过 load_sampler_state_dict() 恢复后，下一次迭代将从第 batches 个 batch 开始；
+        batches 不小于 len(self) 时，下一次迭代将从头开始
+        """
+        res = {}
+        remain = batches
+        for name, (loader, func) in self.dataloaders.items():
+            sampler = self._resumable_sampler(loader) if not isinstance(loader, DataBundler) else None
+            num = len(loader)
+            if self.iter_mode == 'zip' or len(self.dataloaders) == 1:
+                consumed = batches
+            else:
+                consumed = min(remain, num)
+                remain -= consumed
+            if sampler is None:
+                continue
+
+            if consumed == 0 or batches >= len(self):
+                res[name] = sampler.state_dict()
+                continue
+            # loaders added by cycle() may have been iterated for several rounds
+            consumed = consumed - num * ((consumed - 1) // num)
+            state = sampler.state_dict(consumed * loader.batch_sampler.batch_size)
+            if func is cycle and consumed == num:
+                # an empty round would stop cycle(), start the next round directly
+                state.update(epoch=state['epoch'] + 1, offset=0)
+            # otherwise a finished loader in chain mode yields nothing in the resumed iteration
+            res[name] = state
+        return res
+
+    def load_sampler_state_dict(self, state_dict: dict, rng_state=None):
+        """
+        Args:
+            rng_state: 不为 None 时，在中断的 DataLoader 开始迭代时恢复该随机数状态（见 ResumableSampler.rng_state），
+                从而与中断前 DataLoader 创建 iterator 时消耗的随机数保持一致
+        """
+        for name, state in state_dict.items():
+            if name not in self.dataloaders:
+                continue
+            sampler = self._resumable_sampler(self.dataloaders[name][0])
+            sampler.load_state_dict(state)
+            if rng_state is not None and state['offset'] < len(sampler):
+                sampler.rng_state, rng_state = rng_state, None
+        if rng_state is not None:
+            random.set_state(rng_state, fix_cudnn=False)
+
     def cycle(self, loader, name=None):
         """
 
@@ -156,11 +355,23 @@ class DataBundler:
             device = args[0]
         assert isinstance(device, (torch.device, str))
         self.device_arg = [args, kwargs]
+        self.device = torch.device(device)
         for (loader, _) in self.dataloaders.values():
             if isinstance(loader, DataBundler):
                 loader.to(*args, **kwargs)
         return self
 
+    def prefetch(self, depth=2):
+        """
+        在后台线程中预先读取至多 depth 个 batch，并将其转移到 to() 所指定的 device 上，
+        使数据的读取、collate 和转移与 train_batch 的计算重叠。depth=0 时关闭预读取。
+
+        迭代结束或提前退出（如 trainer.stop_current_epoch()）时，后台线程会被关闭。
+        每次迭代中主线程等待数据的总时间（秒）记录在 wait_time 中。
+        """
+        self.prefetch_depth = depth
+        return self
+
     def choice_batch(self) -> tuple:
         return next(iter(self))
 
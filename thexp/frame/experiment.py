@@ -3,11 +3,13 @@ import json
 import os
 import re
 import sys
+import threading
 import warnings
 from collections import namedtuple
 
 from thexp.globals import _CONFIGL, _GITKEY, _FNAME, _OS_ENV, _PLUGIN_KEY, _BUILTIN_PLUGIN, _PLUGIN_DIRNAME
 from thexp.utils.dates import curent_date
+from thexp.utils.paths import atomic_dump_json
 
 from .configs import globs
 
@@ -15,6 +17,25 @@ test_dir_pt = re.compile("[0-9]{4}\.[a-z0-9]{7}")
 exception = namedtuple('exception_status', ['exc_type', 'exc_value', 'exc_tb'])
 
 
+def _read_lines(fn) -> list:
+    if not os.path.exists(fn):
+        return []
+    with open(fn, 'r', encoding='utf-8') as r:
+        return [i.strip() for i in r.readlines()]
+
+
+def _write_if_changed(fn, content: str):
+    """内容不同时才写入，通过临时文件和重命名完成，并发读取时不会读到被清空的文件"""
+    if os.path.exists(fn):
+        with open(fn, 'r', encoding='utf-8') as r:
+            if r.read() == content:
+                return
+    tmp_fn = "{}.tmp{}".format(fn, os.getpid())
+    with open(tmp_fn, 'w', encoding='utf-8') as w:
+        w.write(content)
+    os.replace(tmp_fn, fn)
+
+
 class Experiment:
     """
     用于目录管理和常量配置管理
@@ -38,6 +59,8 @@ class Experiment:
 
         self._repo = None
         self._commit = None
+        self._commit_future = None  # the snapshot committed in background, see commit
+        self._fingerprint = None
 
         self._end_state = False  # 是否试验已结束
         self._exc_dict = None  # type:exception
@@ -49,8 +72,14 @@ class Experiment:
         self._plugins = {}
 
         self._in_main = True
+        self._init_flush()
         self._initial()
 
+    def _init_flush(self):
+        self._dirty = False  # whether the changes haven't been written to info.json
+        self._lock = threading.RLock()
+        self._flush_stop = None
+
     def __getstate__(self):
         res = {
             '_start_time': self._start_time,
@@ -99,7 +128,10 @@ class Experiment:
 
         self._repo = None
         self._commit = Commit(self.repo, hex_to_bin(state['_commit']))
+        self._commit_future = None
+        self._fingerprint = None
         self._config = globs
+        self._init_flush()
 
     def disable_write(self):
         self._in_main = False
@@ -118,9 +150,8 @@ class Experiment:
             注册 系统退出 回调
             注册 repository
             注册 实验
-            提交
+            提交（在后台线程中进行，见 commit）
         """
-        from thexp.utils.repository import commit as git_commit
         if self._start_time is None:
             self._start_time = curent_date(self._time_fmt)
             sys.excepthook = self.exc_end
@@ -131,9 +162,10 @@ class Experiment:
 
             # 目录下所有thexp项目
             if _OS_ENV.THEXP_COMMIT_DISABLE not in os.environ:
-                git_commit(self.repo, _GITKEY.commit_key, branch_name=_GITKEY.thexp_branch)
+                self._start_commit()
 
-            self._write()
+            # written at the first flush(), so that the snapshot can be committed meanwhile
+            self._dirty = True
         else:
             warnings.warn("start the same experiment twice is not suggested.")
 
@@ -141,41 +173,34 @@ class Experiment:
         """
         在相应位置注册当前实验保存的项目级别的路径（project_dir）与该repo的相应位置，便于回溯。
 
-        共在三个位置添加相应关系（每次都会确认，未添加会添加，添加则覆盖）
+        共在三个位置添加相应关系（每次都会确认，未添加或不同时会写入，已添加则跳过）
 
         :param exp_repo:  Exprepo对象
         :return:
         """
 
         # 在全局添加 项目下实验存储路径与相应repo的关系，由此可以存储所有的实验存储目录
-        from thexp.utils.paths import home_dir
+        # 该文件被所有项目的所有试验共享，已记录时不再写入，需要写入时通过文件锁和原子替换避免并发时丢失记录或写坏文件
+        from thexp.utils.paths import home_dir, load_json, locked_json
         global_repofn = os.path.join(home_dir(), _FNAME.repo)
-        if os.path.exists(global_repofn):
-            with open(global_repofn, 'r', encoding='utf-8') as r:
-                res = json.load(r)
-        else:
-            res = {}
-        res[self.project_dir] = self.repo.working_dir
-        with open(global_repofn, 'w', encoding='utf-8') as w:
-            json.dump(res, w)
+        if load_json(global_repofn, {}).get(self.project_dir, None) != self.repo.working_dir:
+            with locked_json(global_repofn) as res:
+                res[self.project_dir] = self.repo.working_dir
 
         # 在项目级别的实验存储目录下写下相应 repo ，用于方便获取
         local_repofn = os.path.join(self.project_dir, _FNAME.repopath)
-        with open(local_repofn, 'w', encoding='utf-8') as w:
-            w.write(self.repo.working_dir)
+        _write_if_changed(local_repofn, self.repo.working_dir)
 
         # 在repo目录下记录所用过的实验存储路径到 .expsdirs，方便回溯
         repo_expdirfn = os.path.join(self.repo.working_dir, _FNAME.expsdirs)
-        if os.path.exists(repo_expdirfn):
-            with open(repo_expdirfn, 'r', encoding='utf-8') as r:
-                _expsdirs = [i.strip() for i in r.readlines()]
-        else:
-            _expsdirs = []
-
-        if self.expsdir not in _expsdirs:
-            _expsdirs.append(self.expsdir)
-            with open(repo_expdirfn, 'w', encoding='utf-8') as w:
-                w.write("\n".join(_expsdirs))
+        if self.expsdir not in _read_lines(repo_expdirfn):
+            from thexp.utils.paths import file_lock
+            # lock file is put in .git/ so that it won't appear in the working tree
+            with file_lock(os.path.join(self.repo.git_dir, 'thexp-expsdirs.lock')):
+                _expsdirs = _read_lines(repo_expdirfn)
+                if self.expsdir not in _expsdirs:
+                    _expsdirs.append(self.expsdir)
+                    _write_if_changed(repo_expdirfn, "\n".join(_expsdirs))
 
     def _regist_exp(self):
         """
@@ -186,37 +211,83 @@ class Experiment:
         """
         # 在 exp_dir 下存储对应的 repo 路径
         local_repofn = os.path.join(self.exp_dir, _FNAME.repopath)
-        with open(local_repofn, 'w', encoding='utf-8') as w:
-            w.write(self.repo.working_dir)
+        _write_if_changed(local_repofn, self.repo.working_dir)
 
-    def _write(self, **extra):
-        """将试验状态写入试验目录中的 info.json """
-        if self._end_state:
-            return
+    def _write(self, _final=False, **extra):
+        """
+        将试验状态写入试验目录中的 info.json，通过临时文件和重命名完成，不会留下写了一半的文件。
+        _final=True 时为结束时的写入，此后（包括正在等待锁的定时写入）不会再写入该文件。
+        """
         if not self._in_main:
             return
-        res = dict(
-            repo=self.repo.working_dir,
-            argv=sys.argv,
-            exp_name=self._exp_name,
-            exp_dir=self.exp_dir,
-            test_name=os.path.basename(self.test_dir),
-            test_dir=self.test_dir,
-            root_dir=self.expsdir,
-            project_name=self.project_name,
-            project_iname=os.path.basename(self.project_dir),
-            project_dir=self.project_dir,
-            commit_hash=self.commit_hash,
-            short_hash=self.test_hash,
-            dirs=self._hold_dirs,
-            time_fmt=self._time_fmt,
-            start_time=self._start_time,
-            tags=self._tags,
-            plugins=self._plugins,
-            **extra,
-        )
-        with open(self.test_info_fn, 'w', encoding='utf-8') as w:
-            json.dump(res, w, indent=2)
+        with self._lock:
+            # checked under the lock, a flush waiting for it must not overwrite the end state
+            if self._end_state:
+                return
+            res = dict(
+                repo=self.repo.working_dir,
+                argv=sys.argv,
+                exp_name=self._exp_name,
+                exp_dir=self.exp_dir,
+                test_name=os.path.basename(self.test_dir),
+                test_dir=self.test_dir,
+                root_dir=self.expsdir,
+                project_name=self.project_name,
+                project_iname=os.path.basename(self.project_dir),
+                project_dir=self.project_dir,
+                commit_hash=self.commit_hash,
+                short_hash=self.test_hash,
+                dirs=self._hold_dirs,
+                time_fmt=self._time_fmt,
+                start_time=self._start_time,
+                tags=self._tags,
+                plugins=self._plugins,
+                **extra,
+            )
+            atomic_dump_json(res, self.test_info_fn)
+            self._dirty = False
+            if _final:
+                self._end_state = True
+            # a snapshot, the dicts in res may be modified by add_tag() etc. once the lock is released
+            info = json.loads(json.dumps(res))
+            info_mtime = os.stat(self.test_info_fn).st_mtime_ns
+        # not under the lock: waiting for the index (e.g. a running query) should not block add_tag() etc.
+        self._update_index(info, info_mtime)
+
+    def _update_index(self, info: dict, info_mtime: int):
+        """
+        更新 Q 使用的索引，只等待很短的时间，失败时（如 sqlite 不可用或被其他进程锁住）只给出警告，
+        查询时会根据修改时间重新读取
+        """
+        from thexp.utils.index import TestIndex, INDEX_ERRORS
+        try:
+            with TestIndex(timeout=1) as index:
+                index.update(self.test_dir, info, info_mtime)
+        except INDEX_ERRORS as e:
+            warnings.warn('failed to update the test index: {}'.format(e))
+
+    def flush(self):
+        """
+        将 add_tag() / add_plugin() 等方法的修改写入 info.json，没有修改时不会写入。
+
+        这些方法只会标记修改，实际的写入只发生在：Trainer.initial() 结束时、试验结束（end()，退出时会自动调用）时、
+        以及 start_flush_timer() 开启的定时写入中，从而避免在启动阶段多次重写该文件。
+        """
+        if self._dirty:
+            self._write()
+
+    def start_flush_timer(self, interval: float):
+        """在后台线程中每隔 interval 秒调用一次 flush()，试验结束时停止"""
+        if self._flush_stop is not None or not self._in_main:
+            return
+        self._flush_stop = threading.Event()
+
+        def run(stop):
+            while not stop.wait(interval):
+                self.flush()
+
+        threading.Thread(target=run, args=(self._flush_stop,), daemon=True,
+                         name='thexp-exp-flush').start()
 
     @property
     def repo(self):
@@ -225,11 +296,35 @@ class Experiment:
             self._repo = load_repo()
         return self._repo
 
+    def _start_commit(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from thexp.utils.repository import commit as git_commit
+        executor = ThreadPoolExecutor(1, thread_name_prefix='thexp-git')
+        self._commit_future = executor.submit(git_commit, self.repo, _GITKEY.commit_key,
+                                              branch_name=_GITKEY.thexp_branch, fingerprint=self.fingerprint)
+        executor.shutdown(wait=False)
+
+    @property
+    def fingerprint(self) -> str:
+        """工作区文件的 stat 指纹，见 utils.repository.stat_fingerprint()"""
+        from thexp.utils.repository import stat_fingerprint
+        if self._fingerprint is None:
+            self._fingerprint = stat_fingerprint(self.repo)
+        return self._fingerprint
+
     @property
     def commit(self):
+        """
+        当前试验的代码快照，在 _initial() 中由后台线程开始提交，第一次获取时等待其完成
+        """
         from thexp.utils.repository import commit as git_commit
         if self._commit is None:
-            self._commit = git_commit(self.repo, _GITKEY.commit_key, branch_name=_GITKEY.thexp_branch)
+            if self._commit_future is not None:
+                future, self._commit_future = self._commit_future, None
+                self._commit = future.result()
+            else:
+                self._commit = git_commit(self.repo, _GITKEY.commit_key, branch_name=_GITKEY.thexp_branch,
+                                          fingerprint=self.fingerprint)
         return self._commit
 
     @property
@@ -291,8 +386,7 @@ class Experiment:
         if self._exp_dir is None:
             self._exp_dir = os.path.join(self.project_dir, self._exp_name)
             os.makedirs(self._exp_dir, exist_ok=True)
-            with open(os.path.join(self._exp_dir, _FNAME.repopath), 'w', encoding='utf-8') as w:
-                w.write(self.repo.working_dir)
+            _write_if_changed(os.path.join(self._exp_dir, _FNAME.repopath), self.repo.working_dir)
         return self._exp_dir
 
     @property
@@ -301,30 +395,47 @@ class Experiment:
         获取当前 exp 目录下的 test_dir
         命名方式： 通过 序号.hash 的方式命名每一次实验
         会进行一系列判断保证在硬盘中的任何位置不会出现同名试验
-        其中，hash 保证在不同时间运行的试验文件名不同，序号保证在同一进程运行的多次试验文件名不同
+        其中，hash 为代码快照的 commit 的前 8 位（即 short_hash），保证在不同时间运行的试验文件名不同，
+        序号保证在同一进程运行的多次试验文件名不同
         {:04d}.{hash}
 
         Returns: 一个全局唯一的test_dir，(绝对路径)
 
         Notes:
-            命名时还会确保存储路径下不会存在相同的序号（在生成时如果有相同序号则一直+1），方法为
-            第一次获取试验目录时记录生成的序号，之后所有的序号都在此基础上生成，但如果 exp 目录变更，则
+            序号通过 exp 目录下的计数文件（.testcount）分配：在 .lock 的文件锁下读取并更新计数，
+            再用 os.mkdir（不使用 exist_ok）创建目录，目录已存在时序号 +1 重试。
+            因此同时启动的多个试验也不会得到相同的目录，且不需要列出整个 exp 目录（只在计数文件不存在时列出一次）。
         """
         if self._test_dir is None:
-            fs = os.listdir(self.exp_dir)
-
-            if Experiment.count != 0:  # 如果
-                i = self.count + 1
-            else:
+            from thexp.utils.paths import file_lock
+            if Experiment.count == 0:
                 atexit.register(final_report)
-                i = len([f for f in fs if re.search(test_dir_pt, f) is not None]) + 1
 
-            cf_set = {f.split('.')[0] for f in fs}  # 首位元素永远存在，不需要判断其他文件
-            while "{:04d}".format(i) in cf_set:
-                i += 1
-
-            self._test_dir = os.path.join(self.exp_dir, "{:04d}.{}".format(i, self.test_hash))
-            os.makedirs(self._test_dir, exist_ok=True)
+            # waits for the background snapshot, outside the lock
+            test_hash = self.test_hash
+            with file_lock(os.path.join(self.exp_dir, _FNAME.lock)):
+                count_fn = os.path.join(self.exp_dir, _FNAME.test_count)
+                if os.path.exists(count_fn):
+                    with open(count_fn, 'r') as r:
+                        i = int(r.read().strip() or 0) + 1
+                else:  # directories created before the counter file was introduced
+                    i = max([int(f.split('.')[0]) for f in os.listdir(self.exp_dir)
+                             if re.search(test_dir_pt, f) is not None and f.split('.')[0].isdigit()],
+                            default=0) + 1
+                i = max(i, Experiment.count + 1)
+
+                while True:
+                    test_dir = os.path.join(self.exp_dir, "{:04d}.{}".format(i, test_hash))
+                    try:
+                        os.mkdir(test_dir)
+                        break
+                    except FileExistsError:
+                        i += 1
+
+                with open(count_fn, 'w') as w:
+                    w.write(str(i))
+
+            self._test_dir = test_dir
             Experiment.count = i
             Experiment.whole_tests.append(os.path.basename(self._test_dir))
 
@@ -346,7 +457,9 @@ class Experiment:
         """
         d = os.path.join(self.test_dir, name)
         os.makedirs(d, exist_ok=True)
-        self._hold_dirs.append(name)
+        with self._lock:
+            self._hold_dirs.append(name)
+            self._dirty = True
         return d
 
     def make_exp_dir(self, name) -> str:
@@ -368,7 +481,10 @@ class Experiment:
         :param extra:
         :return:
         """
+        if self._flush_stop is not None:
+            self._flush_stop.set()
         self._write(
+            _final=True,
             end_time=curent_date(self._time_fmt),
             end_code=end_code,
             **extra
@@ -402,8 +518,9 @@ class Experiment:
         :param plugins:
         :return:
         """
-        self._tags[name] = plugins
-        self._write()
+        with self._lock:
+            self._tags[name] = plugins
+            self._dirty = True
 
     def add_plugin(self, key: str, value: dict = None):
         """
@@ -419,8 +536,9 @@ class Experiment:
         """
         if value is None:
             value = {}
-        self._plugins[key] = value
-        self._write()
+        with self._lock:
+            self._plugins[key] = value
+            self._dirty = True
 
     def add_params(self, params):
         """
@@ -504,6 +622,19 @@ class Experiment:
         self.add_plugin(_BUILTIN_PLUGIN.rnd, kwargs)
         return kwargs
 
+    def add_profile(self):
+        """
+        ```python
+        kwargs = exp.add_profile()
+        fn = kwargs['fn'] # ProfileCallback 每个 epoch 向该文件追加一行 json
+        ```
+        """
+        kwargs = {
+            _PLUGIN_KEY.PROFILE.fn: os.path.join(self.test_dir, _FNAME.profile)
+        }
+        self.add_plugin(_BUILTIN_PLUGIN.profile, kwargs)
+        return kwargs
+
     def config_items(self):
         """
         三个等级的配置文件的内容
@@ -2,6 +2,7 @@
 Used for recording data
 """
 from collections import OrderedDict
+from functools import lru_cache
 from numbers import Number
 from typing import Any, Iterable
 
@@ -10,6 +11,41 @@ import torch
 
 from ..base_classes.trickitems import AvgItem, NoneItem
 
+_raw_types = frozenset({int, float, bool, str})
+
+
+@lru_cache()
+def _formatter(kind: str, acc: int = None):
+    """
+    返回格式化函数，同一种 (kind, acc) 的格式化函数在所有 Meter 之间共享，不会为每个 key 重新创建
+    """
+    if kind == 'int':
+        return "{:.0f}".format
+    elif kind == 'float':
+        return "{{:.{}f}}".format(acc).format
+    elif kind == 'percent':
+        return "{{:.{}%}}".format(acc).format
+    elif kind == 'tensorfloat':
+        fmt = "{{:.{}f}}".format(acc)
+
+        def func(x: torch.Tensor):
+            if len(x.shape) == 0:
+                return fmt.format(x)
+            else:
+                return fmt.format(x.item())
+
+        return func
+    elif kind == 'str_in_line':
+        def func(x):
+            l = str(x).split("\n")
+            if len(l) > 1:
+                return "{}...".format(l[0])
+            else:
+                return l[0]
+
+        return func
+    raise KeyError(kind)
+
 
 class Meter:
     """
@@ -34,7 +70,7 @@ class Meter:
         self._convert_type = []
 
     def int(self, item: str):
-        self._format_dict[item] = lambda x: "{:.0f}".format(x)
+        self._format_dict[item] = _formatter('int')
 
     def float(self, key: str, acc=4):
         """
@@ -46,35 +82,23 @@ class Meter:
         Returns:
 
         """
-        self._format_dict[key] = lambda x: "{{:.{}f}}".format(acc).format(x)
+        self._format_dict[key] = _formatter('float', acc)
 
     def percent(self, key: str, acc=2):
-        self._format_dict[key] = lambda x: "{{:.{}%}}".format(acc).format(x)
+        self._format_dict[key] = _formatter('percent', acc)
 
     def tensorfloat(self, key: str, acc=4):
-        def func(x: torch.Tensor):
-            if len(x.shape) == 0:
-                return "{{:.{}f}}".format(acc).format(x)
-            else:
-                return "{{:.{}f}}".format(acc).format(x.item())
-
-        self._format_dict[key] = func
+        self._format_dict[key] = _formatter('tensorfloat', acc)
 
     def str_in_line(self, key: str):
-        def func(x):
-            l = str(x).split("\n")
-            if len(l) > 1:
-                return "{}...".format(l[0])
-            else:
-                return l[0]
-
-        self._format_dict[key] = func
+        self._format_dict[key] = _formatter('str_in_line')
 
     def add_format_type(self, type, func):
-        self._convert_type.append((type, func))
+        if (type, func) not in self._convert_type:
+            self._convert_type.append((type, func))
 
     def _convert(self, val):
-        if type(val) in {int, float, bool, str}:
+        if type(val) in _raw_types or not self._convert_type:
             return val
         # elif isinstance(val, torch.Tensor):
         #     if len(val.shape) == 1 and val.shape[0] == 1:
@@ -177,9 +201,60 @@ class Meter:
         return self
 
 
+class _DeviceAvgItem(AvgItem):
+    """
+    在 tensor 原本所在的 device 上累积的 AvgItem，update() 时不会触发 device 同步和拷贝，
+    只有在读取 item / avg 时才会转换为 numpy，转换结果会被缓存直到下一次 update()。
+    cpu 上的 tensor 不存在同步的问题，会直接转换为 numpy 累积。
+
+    读取得到的数值和类型与先 detach().cpu().numpy() 再 update() 的 AvgItem 相同。
+    """
+
+    __slots__ = ('_cache',)
+
+    def __init__(self, weight=1) -> None:
+        super().__init__(weight)
+        self._cache = None
+
+    def update(self, other, weight=1):
+        if isinstance(other, torch.Tensor):
+            other = other.detach()
+            if other.device.type == 'cpu':
+                # no device sync for cpu tensors, and numpy is faster for scalar arithmetic
+                other = other.numpy()
+        # not inplace, dtype of the sum may be promoted by later values
+        self._sum = self._sum + other * self._weight
+        self._count += self._weight
+        self._item = other
+        self._cache = None
+
+    def _materialize(self):
+        if self._cache is None:
+            item, sum_ = self._item, self._sum
+            if isinstance(item, torch.Tensor):
+                item = item.cpu().numpy()
+            if isinstance(sum_, torch.Tensor):
+                sum_ = sum_.cpu().numpy()
+            self._cache = (item, sum_)
+        return self._cache
+
+    @property
+    def item(self):
+        return self._materialize()[0]
+
+    @property
+    def avg(self):
+        if self._count == 0:
+            return 0
+        return self._materialize()[1] / self._count
+
+
 class AvgMeter(Meter):
     """
+    对每个 key 记录的值求均值的 Meter
 
+    标量 tensor 会以 tensor 的形式在其原本的 device 上累积，仅当通过 avg / serialize() / numeral_items()
+    等方式读取时才会转换为数字，因此每个 step 都 update 一次不会导致 device 同步。
     """
 
     def __init__(self):
@@ -191,29 +266,36 @@ class AvgMeter(Meter):
         elif name.endswith("_"):
             assert False
         else:
-            value = self._convert(value)
-            if isinstance(value, int) and name not in self._format_dict:
+            self._set_value(name, value)
+
+    def _set_value(self, name: str, value: Any):
+        value = self._convert(value)
+        if name not in self._format_dict:
+            if isinstance(value, int):
                 self.int(name)
-            elif isinstance(value, float) and name not in self._format_dict:
+            elif isinstance(value, float):
                 self.float(name)
 
-            if name in self._meter_dict and isinstance(self._meter_dict[name], AvgItem):
-                self._meter_dict[name].update(value)
-            elif isinstance(value, (float)):
-                if name not in self._meter_dict:
-                    self._meter_dict[name] = AvgItem()
-                self._meter_dict[name].update(value)
-            elif isinstance(value, (torch.Tensor, np.ndarray)):
+        item = self._meter_dict.get(name, None)
+        if isinstance(item, AvgItem):
+            if isinstance(value, torch.Tensor) and not isinstance(item, _DeviceAvgItem):
+                value = value.detach().cpu().numpy()
+            item.update(value)
+        elif isinstance(value, (float)):
+            if item is None:
+                item = self._meter_dict[name] = AvgItem()
+            item.update(value)
+        elif isinstance(value, (torch.Tensor, np.ndarray)):
+            if len(value.shape) == 0 or sum(value.shape) == 1:
+                if item is None:
+                    item = self._meter_dict[name] = _DeviceAvgItem()
+                item.update(value)
+            else:
                 if isinstance(value, torch.Tensor):
                     value = value.detach().cpu().numpy()
-                if len(value.shape) == 0 or sum(value.shape) == 1:
-                    if name not in self._meter_dict:
-                        self._meter_dict[name] = AvgItem()
-                    self._meter_dict[name].update(value)
-                else:
-                    self._meter_dict[name] = value
-            else:
                 self._meter_dict[name] = value
+        else:
+            self._meter_dict[name] = value
 
     def __getitem__(self, item) -> AvgItem:
         return super().__getitem__(item)
@@ -223,13 +305,16 @@ class AvgMeter(Meter):
     def update(self, meter):
         if meter is None:
             return
+        # keys in meter are already checked by Meter.__setattr__
         for k, v in meter._meter_dict.items():
-            self[k] = v
+            self._set_value(k, v)
         self._format_dict.update(meter._format_dict)
-        self._convert_type.extend(meter._convert_type)
+        for convert_type in meter._convert_type:
+            if convert_type not in self._convert_type:
+                self._convert_type.append(convert_type)
 
     def average(self, k):
-        self[k] = AvgItem()
+        self[k] = _DeviceAvgItem()
 
     def serialize(self):
         log_dict = OrderedDict()
@@ -264,6 +349,24 @@ class AvgMeter(Meter):
             elif isinstance(v, AvgItem):
                 yield k, v.avg
 
+    def mean_meter(self) -> Meter:
+        """
+        返回一个新的 Meter，其中被平均的值（AvgItem）替换为当前的均值，其余的值保持最新值。
+
+        用于将多个 micro-batch 的 Meter 归约为一个 step 的 Meter（见 params.accum_steps），
+        在 device 上累积的 tensor 求均值后仍然是 device 上的 tensor，不会引起同步。
+        """
+        res = Meter()
+        res._format_dict.update(self._format_dict)
+        res._convert_type.extend(self._convert_type)
+        for k, v in self._meter_dict.items():
+            if isinstance(v, AvgItem):
+                if v._count == 0:
+                    continue
+                v = v._sum / v._count
+            res._meter_dict[k] = v
+        return res
+
     @property
     def meter(self):
         """try to get newest value"""
@@ -286,7 +389,7 @@ class _InMeter():
         res = self._avg._meter_dict[item]
         if isinstance(res, AvgItem):
             if self._mode == 'newest':
-                res = res._item
+                res = res.item
             else:
                 res = res.avg
 
@@ -11,9 +11,6 @@ from collections.abc import Iterable
 from datetime import timedelta
 from typing import Any, overload
 
-import fire
-import torch
-
 from ..base_classes.attr import attr
 from ..base_classes.defaults import default
 from ..base_classes.errors import BoundCheckError, NewParamWarning
@@ -22,6 +19,9 @@ from ..utils.environ import ENVIRON_
 from ..calculate import schedule
 from ..decorators.deprecated import deprecated
 
+# Params.device 的默认值在第一次被读取时才确定，见 Params._resolve_defaults()
+_DEFAULT_DEVICE = object()
+
 
 class BaseParams(OptimMixin):
     ENV = ENVIRON_
@@ -59,6 +59,7 @@ class BaseParams(OptimMixin):
         return item in self._param_dict
 
     def __getstate__(self):
+        self._resolve_defaults()
         return {
             '_param_dict': self._param_dict,
             '_repeat': self._repeat,
@@ -111,6 +112,7 @@ class BaseParams(OptimMixin):
         return self._param_dict.__getattr__(item)
 
     def __repr__(self):
+        self._resolve_defaults()
         return "{}".format(self.__class__.__name__) + pp.pformat([(k, v) for k, v in self._param_dict.items()])
 
     __str__ = __repr__
@@ -139,6 +141,10 @@ class BaseParams(OptimMixin):
     def initial(self):
         pass
 
+    def _resolve_defaults(self):
+        """在参数被整体读取（序列化、hash、复制等）前确定延迟计算的默认值"""
+        pass
+
     def arange(self, k, default, left=float("-inf"), right=float("inf")):
         """
         constrain value within a continuous interval.
@@ -214,6 +220,7 @@ class BaseParams(OptimMixin):
             yield res
 
     def _copy(self):
+        self._resolve_defaults()
         res = BaseParams()
         res._param_dict = copy.copy(self._param_dict)
         res._repeat = copy.copy(self._repeat)
@@ -259,6 +266,7 @@ class BaseParams(OptimMixin):
                             k))
                 self[k] = v
 
+        import fire
         fire.Fire(func)
         return self
 
@@ -291,6 +299,7 @@ class BaseParams(OptimMixin):
             json.dump(self.inner_dict.jsonify(), w, indent=2)
 
     def items(self):
+        self._resolve_defaults()
         return self._param_dict.items()
 
     def keys(self):
@@ -319,6 +328,7 @@ class BaseParams(OptimMixin):
         Returns:
 
         """
+        self._resolve_defaults()
         return self._param_dict.hash()
 
     def lock(self):
@@ -332,6 +342,7 @@ class BaseParams(OptimMixin):
 
     @property
     def inner_dict(self) -> attr:
+        self._resolve_defaults()
         return self._param_dict
 
     def get(self, k, default=None):
@@ -399,7 +410,8 @@ class Params(BaseParams):
         self.eidx = 1
         self.idx = 0
         self.global_step = 0
-        self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        # "cuda:0" if torch.cuda.is_available() else "cpu", torch is imported when it is read
+        self.device = _DEFAULT_DEVICE
         self.device_ids = []
         self.dataset = None
         self.architecture = None
@@ -412,6 +424,16 @@ class Params(BaseParams):
         self.local_rank = -1  # if not -1, means will use
         self.init_method = 'env://'
 
+    def __getattr__(self, item):
+        if item == 'device':
+            self._resolve_defaults()
+        return super().__getattr__(item)
+
+    def _resolve_defaults(self):
+        if self._param_dict.get('device', None) is _DEFAULT_DEVICE:
+            import torch
+            self._param_dict['device'] = "cuda:0" if torch.cuda.is_available() else "cpu"
+
     def enable_distribution(self):
         pass
 
@@ -0,0 +1,119 @@
+"""
+checkpoint 的保留策略，见 Saver.retention
+"""
+import json
+import os
+from typing import List
+
+_MANIFEST_FN = 'checkpoints.v1.json'
+
+
+class RetentionPolicy:
+    """
+    决定 Saver 保存的 checkpoint（不包括 keypoint 和 model）中哪些需要被删除，以下规则同时生效，被任一规则保留的 checkpoint 都会被保留：
+        keep_last: 保留最近保存的 keep_last 个
+        keep_best: 保留保存时指定的 metric 最优的 keep_best 个，lower=True 时越小越好
+        keep_every: epoch 为 keep_every 的倍数时，该 checkpoint 会被永久保留
+
+    Args:
+        keep_last:
+        keep_best:
+        lower:
+        keep_every: 为 0 时不生效
+    """
+
+    def __init__(self, keep_last=3, keep_best=0, lower=True, keep_every=0):
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.lower = lower
+        self.keep_every = keep_every
+
+    def is_pinned(self, epoch: int) -> bool:
+        return self.keep_every > 0 and epoch % self.keep_every == 0
+
+    def _best(self, entries: dict) -> List[str]:
+        scored = [fn for fn, entry in entries.items() if entry['metric'] is not None]
+        scored.sort(key=lambda fn: entries[fn]['metric'], reverse=not self.lower)
+        return scored[:self.keep_best]
+
+    def prune(self, entries: dict) -> List[str]:
+        """
+        Args:
+            entries: 未被永久保留的 checkpoint，{fn: entry}，按保存顺序排列
+
+        Returns:
+            需要删除的 checkpoint
+        """
+        fns = list(entries)
+        keep = set(fns[max(len(fns) - self.keep_last, 0):])
+        if self.keep_best > 0:
+            keep.update(self._best(entries))
+        return [fn for fn in fns if fn not in keep]
+
+    def is_best(self, entries: dict, metric) -> bool:
+        """metric 是否能进入 entries 中最优的 keep_best 个，用来避免保存一个会被立即删除的 checkpoint"""
+        if self.keep_best <= 0 or metric is None:
+            return False
+        best = self._best(entries)
+        if len(best) < self.keep_best:
+            return True
+        worst = entries[best[-1]]['metric']
+        return metric < worst if self.lower else metric > worst
+
+    def __repr__(self) -> str:
+        return "RetentionPolicy(keep_last={}, keep_best={}, lower={}, keep_every={})".format(
+            self.keep_last, self.keep_best, self.lower, self.keep_every)
+
+
+class CheckpointManifest:
+    """
+    记录 Saver 保存的 checkpoint（文件名、epoch、metric 以及保存顺序），保存在 <ckpt_dir>/checkpoints.v1.json 中。
+    保留策略只需要读写该文件，不需要列出目录或读取文件的时间。
+
+    永久保留的 checkpoint（pinned）单独记录，之后的保存不会再检查它们，
+    因此 entries 中的数量不会超过 keep_last + keep_best + 1，每次保存的判断都是常数时间。
+    """
+
+    def __init__(self, ckpt_dir):
+        self.fn = os.path.join(ckpt_dir, _MANIFEST_FN)
+        self.entries = {}  # fn -> entry
+        self.pinned = {}
+        self.seq = 0
+        if os.path.exists(self.fn):
+            with open(self.fn, 'r', encoding='utf-8') as r:
+                content = json.load(r)
+            self.seq = content['seq']
+            # drop checkpoints removed by hand
+            for key in ['entries', 'pinned']:
+                getattr(self, key).update(
+                    (entry['fn'], entry) for entry in content[key]
+                    if os.path.exists(os.path.join(ckpt_dir, entry['fn'])))
+
+    def add(self, fn: str, epoch: int, metric=None, pinned=False):
+        self.discard(fn)
+        entry = {'fn': fn, 'epoch': epoch, 'metric': None if metric is None else float(metric), 'seq': self.seq}
+        self.seq += 1
+        if pinned:
+            self.pinned[fn] = entry
+        else:
+            self.entries[fn] = entry
+
+    def discard(self, fn: str) -> bool:
+        return (self.entries.pop(fn, None) or self.pinned.pop(fn, None)) is not None
+
+    def fns(self) -> List[str]:
+        """所有记录的 checkpoint，最近保存的在前"""
+        entries = list(self.entries.values()) + list(self.pinned.values())
+        entries.sort(key=lambda entry: entry['seq'], reverse=True)
+        return [entry['fn'] for entry in entries]
+
+    def state(self) -> dict:
+        return {
+            'seq': self.seq,
+            'entries': list(self.entries.values()),
+            'pinned': list(self.pinned.values()),
+        }
+
+    def clear(self):
+        self.entries.clear()
+        self.pinned.clear()
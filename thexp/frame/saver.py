@@ -1,17 +1,188 @@
 """
 
 """
+import atexit
+import copy
 import json
 import os
 import re
+import shutil
+import uuid
+import weakref
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
-from ..utils.paths import listdir_by_time
+from .blobstore import BlobStore, PackRef, find_refs, ref_root, resolve_refs
+from .retention import CheckpointManifest, RetentionPolicy
+from ..utils.paths import listdir_by_time, atomic_dump_json
 import torch
 
 ckpt_tuple = namedtuple("Checkpoint", ["checkpoint", 'info'])
 
+_INDEX_FN = 'index.json'
+_META_FN = '__meta__.pt'
+_DELTA_DIRNAME = 'deltas'
+
+# 所有开启了 async_save 的 Saver，进程退出前统一 flush；弱引用，不会让 Saver 常驻内存
+_async_savers = weakref.WeakSet()
+
+
+def _flush_all():
+    for saver in list(_async_savers):
+        saver.flush()
+
+
+atexit.register(_flush_all)
+
+
+def _cpu_snapshot(obj):
+    """递归地将 state_dict 中的 tensor 复制到 cpu 内存中，其余可变对象深拷贝，使之后对原对象的修改不影响快照"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return obj.__class__((k, _cpu_snapshot(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return obj.__class__(_cpu_snapshot(v) for v in obj)
+    elif isinstance(obj, (int, float, str, bytes, bool, type(None))):
+        return obj
+    return copy.deepcopy(obj)
+
+
+def _replace(tmp_fn, fn):
+    """将写好的临时文件（或目录）重命名为 fn，fn 已存在时会被替换"""
+    if os.path.isdir(fn):
+        old_fn = "{}.old{}".format(fn, os.getpid())
+        os.replace(fn, old_fn)
+        os.replace(tmp_fn, fn)
+        shutil.rmtree(old_fn)
+    else:
+        if os.path.isdir(tmp_fn) and os.path.exists(fn):
+            os.remove(fn)
+        os.replace(tmp_fn, fn)
+
+
+def _atomic_save(obj, fn):
+    """先写入临时文件再重命名，文件要么不存在，要么是完整的"""
+    tmp_fn = "{}.tmp{}".format(fn, os.getpid())
+    torch.save(obj, tmp_fn)
+    _replace(tmp_fn, fn)
+
+
+def _tensor_index(obj, prefix: str, res: dict):
+    if isinstance(obj, torch.Tensor):
+        res[prefix] = {
+            'dtype': str(obj.dtype).replace('torch.', ''),
+            'shape': list(obj.shape),
+            'nbytes': obj.numel() * obj.element_size(),
+        }
+    elif isinstance(obj, dict):
+        for k, v in obj.items():
+            _tensor_index(v, "{}.{}".format(prefix, k) if prefix else str(k), res)
+    elif isinstance(obj, (list, tuple)):
+        for k, v in enumerate(obj):
+            _tensor_index(v, "{}.{}".format(prefix, k) if prefix else str(k), res)
+
+
+def _atomic_save_sharded(state_dict: dict, fn):
+    """
+    以目录的形式保存 state_dict：每个值为 dict 的 key（如 checkpoint 中的 model / optim / other / vector / plug）
+    作为一个 section 单独保存为一个文件，其余的值一起保存在 __meta__.pt 中。
+    index.json 记录了每个 section 的文件，以及其中每个 tensor 的 dtype / shape / nbytes。
+    """
+    tmp_fn = "{}.tmp{}".format(fn, os.getpid())
+    os.makedirs(tmp_fn)
+    index = {'version': 1, 'keys': [], 'sections': {}, 'meta': _META_FN}
+    meta = {}
+    for i, (k, v) in enumerate(state_dict.items()):
+        index['keys'].append(k)
+        if isinstance(v, dict):
+            file = "{:04d}.pt".format(i)
+            torch.save(v, os.path.join(tmp_fn, file))
+            tensors = {}
+            _tensor_index(v, '', tensors)
+            index['sections'][k] = {'file': file, 'tensors': tensors}
+        else:
+            meta[k] = v
+    torch.save(meta, os.path.join(tmp_fn, _META_FN))
+    with open(os.path.join(tmp_fn, _INDEX_FN), 'w', encoding='utf-8') as w:
+        json.dump(index, w, indent=2)
+    _replace(tmp_fn, fn)
+
+
+def _load(fn):
+    """通过 mmap 读取，tensor 的数据只有在被访问时才会从磁盘中读入"""
+    try:
+        return torch.load(fn, mmap=True, weights_only=False)
+    except RuntimeError:
+        # files saved by the legacy (non-zipfile) serialization can't be memory-mapped
+        return torch.load(fn, weights_only=False)
+
+
+def _weighted_sum(acc, obj, weight):
+    """acc += obj * weight，浮点类型以外的 tensor（如 num_batches_tracked）和其他值使用第一个"""
+    if isinstance(obj, torch.Tensor):
+        if not obj.is_floating_point():
+            return obj if acc is None else acc
+        if acc is None:
+            dtype = torch.float64 if obj.dtype == torch.float64 else torch.float32
+            return obj.to(dtype, copy=True).mul_(weight)
+        return acc.add_(obj.to(acc.dtype), alpha=weight)
+    elif isinstance(obj, dict):
+        if acc is not None and set(acc.keys()) != set(obj.keys()):
+            raise KeyError("keys mismatch: {}".format(set(acc.keys()) ^ set(obj.keys())))
+        return obj.__class__((k, _weighted_sum(None if acc is None else acc[k], v, weight)) for k, v in obj.items())
+    return obj if acc is None else acc
+
+
+def _weighted_mean(acc, ref, total):
+    """acc / total，并转换为 ref 中对应 tensor 的类型"""
+    if isinstance(ref, torch.Tensor):
+        if not ref.is_floating_point():
+            return acc.clone()
+        return acc.div_(total).to(ref.dtype)
+    elif isinstance(ref, dict):
+        return ref.__class__((k, _weighted_mean(acc[k], v, total)) for k, v in ref.items())
+    return acc
+
+
+def average_checkpoints(fns: List[str], fn: str, weights: List[float] = None) -> str:
+    """
+    对 fns 中模型的参数求（加权）平均，如 SWA 或 model soup，保存在 fn 中，可以通过 Trainer.load_model(fn) 读取。
+
+    fns 可以是 checkpoint（只会读取其中的 model 部分）或 save_model() 保存的模型。
+    文件逐个通过 mmap 读取，并逐个 tensor 地累加，因此内存中只需要保存一份累加结果，不需要同时读入所有文件。
+    浮点类型以外的 tensor（如 BatchNorm 的 num_batches_tracked）使用 fns 中第一个文件的值。
+
+    Args:
+        fns:
+        fn: 保存的文件名
+        weights: 每个文件的权重，默认相同
+
+    Returns:
+        fn
+    """
+    if len(fns) == 0:
+        raise ValueError("no checkpoint to average")
+    if weights is None:
+        weights = [1] * len(fns)
+    assert len(weights) == len(fns)
+
+    savers = {}
+    acc, state_dict = None, None
+    for ckpt_fn, weight in zip(fns, weights):
+        ckpt_dir = os.path.dirname(os.path.abspath(ckpt_fn))
+        if ckpt_dir not in savers:
+            savers[ckpt_dir] = Saver(ckpt_dir)
+        state_dict, _ = savers[ckpt_dir].load_model(ckpt_fn)
+        acc = _weighted_sum(acc, state_dict, weight)
+    state_dict = _weighted_mean(acc, state_dict, float(sum(weights)))
+
+    _atomic_save(state_dict, fn)
+    atomic_dump_json({'fn': fn, 'sources': [os.path.abspath(i) for i in fns], 'weights': weights},
+                      "{}.json".format(fn))
+    return fn
+
 
 class Saver:
     _ckpt_fn_templete = "{}{:06d}.ckpt"
@@ -19,11 +190,180 @@ class Saver:
     re_fn = re.compile("^[0-9]{7}\.ckpt$")
     re_keep_fn = re.compile("^keep.[0-9]{7}\.ckpt$")
 
-    def __init__(self, ckpt_dir, max_to_keep=3):
+    def __init__(self, ckpt_dir, max_to_keep=3, async_save=False, sharded=False, blob_dir=None,
+                 delta=False, compact_every=10):
+        """
+        Args:
+            ckpt_dir:
+            max_to_keep: 最多保留的 checkpoint 数量（不包括 keypoint 和 model），即 retention.keep_last，
+                更多的保留规则（metric 最优的 k 个、每 N 个 epoch 保留一个）见 RetentionPolicy，可以通过 saver.retention 修改
+            async_save: 为 True 时，save_* 方法只在当前线程中将 state_dict 复制到 cpu 内存，
+                序列化和写入（包括 blob_dir / delta 所需的 hash 计算）在后台线程中按顺序完成，
+                写入完成后才会根据 max_to_keep 删除旧的 checkpoint。
+                可以通过 flush() 等待所有写入完成，进程退出时也会自动调用。
+            sharded: 为 True 时，以目录的形式保存，state_dict 的每个部分单独保存为一个文件，
+                读取时可以通过 load_state_dict(fn, sections=[...]) 只读取需要的部分，见 _atomic_save_sharded()。
+                读取时会自动识别两种格式。
+            blob_dir: 不为 None 时，较大的 tensor 会按内容去重保存在该目录下（一般为实验级别的目录），
+                checkpoint 中只保存引用，见 BlobStore。删除 checkpoint 时，不再被引用的 tensor 会被删除。
+            delta: 为 True 时，save_checkpoint() / save_keypoint() 只保存自上一次保存以来发生变化的 tensor，
+                未变化的部分引用之前保存的内容，见 _prepare_delta()。读取时会自动将它们组合为完整的 state_dict。
+            compact_every: delta=True 时，每保存 compact_every 次会完整保存一次（作为新的 base），
+                使更早的增量可以随旧的 checkpoint 一起被删除，读取时需要组合的文件数量也不会超过 compact_every。
+        """
         self.info = {}
         self.ckpt_dir = ckpt_dir
-        self.max_to_keep = max_to_keep
+        self.retention = RetentionPolicy(keep_last=max_to_keep)
+        self.async_save = async_save
+        self.sharded = sharded
+        self.blobs = BlobStore(blob_dir) if blob_dir is not None else None
+        self.deltas = BlobStore(os.path.join(ckpt_dir, _DELTA_DIRNAME)) if delta else None
+        self.compact_every = compact_every
+        self._delta_records = {}  # key path -> (hash, PackRef) of the last delta save
+        self._delta_saves = 0
+        self._executor = None
+        self._futures = []
+        self._pending = set()  # files which are being written in background
         os.makedirs(ckpt_dir, exist_ok=True)
+        self.manifest = CheckpointManifest(ckpt_dir)
+        if not os.path.exists(self.manifest.fn):
+            # checkpoints saved before the manifest was introduced
+            fs = [i for i in os.listdir(ckpt_dir) if re.search(Saver.re_fn, i) is not None]
+            fs.sort(key=lambda i: os.path.getmtime(os.path.join(ckpt_dir, i)))
+            for i in fs:
+                self.manifest.add(i, int(i[1:7]))
+        if async_save:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thexp-saver')
+            _async_savers.add(self)
+
+    @property
+    def max_to_keep(self):
+        return self.retention.keep_last
+
+    @max_to_keep.setter
+    def max_to_keep(self, value):
+        self.retention.keep_last = value
+
+    def _write(self, fn, state_dict, extra_info: dict, prune: tuple = None, delta=False):
+        store, missing = None, None
+        if delta and self.deltas is not None:
+            # unchanged tensors need not to be written
+            store = self.deltas
+            state_dict, missing = self._prepare_delta(state_dict, fn)
+        elif self.blobs is not None:
+            # tensors which are already in the blob store need not to be written
+            store = self.blobs
+            state_dict, missing = self.blobs.prepare(state_dict, fn)
+
+        old_refs = set()
+        if store is not None:
+            if os.path.exists(fn):
+                old_refs = self._find_refs(fn)
+            store.commit(missing)
+        if self.sharded:
+            _atomic_save_sharded(state_dict, fn)
+        else:
+            _atomic_save(state_dict, fn)
+        if len(old_refs) > 0:
+            # fn is replaced, release the blobs which are not used anymore
+            self._release_refs(fn, old_refs - find_refs(state_dict))
+        atomic_dump_json(extra_info, "{}.json".format(fn))
+        if prune is not None:
+            removed, manifest = prune
+            for i in removed:
+                self._remove(os.path.join(self.ckpt_dir, i))
+            atomic_dump_json(manifest, self.manifest.fn)
+
+    def _prepare_delta(self, state_dict, fn):
+        """
+        将 state_dict 中较大的 tensor 替换为 PackRef。
+        通过 tensor 内容的 hash 判断其自上一次保存以来是否发生变化（通过 .data 的 in-place 修改不会改变 tensor 的版本号，
+        因此不能依赖版本号），变化的 tensor 保存在本次新建的 pack 中，未变化的 tensor 引用之前的 pack，不需要复制或写入。
+
+        Returns:
+            (manifest, missing): manifest 保存在 fn 中，missing 为需要写入的 pack
+        """
+        compact = self._delta_saves % self.compact_every == 0
+        pack_id = uuid.uuid4().hex
+        root = self.deltas.rel_root(fn)
+        changed, records = {}, {}
+
+        def replace(obj, path):
+            if isinstance(obj, torch.Tensor):
+                if obj.numel() * obj.element_size() < self.deltas.min_bytes:
+                    return obj
+                hash = BlobStore.hash_tensor(obj)
+                record = self._delta_records.get(path, None)
+                if not compact and record is not None and record[0] == hash:
+                    ref = record[1]
+                else:
+                    changed[path] = obj
+                    ref = PackRef(pack_id, root, path)
+                records[path] = (hash, ref)
+                return ref
+            elif isinstance(obj, dict):
+                return obj.__class__((k, replace(v, path + (k,))) for k, v in obj.items())
+            elif isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+                return obj.__class__(replace(v, path + (i,)) for i, v in enumerate(obj))
+            return obj
+
+        manifest = replace(state_dict, ())
+        reused = {record[1].hash for record in records.values()} - {pack_id}
+        new = [pack_id] if len(changed) > 0 else []
+        if not self.deltas.add_refs(fn, reused, new):
+            # the previous checkpoints were removed, save the whole state_dict as a new base
+            self._delta_records, self._delta_saves = {}, 0
+            return self._prepare_delta(state_dict, fn)
+
+        self._delta_records = records
+        self._delta_saves += 1
+        return manifest, ({pack_id: changed} if len(changed) > 0 else {})
+
+    def _retain(self, fn, epoch, metric=None) -> tuple:
+        """将 fn 记录在 manifest 中，并根据 retention 决定需要删除的 checkpoint"""
+        self.manifest.add(os.path.basename(fn), epoch, metric, pinned=self.retention.is_pinned(epoch))
+        removed = self.retention.prune(self.manifest.entries)
+        for i in removed:
+            self.manifest.discard(i)
+        return removed, self.manifest.state()
+
+    def _submit(self, fn, state_dict, extra_info: dict, prune: tuple = None, delta=False):
+        if extra_info is None:
+            extra_info = dict()
+        extra_info["fn"] = fn
+
+        if self._executor is None:
+            self._write(fn, state_dict, extra_info, prune, delta)
+            return
+
+        # raise errors of finished writes as soon as possible
+        futures, self._futures = self._futures, []
+        for future in futures:
+            if future.done():
+                future.result()
+            else:
+                self._futures.append(future)
+
+        # hashing (blob_dir / delta) reads every tensor as well, it is done in the background on the snapshot
+        state_dict, extra_info = _cpu_snapshot(state_dict), copy.deepcopy(extra_info)
+        self._pending.add(fn)
+        future = self._executor.submit(self._write, fn, state_dict, extra_info, prune, delta)
+        future.add_done_callback(lambda _: self._pending.discard(fn))
+        self._futures.append(future)
+
+    def flush(self):
+        """等待所有后台写入完成，如果写入过程中出现异常，会在这里抛出"""
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        """等待后台写入完成并关闭写入线程，之后的保存会退化为同步写入"""
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        _async_savers.discard(self)
 
     def _build_checkpoint_name(self, epoch=0, replacement: bool = False, lasting=False):
         i = 0
@@ -35,7 +375,7 @@ class Saver:
             return fn
 
         absfn = os.path.join(self.ckpt_dir, build_fn())
-        while replacement == False and os.path.exists(absfn):
+        while replacement == False and (os.path.exists(absfn) or absfn in self._pending):
             i += 1
             if i >= 9:
                 if lasting:
@@ -51,21 +391,13 @@ class Saver:
         fn = os.path.join(self.ckpt_dir, Saver._model_fn_templete.format(0, epoch))
         return fn
 
-    def _check_max_checkpoint(self):
-        fs = self.find_checkpoints()
-        while len(fs) > self.max_to_keep:
-            self.check_remove(fs[-1])
-            fs.pop()
-
     def find_checkpoints(self) -> List[str]:
         """
         find all checkpoint saved in the save dir.
         Returns:
+            按保存顺序排列，最近保存的在前
         """
-
-        fs = listdir_by_time(self.ckpt_dir)  # 按创建时间排序
-        fs = [os.path.join(self.ckpt_dir, i) for i in fs if re.search(Saver.re_fn, i) is not None]
-        return fs
+        return [os.path.join(self.ckpt_dir, i) for i in self.manifest.fns()]
 
     def find_models(self) -> List[str]:
         fs = listdir_by_time(self.ckpt_dir)  # 按创建时间排序
@@ -91,19 +423,11 @@ class Saver:
         :return:
         """
         fn = self._build_model_name(epoch)
-        json_fn = "{}.json".format(fn)
-        torch.save(state_dict, fn)
-
-        if extra_info is None:
-            extra_info = dict()
-        extra_info["fn"] = fn
-
-        with open(json_fn, "w", encoding="utf-8") as w:
-            json.dump(extra_info, w, indent=2)
+        self._submit(fn, state_dict, extra_info)
         return fn
 
     def save_checkpoint(self, epoch, state_dict, extra_info: dict = None, replacement: bool = False,
-                        lasting=False) -> str:
+                        lasting=False, metric=None) -> str:
         """
         命名格式为 {epoch}.ckpt ，如果replacement=True，则命名格式为 keep.{epoch}.ckpt
         :param epoch:
@@ -111,22 +435,12 @@ class Saver:
         :param extra_info: 额外信息，会以json格式保存在同模型名+ '.json'下
         :param replacement: 如果命名重复是否删除
         :param lasting: 是否受 max_to_keep 影响删除，默认为False
+        :param metric: 用于 retention.keep_best 的指标
         :return:
         """
         fn = self._build_checkpoint_name(epoch, replacement, lasting)
-
-        json_fn = "{}.json".format(fn)
-        torch.save(state_dict, fn)
-        if extra_info is None:
-            extra_info = dict()
-        extra_info["fn"] = fn
-
-        with open(json_fn, "w", encoding="utf-8") as w:
-            json.dump(extra_info, w, indent=2)
-
-        if not lasting:
-            self._check_max_checkpoint()
-
+        prune = None if lasting else self._retain(fn, epoch, metric)
+        self._submit(fn, state_dict, extra_info, prune=prune, delta=True)
         return fn
 
     def save_keypoint(self, val, state_dict, extra_info: dict = None, replacement: bool = False) -> str:
@@ -148,22 +462,40 @@ class Saver:
             return ckpt_tuple(None, None)
         return self.load_state_dict(fs[-1])
 
-    def load_state_dict(self, fn: str) -> ckpt_tuple:
+    def is_sharded(self, fn: str) -> bool:
+        return os.path.isdir(self._guess_abs_path(fn))
+
+    def read_index(self, fn: str) -> dict:
+        """返回以 sharded 格式保存的文件的 index，包括每个 section 的文件以及其中每个 tensor 的 dtype / shape / nbytes"""
+        path = self._guess_abs_path(fn)
+        if path in self._pending:
+            self.flush()
+        if not os.path.isdir(path):
+            return None
+        with open(os.path.join(path, _INDEX_FN), 'r', encoding='utf-8') as r:
+            return json.load(r)
+
+    def load_state_dict(self, fn: str, sections: List[str] = None) -> ckpt_tuple:
         """
 
         Args:
             fn: fn: rel path or abs path
+            sections: 只读取 state_dict 中的这些部分（如 ['model']），仅对 sharded 格式有效，
+                其余非 dict 的值（如 eidx）总会被读取。为 None 时读取全部。
 
         Returns:
             A namedtuple("Checkpoint", ["checkpoint", 'info']) instance, include two items, first item is a state_dict,
             second item is information attached when stored the state_dict
+
+        Notes:
+            tensor 通过 mmap 读取，只有在被访问时才会从磁盘读入。
         """
         path = self._guess_abs_path(fn)
+        if path in self._pending:
+            self.flush()
 
-        if os.path.exists(path):
-            ckpt = torch.load(fn)
-        else:
-            ckpt = None
+        ckpt = self._load_manifest(path, sections)
+        ckpt = resolve_refs(ckpt, path, _load)
         info_path = "{}.json".format(path)
         if os.path.exists(info_path):
             with open(info_path, 'r', encoding='utf-8') as r:
@@ -173,6 +505,61 @@ class Saver:
 
         return ckpt_tuple(ckpt, info)
 
+    def load_model(self, fn: str) -> ckpt_tuple:
+        """
+        读取模型的 state_dict，fn 可以是 save_model() 保存的模型，也可以是 checkpoint（.ckpt），此时只会读取其中的 model 部分
+        """
+        if fn.endswith('.ckpt'):
+            ckpt, info = self.load_state_dict(fn, sections=['model'])
+            return ckpt_tuple(ckpt['model'], info)
+        return self.load_state_dict(fn)
+
+    def average_checkpoints(self, fns: List[str] = None, weights: List[float] = None, fn: str = None) -> str:
+        """
+        对 fns（默认为 find_checkpoints() 中的所有 checkpoint）中的模型参数求平均，默认保存为 model.avg.pth，见 average_checkpoints()
+        """
+        self.flush()
+        if fns is None:
+            fns = self.find_checkpoints()
+        if fn is None:
+            fn = os.path.join(self.ckpt_dir, 'model.avg.pth')
+        return average_checkpoints(fns, fn, weights)
+
+    def _load_manifest(self, path, sections=None):
+        """读取文件，但不读取其中引用的 blob"""
+        if os.path.isdir(path):
+            index = self.read_index(path)
+            meta = _load(os.path.join(path, index['meta']))
+            ckpt = {}
+            for k in index['keys']:
+                if k in index['sections']:
+                    if sections is None or k in sections:
+                        ckpt[k] = _load(os.path.join(path, index['sections'][k]['file']))
+                else:
+                    ckpt[k] = meta[k]
+        elif os.path.exists(path):
+            ckpt = _load(path)
+        else:
+            ckpt = None
+        return ckpt
+
+    def _find_refs(self, fn) -> set:
+        try:
+            return find_refs(self._load_manifest(fn))
+        except Exception:  # not a checkpoint file
+            return set()
+
+    def _release_refs(self, fn, refs):
+        roots = {}
+        for ref in refs:
+            roots.setdefault(ref_root(ref, fn), []).append(ref.hash)
+        stores = {store.root: store for store in (self.blobs, self.deltas) if store is not None}
+        for root, hashes in roots.items():
+            if root in stores:
+                stores[root].release(fn, hashes)
+            elif os.path.isdir(root):
+                BlobStore(root).release(fn, hashes)
+
     def _guess_abs_path(self, fn: str) -> str:
         if os.path.basename(fn) == fn:
             path = os.path.join(self.ckpt_dir, fn)
@@ -181,8 +568,23 @@ class Saver:
         return path
 
     def check_remove(self, fn: str, with_json=True):
-        if os.path.exists(fn):
+        if os.path.dirname(os.path.abspath(fn)) == os.path.abspath(self.ckpt_dir):
+            self.flush()  # the manifest may be written by pending saves
+            if self.manifest.discard(os.path.basename(fn)):
+                atomic_dump_json(self.manifest.state(), self.manifest.fn)
+        self._remove(fn, with_json)
+
+    def _remove(self, fn: str, with_json=True):
+        refs = set()
+        if (self.blobs is not None or self.deltas is not None) and os.path.exists(fn):
+            # only checkpoints saved with blob_dir / delta have refs, others are not loaded just to be removed
+            refs = self._find_refs(fn)
+        if os.path.isdir(fn):
+            shutil.rmtree(fn)
+        elif os.path.exists(fn):
             os.remove(fn)
+        if len(refs) > 0:
+            self._release_refs(fn, refs)
         if with_json:
             jfn = "{}.json".format(fn)
             if os.path.exists(jfn):
@@ -195,8 +597,11 @@ class Saver:
             self.check_remove(os.path.join(self.ckpt_dir, i))
 
     def clear_checkpoints(self):
+        self.flush()
         for i in self.find_checkpoints():
-            self.check_remove(i)
+            self._remove(i)
+        self.manifest.clear()
+        atomic_dump_json(self.manifest.state(), self.manifest.fn)
 
     def clear_keypoints(self):
         fns = filter(lambda x: x.endswith(".ckpt") and x.startswith("keep."),
@@ -2,6 +2,7 @@
 
 """
 import bisect
+import contextlib
 import os
 import pprint as pp
 import warnings
@@ -20,9 +21,16 @@ from .meter import AvgMeter, Meter
 from .params import Params
 from .saver import Saver
 from ..base_classes.metaclasses import Merge
+from ..utils import random as rnd
 from ..globals import _BUILTIN_PLUGIN, _FNAME, _PLUGIN_DIRNAME, _PLUGIN_KEY, _OS_ENV
 
 
+_PRECISION_DTYPES = {
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
 def mp_agent(rank, self, op):
     import torch.distributed as dist
     self.params.local_rank = rank
@@ -40,6 +48,108 @@ def mp_agent(rank, self, op):
     op(self)
 
 
+class MicroBatches:
+    """
+    梯度累积时一个 optimizer step 所对应的 micro-batch 窗口，从共享的 enumerate(dataloader) 中按需读取，
+    迭代得到 (idx, batch_data, is_last)，窗口内最多同时持有两个 batch。
+    """
+
+    def __init__(self, batches: Iterator, first, accum_steps: int):
+        self._batches = batches
+        self._next = first
+        self._accum_steps = accum_steps
+        self.count = 0  # number of micro-batches read so far
+
+    def __iter__(self):
+        while self._next is not None:
+            idx, batch_data = self._next
+            self.count += 1
+            self._next = None
+            if self.count < self._accum_steps:
+                self._next = next(self._batches, None)
+            yield idx, batch_data, self._next is None
+
+    @staticmethod
+    def split(batches: Iterator, accum_steps: int, start: int = 0):
+        """将 enumerate(dataloader) 按 accum_steps 切分为窗口，迭代得到 (step_idx, MicroBatches)"""
+        batches = iter(batches)
+        for step_idx, first in enumerate(batches, start):
+            window = MicroBatches(batches, first, accum_steps)
+            yield step_idx, window
+            for _ in window:  # skip the micro-batches which were not consumed
+                pass
+
+
+class _OptimizerHook:
+    """
+    在一次 train_batch() 中接管 optimizers 的 step() / zero_grad()：
+        step: 为 False 时 step() 不生效（梯度累积中除最后一个 micro-batch 以外）
+        zero_grad: 为 False 时 zero_grad() 不生效
+        grad_scale: step() 生效前梯度会先除以该值
+        scaler: 不为 None 且 scaled() 为 True 时 step() 通过 scaler.step() 完成，并在退出时（如果进行过 step）调用 scaler.update()
+        scaled: 返回 loss 是否已经通过 scaler 缩放（即是否调用了 trainer.backward()），
+            直接调用 loss.backward() 时梯度没有被缩放，step() 不能经过 scaler，否则梯度会被错误地除以 scale
+    """
+
+    def __init__(self, optims, step=True, zero_grad=True, grad_scale=1, scaler=None, scaled=None):
+        self.optims = list(optims)
+        self.step = step
+        self.zero_grad = zero_grad
+        self.grad_scale = grad_scale
+        self.scaler = scaler
+        self.scaled = scaled
+        self.stepped = False  # whether scaler.step() was called
+        self._saved = []
+
+    def _hook_step(self, optim, step):
+        def hooked_step(*args, **kwargs):
+            if not self.step:
+                return None
+            if self.grad_scale > 1:
+                for group in optim.param_groups:
+                    for p in group['params']:
+                        if p.grad is not None:
+                            p.grad.div_(self.grad_scale)
+            if self.scaler is None:
+                return step(*args, **kwargs)
+            if self.scaled is not None and not self.scaled():
+                warnings.warn("precision='fp16' but the loss was not scaled, "
+                              "use self.backward(loss) instead of loss.backward() in train_batch()")
+                return step(*args, **kwargs)
+
+            self.stepped = True
+            # scaler.step() calls optim.step() itself
+            optim.step = step
+            try:
+                return self.scaler.step(optim, *args, **kwargs)
+            finally:
+                optim.step = hooked_step
+
+        return hooked_step
+
+    def __enter__(self):
+        hook_step = not self.step or self.grad_scale > 1 or self.scaler is not None
+        for optim in self.optims:
+            # keep the instance attributes which may be patched by others, e.g. lr_scheduler
+            self._saved.append((optim, {k: optim.__dict__[k] for k in ('step', 'zero_grad') if k in optim.__dict__}))
+            if hook_step:
+                optim.step = self._hook_step(optim, optim.step)
+            if not self.zero_grad:
+                optim.zero_grad = lambda *args, **kwargs: None
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for optim, saved in self._saved:
+            for k in ('step', 'zero_grad'):
+                if k in saved:
+                    optim.__dict__[k] = saved[k]
+                elif k in optim.__dict__:
+                    del optim.__dict__[k]
+        self._saved.clear()
+        if exc_type is None and self.stepped and self.scaler is not None:
+            self.scaler.update()
+
+
 class BaseTrainer(metaclass=Merge):
     __exp_name__ = None
     _call_backs = {
@@ -48,28 +158,33 @@ class BaseTrainer(metaclass=Merge):
         "regist_databundler", "train_batch", "test_eval_logic", "test_eval_logic_v2", "predict",
         "load_keypoint", "load_checkpoint", "load_model", "save_keypoint", "save_checkpoint", "save_model",
     }
+    # functions run under the autocast context of params.precision, see autocast()
+    _autocast_funcs = {"train_batch", "test_eval_logic_v2"}
 
     def __new__(cls, *args, **kwargs):
         self = super().__new__(cls)
         if cls.__exp_name__ is None:
             cls.__exp_name__ = cls.__name__.lower().replace("trainer", "Exp")
 
-        def wrapper(func, _call_set: list):
+        def wrapper(func, _call_set: list, _dispatch: tuple):
             """
             对每个 Trainer 的 _call_backs 类变量中定义的函数尝试绑定回调
             Args:
                 func:
-                _call_set:
+                _call_set: 所有已注册的 callback，仅在异常时遍历
+                _dispatch: (begin_hooks, end_hooks)，只包含真正重写了该函数相应钩子的回调方法，
+                    在 add_callback / remove_callback 时原地更新，见 _rebuild_callback_dispatch()
 
             Returns:
 
             """
+            _begins, _ends = _dispatch
 
             @wraps(func)
             def _newfunc(*aargs, **kkwargs):
                 """执行前回调 on_begin() 、执行后回调 on_end()、执行异常则回调 on_exception() """
-                for callback in _call_set:
-                    callback.on_begin(self, func, self.params, *aargs, **kkwargs)
+                for hook in _begins:
+                    hook(self, func, self.params, *aargs, **kkwargs)
                 try:
                     _meter = func(*aargs, **kkwargs)
                     # 如果返回迭代器，那么会消耗掉迭代器，并只返回最后一次运行的结果（如果有）
@@ -87,14 +202,43 @@ class BaseTrainer(metaclass=Merge):
                     else:
                         raise e
 
-                for callback in _call_set:
-                    callback.on_end(self, func, self.params, _meter, *aargs, **kkwargs)
+                for hook in _ends:
+                    hook(self, func, self.params, _meter, *aargs, **kkwargs)
                 return _meter
 
             return _newfunc
 
+        def autocast_wrapper(func, hook_optimizer: bool):
+            """在 params.precision 对应的 autocast 上下文中执行 func，fp16 时 optimizer 的 step() 会经过 grad_scaler"""
+
+            @wraps(func)
+            def _autocast_func(*aargs, **kkwargs):
+                if self._precision == 'fp32':
+                    return func(*aargs, **kkwargs)
+                with self.autocast():
+                    scaler = self.grad_scaler if hook_optimizer else None
+                    if scaler is None:
+                        return func(*aargs, **kkwargs)
+                    self._loss_scaled = False
+                    with _OptimizerHook(self._optim_dict.values(), scaler=scaler, scaled=lambda: self._loss_scaled):
+                        return func(*aargs, **kkwargs)
+
+            return _autocast_func
+
+        def progress_wrapper(func):
+            """func 返回后（on_train_batch_end 回调之前）推进 global_step 和 epoch 中的位置，见 _finish_batch()"""
+
+            @wraps(func)
+            def _train_batch(*aargs, **kkwargs):
+                _meter = func(*aargs, **kkwargs)
+                self._finish_batch()
+                return _meter
+
+            return _train_batch
+
         self._callback_set = []
         self._callback_name_set = set()
+        self._callback_dispatch = {}  # type:Dict[str,tuple]
 
         vars = dir(self)
         for name in vars:
@@ -106,7 +250,25 @@ class BaseTrainer(metaclass=Merge):
             if value is None:
                 continue
             if callable(value):
-                setattr(self, name, wrapper(value, self._callback_set))
+                raw = value
+                if name in self._autocast_funcs:
+                    value = autocast_wrapper(value, name == "train_batch")
+                if name == "train_batch":
+                    value = progress_wrapper(value)
+                dispatch = ([], [])
+                self._callback_dispatch[name] = dispatch
+                value = wrapper(value, self._callback_set, dispatch)
+                # the function without the wrappers above, user decorators are kept
+                value.__thexp_inner__ = raw
+                setattr(self, name, value)
+
+        if "train_batch" in self._callback_dispatch:
+            # 梯度累积时，每次 optimizer step 只触发一次 train_batch 的回调，见 train_epoch()
+            def train_batch(*aargs, **kkwargs):
+                return self._train_accum_batch(*aargs, **kkwargs)
+
+            self._accum_train_batch = wrapper(progress_wrapper(train_batch), self._callback_set,
+                                              self._callback_dispatch["train_batch"])
         return self
 
     def __init__(self, params: Params = None):
@@ -119,8 +281,16 @@ class BaseTrainer(metaclass=Merge):
         self.train_epoch_toggle = False
         self.train_toggle = False
         self.experiment = None
+        self._grad_scaler = None
+        self._loss_scaled = False  # whether the loss of the current train_batch() was scaled by backward()
+        self._precision = 'fp32'
+        self._epoch_batches = 0  # batches of the current epoch whose train_batch() has finished
+        self._read_batches = 0  # batches read from train_dataloader in the current epoch
+        self._unfinished = False  # whether the train_batch() called by train_epoch() has not finished
+        self._resume_batches = 0  # batches to skip in the next epoch, see load_checkpoint_dict()
         if params is not None:
             self.params = params
+            self._precision = self._check_precision(params)
             if isinstance(params.device, str):
                 _device = torch.device(params.device)
                 self.regist_device(_device)
@@ -161,6 +331,13 @@ class BaseTrainer(metaclass=Merge):
         self.train_toggle = state['train_toggle']
         self.params = state['params']
         self.experiment = state.get('experiment', None)
+        self._grad_scaler = None
+        self._loss_scaled = False
+        self._precision = self._check_precision(self.params)
+        self._epoch_batches = 0
+        self._read_batches = 0
+        self._unfinished = False
+        self._resume_batches = 0
 
     def __getstate__(self):
         res = {
@@ -212,6 +389,12 @@ class BaseTrainer(metaclass=Merge):
         self.models(self.params)
         self.datasets(self.params)
 
+        # plugins registered above are written to info.json at once, see Experiment.flush()
+        self.experiment.flush()
+        flush_interval = self.params.get('exp_flush_interval', 60)
+        if flush_interval:
+            self.experiment.start_flush_timer(flush_interval)
+
     def _regist_databundler(self, key, val):
         from torch.utils.data import DataLoader
         assert isinstance(val, (DataBundler, DataLoader))
@@ -262,19 +445,51 @@ class BaseTrainer(metaclass=Merge):
         while params.eidx < params.epoch + 1:
             self.train_epoch(params.eidx, params)
             params.eidx += 1
+            self._epoch_batches = self._read_batches = 0
             if self.train_toggle:
                 self.train_toggle = False
                 break
 
     def train_epoch(self, eidx: int, params: Params):
+        """
+        训练一个 epoch。
+
+        params.accum_steps 未设置时为 1。当 params.accum_steps > 1 时，每 accum_steps 个 batch（micro-batch）才进行一次 optimizer step：
+            - train_batch() 仍然对每个 micro-batch 调用一次，其中 optimizer 的 step() 只在最后一个 micro-batch 中生效，
+              生效前梯度会除以 micro-batch 的数量；zero_grad() 在窗口内不生效，窗口结束后统一调用。
+              只有注册为 trainer 属性的 optimizer（见 optimizer_dict）会被接管。
+            - train_batch 的回调（如 on_train_batch_begin / on_train_batch_end）每个窗口只触发一次，
+              batch_data 参数为该窗口的 MicroBatches 对象，meter 参数为各 micro-batch meter 的均值。
+            - params.global_step 和 params.idx 以 optimizer step 计数。
+
+        从 epoch 中间保存的 checkpoint 恢复后（见 load_checkpoint_dict()），会从中断的 batch 继续，idx 也从该位置开始计数。
+        params.global_step 和 epoch 中的位置在 train_batch() 返回后、on_train_batch_end 回调前推进，
+        因此 train_batch 的回调中保存的 checkpoint 包含当前 batch，而 train_batch() 中抛出异常（如 KeyboardInterrupt）时
+        保存的 checkpoint 不包含未完成的 batch。
+        """
         avg = AvgMeter()
         self.change_mode(True)
-        for idx, batch_data in enumerate(self.train_dataloader):  # 复现多线程下 Keyboard Interupt，尝试通过Try解决
-            meter = self.train_batch(eidx, idx, self.params.global_step, batch_data, params, self.device)
+        skip, self._resume_batches = self._resume_batches, 0
+        self._epoch_batches = self._read_batches = skip
+        accum_steps = params.get('accum_steps', 1) or 1
+        if accum_steps > 1:
+            batches = MicroBatches.split(enumerate(self._count_batches(), skip), accum_steps, skip // accum_steps)
+            train_batch = self._accum_train_batch
+        else:
+            batches = enumerate(self._count_batches(), skip)
+            train_batch = self.train_batch
+
+        for idx, batch_data in batches:  # 复现多线程下 Keyboard Interupt，尝试通过Try解决
+            self._unfinished = True
+            try:
+                meter = train_batch(eidx, idx, self.params.global_step, batch_data, params, self.device)
+                # the exception raised in train_batch() was handled by a callback, the batch is skipped
+                self._finish_batch()
+            finally:
+                self._unfinished = False
             avg.update(meter)
             # del meter
 
-            params.global_step += 1
             params.idx = idx
             if self.train_epoch_toggle:
                 self.train_epoch_toggle = False
@@ -283,11 +498,39 @@ class BaseTrainer(metaclass=Merge):
         self.change_mode(False)
         return avg
 
+    def _count_batches(self):
+        for batch_data in self.train_dataloader:
+            self._read_batches += 1
+            yield batch_data
+
+    def _finish_batch(self):
+        """train_epoch() 中的一个 batch（或梯度累积的一个窗口）完成，只在该 batch 第一次调用时生效"""
+        if self._unfinished:
+            self._unfinished = False
+            self.params.global_step += 1
+            self._epoch_batches = self._read_batches
+
+    def _train_accum_batch(self, eidx, idx, global_step, micro_batches, params: Params, device: torch.device):
+        """依次对窗口内的每个 micro-batch 调用原始的 train_batch()，并在最后统一进行一次 optimizer step"""
+        train_batch = getattr(self.train_batch, '__thexp_inner__', self.train_batch)
+        avg = AvgMeter()
+        self._loss_scaled = False
+        for micro_idx, batch_data, last in micro_batches:
+            hook = _OptimizerHook(self._optim_dict.values(), step=last, zero_grad=False,
+                                  grad_scale=micro_batches.count, scaler=self.grad_scaler,
+                                  scaled=lambda: self._loss_scaled)
+            with self.autocast(), hook:
+                avg.update(train_batch(eidx, micro_idx, global_step, batch_data, params, device))
+        for optim in self._optim_dict.values():
+            optim.zero_grad()
+        return avg.mean_meter()
+
     def train_step(self, steps) -> Union[AvgMeter, Meter]:
         """
         train specific steps
         Args:
-            steps: int
+            steps: int, optimizer steps, each step reads params.accum_steps batches when params.accum_steps > 1,
+                see train_epoch()
 
         Returns:
             if steps > 1, will return a AveMeter instance.
@@ -295,16 +538,28 @@ class BaseTrainer(metaclass=Merge):
 
         """
         param = self.params
+        accum_steps = param.get('accum_steps', 1) or 1
+        if accum_steps > 1:
+            def batches():
+                return MicroBatches.split(enumerate(self.train_dataloader), accum_steps)
+
+            train_batch = self._accum_train_batch
+        else:
+            def batches():
+                return enumerate(self.train_dataloader)
+
+            train_batch = self.train_batch
+
         i = 0
         if steps == 1:
-            for idx, data in enumerate(self.train_dataloader):
-                return self.train_batch(0, idx, i, data, param, self.device)
+            for idx, data in batches():
+                return train_batch(0, idx, i, data, param, self.device)
 
         avg = AvgMeter()
         while steps > 0:
             avg = AvgMeter()
-            for idx, data in enumerate(self.train_dataloader):
-                meter = self.train_batch(0, idx, i, data, param, self.device)
+            for idx, data in batches():
+                meter = train_batch(0, idx, i, data, param, self.device)
                 steps -= 1
                 avg.update(meter)
                 if steps <= 0:
@@ -342,6 +597,49 @@ class BaseTrainer(metaclass=Merge):
             return None
         return self.test_eval_logic_v2(loader, self.params, False)
 
+    def autocast(self):
+        """
+        返回 params.precision 对应的 autocast 上下文（未设置时为 fp32）：
+            fp32: 不做任何事
+            bf16: torch.autocast(device.type, dtype=torch.bfloat16)
+            fp16: torch.autocast(device.type, dtype=torch.float16)，梯度通过 grad_scaler 缩放
+
+        train_batch() 和 test_eval_logic_v2() 会自动在该上下文中执行。params.precision 在创建 Trainer 时读取。
+        """
+        if self._precision == 'fp32':
+            return contextlib.nullcontext()
+        return torch.autocast(self.device.type, dtype=_PRECISION_DTYPES[self._precision])
+
+    @staticmethod
+    def _check_precision(params: Params) -> str:
+        precision = params.get('precision', 'fp32')
+        if precision != 'fp32' and precision not in _PRECISION_DTYPES:
+            raise ValueError("precision must be one of 'fp32', 'bf16' and 'fp16', got {}".format(precision))
+        return precision
+
+    @property
+    def grad_scaler(self):
+        """
+        params.precision 为 fp16 时使用的 torch.amp.GradScaler，否则为 None。
+        会随 checkpoint_dict() 保存，并由 load_checkpoint_dict() 恢复。
+        """
+        if self._grad_scaler is None and self._precision == 'fp16':
+            # not registered in other_state_dict, it is saved with the 'scaler' key of checkpoint
+            object.__setattr__(self, '_grad_scaler', torch.amp.GradScaler(self.device.type))
+        return self._grad_scaler
+
+    def backward(self, loss: torch.Tensor, **kwargs):
+        """
+        代替 loss.backward()，fp16 时会先通过 grad_scaler 缩放 loss，optimizer 的 step() 会被自动接管为 scaler.step()。
+        直接调用 loss.backward() 时 step() 不会被接管（并给出警告）。
+        如果需要在 step 之前裁剪梯度，需要先调用 trainer.grad_scaler.unscale_(optim)。
+        """
+        scaler = self.grad_scaler
+        if scaler is not None:
+            loss = scaler.scale(loss)
+            self._loss_scaled = True
+        loss.backward(**kwargs)
+
     @property
     def in_main_process(self):
         return self.params.local_rank <= 0
@@ -418,9 +716,25 @@ class BaseTrainer(metaclass=Merge):
     @property
     @lru_cache()
     def saver(self):
-        """see thexp.frame.Saver"""
+        """
+        see thexp.frame.Saver
+
+        params.async_save = True 时，checkpoint 会在后台线程中写入，见 Saver(async_save=True)
+        params.sharded_ckpt = True 时，checkpoint 的每个部分会单独保存，可以只读取需要的部分，见 Saver(sharded=True)
+        params.dedup_ckpt = True 时，同一个实验下所有 checkpoint 中相同的 tensor 只会保存一次，见 Saver(blob_dir=...)
+        params.delta_ckpt = True 时，checkpoint 只保存自上一次保存以来发生变化的 tensor，
+            每 params.delta_compact_every（默认为 10）次完整保存一次，见 Saver(delta=True)
+        """
         kwargs = self.experiment.add_saver()
-        return Saver(**kwargs)
+        blob_dir = None
+        if self.params.get('dedup_ckpt', False):
+            blob_dir = self.experiment.make_exp_dir(_PLUGIN_DIRNAME.blobs)
+        return Saver(**kwargs,
+                     async_save=self.params.get('async_save', False),
+                     sharded=self.params.get('sharded_ckpt', False),
+                     blob_dir=blob_dir,
+                     delta=self.params.get('delta_ckpt', False),
+                     compact_every=self.params.get('delta_compact_every', 10))
 
     @property
     @lru_cache()
@@ -481,18 +795,19 @@ class BaseTrainer(metaclass=Merge):
         self.logger.info("save keypoint in {}".format(fn))
         return fn
 
-    def save_checkpoint(self, extra_info=None, replacement=False):
+    def save_checkpoint(self, extra_info=None, replacement=False, metric=None):
         """
         保存 checkpoint，会保存所有可存储格式
         Args:
             extra_info:  额外的信息，将以 json 格式被保存在和模型文件名相同，但后缀名为 json 的文件中
             replacement: 若遇到相同文件名，是否进行替换
+            metric: 用于保留策略（self.saver.retention）的指标，见 RetentionPolicy
 
         Returns:
             保存的 checkpoint 的文件名
         """
         state_dict = self.checkpoint_dict()
-        fn = self.saver.save_checkpoint(self.params.eidx, state_dict, extra_info, replacement)
+        fn = self.saver.save_checkpoint(self.params.eidx, state_dict, extra_info, replacement, metric=metric)
         self.logger.info("save checkpoint in {}".format(fn))
         return fn
 
@@ -528,6 +843,7 @@ class BaseTrainer(metaclass=Merge):
             return False
         bisect.insort(self._callback_set, callback)
         self._callback_name_set.add(cb_name)
+        self._rebuild_callback_dispatch()
 
         callback._trainer = self
         callback.on_hooked(self, self.params)
@@ -573,9 +889,26 @@ class BaseTrainer(metaclass=Merge):
         cb_name = callback.__class__.__name__
         self._callback_set.remove(callback)
         self._callback_name_set.remove(cb_name)
+        self._rebuild_callback_dispatch()
         self.logger.info("{} unhooked from {}.".format(callback, self))
         return True
 
+    def _rebuild_callback_dispatch(self):
+        """
+        重建每个被包裹函数的回调列表，只保留真正重写了相应 on_xxx_begin / on_xxx_end 的回调，
+        这样在没有回调关心某个函数（如 train_batch）时，每次调用只需要遍历一个空列表。
+        构建完成后，每个回调还可以通过 _instrument_dispatch() 对列表进行修改（如 ProfileCallback 的计时）。
+
+        列表是原地修改的，已经包裹好的函数无需重新包裹。
+        """
+        for name, (begins, ends) in self._callback_dispatch.items():
+            begins[:] = [hook for hook in (cb._dispatch_begin(name) for cb in self._callback_set)
+                         if hook is not None]
+            ends[:] = [hook for hook in (cb._dispatch_end(name) for cb in self._callback_set)
+                       if hook is not None]
+            for cb in self._callback_set:
+                cb._instrument_dispatch(name, begins, ends)
+
     '''module和optim的一部分方法集成'''
 
     def load_checkpoint(self, fn):
@@ -584,7 +917,10 @@ class BaseTrainer(metaclass=Merge):
         self.logger.raw(pp.pformat(info))
 
     def load_model(self, fn, strict=True):
-        ckpt, info = self.saver.load_state_dict(fn)
+        """
+        fn 可以是 save_model() 保存的模型，也可以是 checkpoint（.ckpt），此时只会读取其中的 model 部分
+        """
+        ckpt, info = self.saver.load_model(fn)
         self.load_model_state_dict(ckpt, strict=strict)
         self.logger.raw(pp.pformat(info))
 
@@ -598,6 +934,32 @@ class BaseTrainer(metaclass=Merge):
         self.load_other_state_dict(state_dict["other"])
         self.load_vector_dict(state_dict["vector"])
         self.load_extra_state_dict(state_dict['plug'])
+        if 'scaler' in state_dict and self.grad_scaler is not None:
+            self.grad_scaler.load_state_dict(state_dict['scaler'])
+        if 'epoch_batches' in state_dict:
+            self._load_epoch_position(state_dict)
+
+    def _load_epoch_position(self, state_dict):
+        """
+        恢复保存时在 epoch 中的位置：
+            - 保存于 epoch 结束时（如 on_train_epoch_end），则从下一个 epoch 开始
+            - 保存于 epoch 中间，并且 train_dataloader 的所有 DataLoader 都使用了 ResumableSampler，
+              则下一次 train_epoch() 会直接从中断的 batch 开始，否则从该 epoch 的第一个 batch 开始
+        """
+        loader = self.train_dataloader
+        batches = state_dict['epoch_batches']
+        rng_state = state_dict['rng']
+        if loader is not None and batches > 0:
+            if batches >= len(loader):
+                self.params.eidx += 1
+                loader.load_sampler_state_dict(state_dict['sampler'])
+            elif loader.resumable:
+                self._resume_batches = batches
+                # the random state will be restored when the interrupted DataLoader starts
+                loader.load_sampler_state_dict(state_dict['sampler'], rng_state)
+                rng_state = None
+        if rng_state is not None:
+            rnd.set_state(rng_state, fix_cudnn=False)
 
     def load_model_state_dict(self, state_dict, strict=True):
         self.logger.inline("loading model: ", append=True)
@@ -722,6 +1084,13 @@ class BaseTrainer(metaclass=Merge):
             global_step=self.params.global_step,
             test_name=self.experiment.test_name,
         )
+        if self.grad_scaler is not None:
+            val['scaler'] = self.grad_scaler.state_dict()
+        # used to resume from the middle of an epoch
+        val['rng'] = rnd.get_state()
+        val['epoch_batches'] = self._epoch_batches
+        if self.train_dataloader is not None:
+            val['sampler'] = self.train_dataloader.sampler_state_dict(self._epoch_batches)
         return val
 
     def model_state_dict(self):
@@ -892,6 +1261,7 @@ class DistributedTrainer():
             _PLUGIN_KEY.TRAINER.class_name: trainer.__class__.__name__
         }
         trainer.experiment.add_plugin(_BUILTIN_PLUGIN.trainer, trainer_kwargs)
+        trainer.experiment.flush()
 
         params.distributed = True
         import torch.multiprocessing as mp
@@ -52,6 +52,12 @@ class _FNAME:
     expsdirs = '.expsdirs'
     gitignore = ".gitignore"
     gitignore_version = '.thexp.{}'.format(__VERSION__)
+    profile = 'profile.v1.jsonl'
+    snapshot = 'thexp-snapshot.v1.json'  # in .git/, see utils.repository.snapshot()
+    snapshot_index = 'thexp-index'
+    index = 'index.v1.sqlite'  # in ~/.thexp, see utils.index.TestIndex
+    test_count = '.testcount'  # in exp_dir, the number of the last allocated test
+    lock = '.lock'
 
 
 class _TEST_BUILTIN_STATE:
@@ -73,6 +79,7 @@ class _BUILTIN_PLUGIN:
     logger = 'logger'
     saver = 'saver'
     rnd = 'rnd'
+    profile = 'profile'
 
 
 class _PLUGIN_DIRNAME:
@@ -80,6 +87,7 @@ class _PLUGIN_DIRNAME:
     writer_tmp = 'board_tmp'
     saver = 'modules'
     rnd = 'rnd'
+    blobs = 'blobs'
 
 
 class _PLUGIN_KEY:
@@ -108,6 +116,9 @@ class _PLUGIN_KEY:
         max_to_keep = 'max_to_keep'
         ckpt_dir = 'ckpt_dir'
 
+    class PROFILE:
+        fn = 'fn'
+
 
 class _INDENT:
     tab = '  '
@@ -0,0 +1,259 @@
+"""
+所有试验的元数据索引（~/.thexp/index.v1.sqlite），用于加快 TestsQuery 的筛选
+"""
+import json
+import os
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .dates import date_from_str
+from ..globals import _FNAME, _INFOJ
+
+try:
+    import sqlite3
+except ImportError:  # python built without sqlite3
+    sqlite3 = None
+
+# errors raised when the index can't be used, the callers should fall back to reading the files
+INDEX_ERRORS = (ImportError,) if sqlite3 is None else (ImportError, sqlite3.Error)
+
+_SCHEMA_VERSION = 4  # PRAGMA user_version, all tables are rebuilt when it changes
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tests (
+    test_dir TEXT PRIMARY KEY,
+    exp_dir TEXT,
+    info_mtime INTEGER,
+    params_mtime INTEGER,
+    end_code INTEGER,
+    start_ts REAL,
+    info TEXT,
+    params TEXT
+);
+CREATE TABLE IF NOT EXISTS tags (test_dir TEXT, name TEXT, PRIMARY KEY (test_dir, name));
+CREATE TABLE IF NOT EXISTS plugins (test_dir TEXT, name TEXT, PRIMARY KEY (test_dir, name));
+CREATE TABLE IF NOT EXISTS param_values (test_dir TEXT, name TEXT, value, kind TEXT, PRIMARY KEY (test_dir, name));
+CREATE INDEX IF NOT EXISTS tests_exp_dir ON tests (exp_dir);
+CREATE INDEX IF NOT EXISTS tags_name ON tags (name);
+CREATE INDEX IF NOT EXISTS plugins_name ON plugins (name);
+"""
+
+
+def _mtime(fn) -> Optional[int]:
+    try:
+        return os.stat(fn).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _load(fn) -> Optional[dict]:
+    try:
+        with open(fn, encoding='utf-8') as r:
+            return json.load(r)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def flatten_params(params: dict, prefix: str = '') -> Iterator[Tuple[str, Any]]:
+    """
+    与 attr.walk() 相同，将 params.json 的内容展开为 ('a.b.c', value)，忽略 _class_name。
+    不同的是空的 dict 会展开为 ('a', {})，使其与不存在的参数可以区分
+    """
+    for k, v in params.items():
+        if k == '_class_name':
+            continue
+        if isinstance(v, dict):
+            if any(i != '_class_name' for i in v):
+                yield from flatten_params(v, '{}{}.'.format(prefix, k))
+            else:
+                yield prefix + k, {}
+        else:
+            yield prefix + k, v
+
+
+def _encode(value) -> tuple:
+    """(value, kind)，SQLite 无法直接表示的值（bool、list 等）记录 kind 后转换"""
+    if isinstance(value, bool):
+        return int(value), 'bool'
+    if isinstance(value, (float, str)) or (isinstance(value, int) and -(1 << 63) <= value < (1 << 63)):
+        return value, None
+    return json.dumps(value), 'json'
+
+
+def _decode(value, kind):
+    if kind is None:
+        return value
+    if kind == 'bool':
+        return bool(value)
+    return json.loads(value)
+
+
+class TestIndex:
+    """
+    每个 test 在索引中记录 info.v1.json 和 params.v1.json 的内容、修改时间，以及用于筛选的 end_code、start_time、tags、plugins，
+    和展开后的每个参数（param_values，见 flatten_params()）。
+
+    索引由 Experiment 在每次写入 info.json 后更新（update()），查询前通过 sync() 比较文件的修改时间，
+    只有修改时间不同（如旧版本创建的、或者被其他方式修改过的 test）时才会重新读取文件，
+    同时会删除与这些 test 位于同一实验目录下、但已经被删除的 test 的记录。
+    多个进程可以同时读写索引（WAL 模式）。
+
+    Args:
+        fn: 索引文件，默认为 ~/.thexp/index.v1.sqlite
+        timeout: 等待其他进程释放写锁的时间（秒）
+
+    Raises:
+        INDEX_ERRORS 中的异常：sqlite3 不可用，或者索引被长时间锁住
+    """
+
+    def __init__(self, fn: str = None, timeout: float = 30):
+        if sqlite3 is None:
+            raise ImportError('sqlite3 is not available')
+        if fn is None:
+            from .paths import home_dir
+            fn = os.path.join(home_dir(), _FNAME.index)
+        self.fn = fn
+        self.conn = sqlite3.connect(fn, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] != _SCHEMA_VERSION:
+            with self.conn:
+                for table in ('tests', 'tags', 'plugins', 'param_values'):
+                    self.conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+                self.conn.execute('PRAGMA user_version = {}'.format(_SCHEMA_VERSION))
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _upsert(self, test_dir: str, info: Optional[dict], info_mtime, params: Optional[dict], params_mtime):
+        self.conn.execute('DELETE FROM tags WHERE test_dir = ?', (test_dir,))
+        self.conn.execute('DELETE FROM plugins WHERE test_dir = ?', (test_dir,))
+        self.conn.execute('DELETE FROM param_values WHERE test_dir = ?', (test_dir,))
+        if info is None:
+            self.conn.execute('DELETE FROM tests WHERE test_dir = ?', (test_dir,))
+            return
+
+        start_ts = None
+        if _INFOJ.start_time in info and _INFOJ.time_fmt in info:
+            try:
+                start_ts = date_from_str(info[_INFOJ.start_time], info[_INFOJ.time_fmt]).timestamp()
+            except ValueError:
+                pass
+        self.conn.execute('INSERT OR REPLACE INTO tests VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+            test_dir, os.path.dirname(test_dir), info_mtime, params_mtime, info.get(_INFOJ.end_code, None), start_ts,
+            json.dumps(info), None if params is None else json.dumps(params)))
+        self.conn.executemany('INSERT OR IGNORE INTO tags VALUES (?, ?)',
+                              [(test_dir, tag) for tag in info.get(_INFOJ.tags, {})])
+        self.conn.executemany('INSERT OR IGNORE INTO plugins VALUES (?, ?)',
+                              [(test_dir, plugin) for plugin in info.get(_INFOJ.plugins, {})])
+        if params is not None:
+            self.conn.executemany('INSERT OR REPLACE INTO param_values VALUES (?, ?, ?, ?)',
+                                  [(test_dir, name, *_encode(value)) for name, value in flatten_params(params)])
+
+    def update(self, test_dir: str, info: dict = None, info_mtime: int = None):
+        """
+        重新记录 test_dir
+
+        Args:
+            info: 刚写入 info.json 的内容，为 None 时从文件中读取
+            info_mtime: 写入 info 后 info.json 的修改时间。在写入之后才更新索引时需要传入，
+                此时如果文件已经被再次修改，记录的修改时间与文件不同，之后的 sync() 会重新读取
+        """
+        info_fn = os.path.join(test_dir, _FNAME.info)
+        params_fn = os.path.join(test_dir, _FNAME.params)
+        if info is None:
+            info = _load(info_fn)
+        if info_mtime is None:
+            info_mtime = _mtime(info_fn)
+        params = _load(params_fn), _mtime(params_fn)
+        with self.conn:
+            self._upsert(test_dir, info, info_mtime, *params)
+
+    def _candidates(self, test_dirs: Iterable[str]):
+        """将 test_dirs 写入临时表 candidates，用于之后的查询"""
+        with self.conn:  # only the temp database is written, doesn't lock the index
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS candidates (test_dir TEXT PRIMARY KEY)')
+            self.conn.execute('DELETE FROM candidates')
+            self.conn.executemany('INSERT OR IGNORE INTO candidates VALUES (?)', [(i,) for i in test_dirs])
+
+    def sync(self, test_dirs: List[str]):
+        """
+        检查 test_dirs 的索引是否过期（info.json 或 params.json 的修改时间与记录的不同），重新读取过期的 test，
+        并删除同一实验目录下 info.json 已经不存在的 test 的记录。
+        文件在写事务开始前读取，因此不会在读取文件时阻塞其他进程对索引的更新。
+        """
+        self._candidates(test_dirs)
+        recorded = {row[0]: row[1:] for row in self.conn.execute(
+            'SELECT t.test_dir, t.info_mtime, t.params_mtime FROM tests t JOIN candidates c USING (test_dir)')}
+        stale = []
+        for test_dir in test_dirs:
+            info_fn = os.path.join(test_dir, _FNAME.info)
+            params_fn = os.path.join(test_dir, _FNAME.params)
+            mtimes = (_mtime(info_fn), _mtime(params_fn))
+            if recorded.get(test_dir, None) != mtimes:
+                stale.append((test_dir, _load(info_fn), mtimes[0], _load(params_fn), mtimes[1]))
+
+        candidates = set(test_dirs)
+        for exp_dir in {os.path.dirname(i) for i in test_dirs}:
+            for test_dir, in self.conn.execute('SELECT test_dir FROM tests WHERE exp_dir = ?', (exp_dir,)):
+                if test_dir not in candidates and not os.path.exists(os.path.join(test_dir, _FNAME.info)):
+                    stale.append((test_dir, None, None, None, None))
+
+        if len(stale) > 0:
+            with self.conn:
+                for row in stale:
+                    self._upsert(*row)
+
+    def select(self, test_dirs: List[str], where: str, args=()) -> set:
+        """
+        Args:
+            test_dirs: 需要已经 sync()
+            where: 对表 tests（别名 t）的 SQL 条件，如 't.end_code = 0'
+
+        Returns:
+            test_dirs 中满足条件的 test_dir
+        """
+        self._candidates(test_dirs)
+        sql = 'SELECT t.test_dir FROM tests t JOIN candidates c USING (test_dir) WHERE {}'.format(where)
+        return {row[0] for row in self.conn.execute(sql, args)}
+
+    def params(self, test_dirs: List[str]) -> Dict[str, Optional[dict]]:
+        """test_dirs（需要已经 sync()）对应的 params.json 的内容，没有记录 params 的 test 为 None"""
+        self._candidates(test_dirs)
+        res = dict.fromkeys(test_dirs)
+        for test_dir, params in self.conn.execute(
+                'SELECT t.test_dir, t.params FROM tests t JOIN candidates c USING (test_dir)'):
+            if params is not None:
+                res[test_dir] = json.loads(params)
+        return res
+
+    def param_values(self, test_dirs: List[str], names: Iterable[str] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        test_dirs（需要已经 sync()）展开后的参数
+
+        Args:
+            names: 只读取这些参数（以及 dict 类型参数的所有子参数，如 'a' 的 'a.b.c'），为 None 时读取所有参数
+
+        Returns:
+            {'a.b.c': {test_dir: value}}，可以直接用于构建 pd.DataFrame
+        """
+        self._candidates(test_dirs)
+        sql = 'SELECT p.test_dir, p.name, p.value, p.kind FROM param_values p JOIN candidates c USING (test_dir)'
+        args = ()
+        if names is not None:
+            names = tuple(set(names))
+            args = names + tuple(i for name in names for i in (len(name) + 1, name + '.'))
+            sql += ' WHERE p.name IN ({}){}'.format(', '.join('?' * len(names)),
+                                                    ' OR substr(p.name, 1, ?) = ?' * len(names))
+        res = {}
+        for test_dir, name, value, kind in self.conn.execute(sql + ' ORDER BY p.rowid', args):
+            column = res.get(name, None)
+            if column is None:
+                column = res[name] = {}
+            column[test_dir] = _decode(value, kind)
+        return res
@@ -1,11 +1,17 @@
 """
 Methods about files/paths/hash
 """
+import contextlib
 import hashlib
 import json
 import os
 from functools import lru_cache
 
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
 from ..globals import _GITKEY
 
 
@@ -14,11 +20,59 @@ def listdir_by_time(dir_path):
     if not dir_list:
         return []
     else:
-        # os.path.getctime() 函数是获取文件最后创建时间
-        dir_list = sorted(dir_list, key=lambda x: os.path.getatime(os.path.join(dir_path, x)), reverse=True)
+        # 按最后修改时间排序（访问时间会在读取文件时改变）
+        dir_list = sorted(dir_list, key=lambda x: os.path.getmtime(os.path.join(dir_path, x)), reverse=True)
         return dir_list
 
 
+def atomic_dump_json(obj, fn, indent=2):
+    """先写入临时文件再重命名，读取者看到的文件要么是旧的，要么是完整的新文件"""
+    tmp_fn = "{}.tmp{}".format(fn, os.getpid())
+    with open(tmp_fn, "w", encoding="utf-8") as w:
+        json.dump(obj, w, indent=indent)
+    os.replace(tmp_fn, fn)
+
+
+@contextlib.contextmanager
+def file_lock(fn):
+    """
+    通过 fn 上的文件锁（fcntl）与其他进程互斥，windows 下不加锁
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(fn, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_json(fn, default=None):
+    """读取 json 文件，文件不存在或内容不完整（被旧版本非原子地写入）时返回 default"""
+    try:
+        with open(fn, 'r', encoding='utf-8') as r:
+            return json.load(r)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+@contextlib.contextmanager
+def locked_json(fn, indent=None):
+    """
+    在 <fn>.lock 的文件锁下读取 fn 中的 dict，with 语句中修改后原子地写回，用于多个进程共同维护的文件（如 repo.v1.json）
+
+    Examples:
+        with locked_json(fn) as res:
+            res[key] = value
+    """
+    with file_lock("{}.lock".format(fn)):
+        res = load_json(fn, {})
+        yield res
+        atomic_dump_json(res, fn, indent=indent)
+
+
 def _default_config():
     return {
         _GITKEY.expsdir: os.path.expanduser("~/.thexp/experiments")
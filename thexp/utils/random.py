@@ -41,7 +41,7 @@ def get_state():
     }
 
 
-def set_state(state_dict):
+def set_state(state_dict, fix_cudnn=True):
     random.setstate(state_dict["random"])
     np.random.set_state(state_dict["numpy"])
     torch.random.set_rng_state(state_dict["torch"])
@@ -51,4 +51,5 @@ def set_state(state_dict):
         else:
             import warnings
             warnings.warn("Don't have torch.cuda random state")
-    fix_cuda()
\ No newline at end of file
+    if fix_cudnn:
+        fix_cuda()
\ No newline at end of file
@@ -1,16 +1,19 @@
 """
 Methods about git.
 """
+import hashlib
 import json
 import os
+import shutil
 import sys
 from functools import lru_cache
 from typing import List
 from uuid import uuid4
 
-from git import Git, Repo
+from git import Actor, Commit, Git, GitCommandError, Repo
+from gitdb.util import hex_to_bin
 from thexp import __VERSION__
-from thexp.utils.paths import renormpath
+from thexp.utils.paths import renormpath, atomic_dump_json
 from .dates import curent_date
 from ..globals import _GITKEY, _OS_ENV, _FNAME
 
@@ -276,21 +279,133 @@ def load_repo(dir='./') -> Repo:
 _commits_map = {}
 
 
-def commit(repo: Repo, key=None, branch_name=_GITKEY.thexp_branch):
-    """"""
+def stat_fingerprint(repo: Repo) -> str:
+    """
+    工作区中所有会被提交的文件（已跟踪的和未被忽略的）的路径、大小、修改时间的 hash，
+    只需要列出文件和 stat，不需要读取文件内容，用于判断工作区自上一次快照后是否被修改。
+    """
+    files = repo.git.execute(['git', 'ls-files', '-z', '--cached', '--others', '--exclude-standard'])
+    h = hashlib.sha1()
+    for f in sorted(set(files.split('\0'))):
+        if not f:
+            continue
+        try:
+            st = os.lstat(os.path.join(repo.working_dir, f))
+        except FileNotFoundError:  # deleted but still in the index
+            continue
+        h.update("{}\0{}\0{}\0{}\n".format(f, st.st_size, st.st_mtime_ns, st.st_mode).encode())
+    return h.hexdigest()
+
+
+def _rev_parse(repo: Repo, rev: str):
+    try:
+        return repo.git.execute(['git', 'rev-parse', '--verify', '-q', rev])
+    except GitCommandError:
+        return None
+
+
+def _write_tree(repo: Repo) -> str:
+    """
+    通过临时的 index（GIT_INDEX_FILE）生成工作区的 tree，不会修改用户的 index。
+
+    临时 index 在每次快照后保存在 .git/thexp-index 中，其中记录的文件 stat 使下一次 add 只需要重新读取被修改过的文件；
+    第一次快照时从用户的 index 复制。
+    """
+    cache_fn = os.path.join(repo.git_dir, _FNAME.snapshot_index)
+    index_fn = "{}.{}".format(cache_fn, os.getpid())
+    for src in [cache_fn, os.path.join(repo.git_dir, 'index')]:
+        if os.path.exists(src):
+            shutil.copyfile(src, index_fn)
+            break
+    env = {'GIT_INDEX_FILE': index_fn}
+    try:
+        repo.git.execute(['git', 'add', '--all'], env=env)
+        tree = repo.git.execute(['git', 'write-tree'], env=env)
+        os.replace(index_fn, cache_fn)
+    finally:
+        if os.path.exists(index_fn):
+            os.remove(index_fn)
+    return tree
+
+
+def snapshot(repo: Repo, branch_name=_GITKEY.thexp_branch, fingerprint: str = None) -> Commit:
+    """
+    将工作区的当前状态提交到 branch_name 分支上，只使用 write-tree / commit-tree / update-ref 等底层命令，
+    用户的 HEAD 和 index 不会被修改。
+
+    工作区的 stat_fingerprint() 与上一次快照相同时直接返回上一次的 commit，记录在 .git/thexp-snapshot.v1.json 中。
+
+    Args:
+        repo:
+        branch_name:
+        fingerprint: 已经计算好的 stat_fingerprint(repo)
+
+    Returns:
+        git.Commit
+    """
+    if fingerprint is None:
+        fingerprint = stat_fingerprint(repo)
+    cache_fn = os.path.join(repo.git_dir, _FNAME.snapshot)
+    cache = {}
+    if os.path.exists(cache_fn):
+        try:
+            with open(cache_fn, 'r', encoding='utf-8') as r:
+                cache = json.load(r)
+        except ValueError:
+            cache = {}
+    cached = cache.get(branch_name, None)
+    if cached is not None and cached['fingerprint'] == fingerprint:
+        if _rev_parse(repo, "{}^{{commit}}".format(cached['commit'])) is not None:
+            return Commit(repo, hex_to_bin(cached['commit']))
+
+    tree = _write_tree(repo)
+    commit_info = dict(
+        date=curent_date(),
+        args=sys.argv,
+        environ="jupyter" if "jupyter_core" in sys.modules else "python",
+        version=sys.version,
+    )
+    reader = repo.config_reader()
+    author, committer = Actor.author(reader), Actor.committer(reader)
+    env = {
+        'GIT_AUTHOR_NAME': author.name, 'GIT_AUTHOR_EMAIL': author.email,
+        'GIT_COMMITTER_NAME': committer.name, 'GIT_COMMITTER_EMAIL': committer.email,
+    }
+    ref = 'refs/heads/{}'.format(branch_name)
+    for _ in range(5):  # retry if another process moved the branch meanwhile
+        old = _rev_parse(repo, ref)
+        parent = old or _rev_parse(repo, 'HEAD^{commit}')
+        if parent is not None and _rev_parse(repo, "{}^{{tree}}".format(parent)) == tree:
+            hexsha = parent  # nothing changed since the last snapshot
+        else:
+            cmd = ['git', 'commit-tree', tree, '-m', json.dumps(commit_info, indent=2)]
+            if parent is not None:
+                cmd.extend(['-p', parent])
+            hexsha = repo.git.execute(cmd, env=env)
+        if hexsha == old:
+            break
+        try:
+            # only succeeds if the branch still points to old (an empty old value means it must not exist)
+            repo.git.execute(['git', 'update-ref', ref, hexsha, old or ''])
+            break
+        except GitCommandError:
+            continue
+    else:
+        raise RuntimeError("can't update branch {}, it is updated by other processes continually".format(branch_name))
+
+    cache[branch_name] = dict(fingerprint=fingerprint, commit=hexsha, tree=tree)
+    atomic_dump_json(cache, cache_fn)
+    return Commit(repo, hex_to_bin(hexsha))
+
+
+def commit(repo: Repo, key=None, branch_name=_GITKEY.thexp_branch, fingerprint: str = None):
+    """
+    生成工作区的快照，同一进程中相同 key 的调用只会提交一次，见 snapshot()
+    """
     if key is not None and key in _commits_map:
         return _commits_map[key]
 
-    with branch(repo, branch_name):
-        repo.git.add(all=True)
-        commit_date = curent_date()
-        commit_info = dict(
-            date=commit_date,
-            args=sys.argv,
-            environ="jupyter" if "jupyter_core" in sys.modules else "python",
-            version=sys.version,
-        )
-        commit_ = repo.index.commit(json.dumps(commit_info, indent=2))
+    commit_ = snapshot(repo, branch_name, fingerprint=fingerprint)
     if key is not None:
         _commits_map[key] = commit_
     return commit_